@@ -13,16 +13,15 @@
 
 import datetime
 import json
-import math
 import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
 import os
 import pandas as pd
 import requests
 import seaborn as sns
+import sys
 
 from dotenv import load_dotenv
-from io import BytesIO
 from PIL import Image
 
 
@@ -32,6 +31,15 @@ load_dotenv("azure.env")
 key = os.getenv("azure_cv_key")
 endpoint = os.getenv("azure_cv_endpoint")
 
+# Shared helpers from the repository root (similarity engine, embedding store...)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from similarity import SimilarityIndex, cosine_similarity
+from bulk_vectorize import BulkImageVectorizer
+from image_fetch import get_image_fetcher, decode_image
+
+# Last similarity index built from a list of embeddings, reused across searches
+_similarity_index_cache = {'list_emb': None, 'index': None}
+
 
 # Python functions
 
@@ -99,18 +107,41 @@ def text_embedding(promptxt):
 def get_cosine_similarity(vector1, vector2):
     """
     Get cosine similarity value between two embedded vectors
-    Using sklearn
     """
-    dot_product = 0
-    length = min(len(vector1), len(vector2))
+    return cosine_similarity(vector1, vector2)
+
+
+def get_similarity_index(list_emb):
+    """
+    Get the similarity index of a list of embeddings.
+    The index is kept between calls so the catalog is only normalized once.
+    """
+    if isinstance(list_emb, SimilarityIndex):
+        return list_emb
+
+    cached = _similarity_index_cache
+    if cached['list_emb'] is not list_emb or len(cached['index']) != len(list_emb):
+        cached['index'] = SimilarityIndex(list_emb)
+        cached['list_emb'] = list_emb
 
-    for i in range(length):
-        dot_product += vector1[i] * vector2[i]
+    return cached['index']
 
-    cosine_similarity = dot_product / (math.sqrt(sum(x * x for x in vector1))\
-                                       * math.sqrt(sum(x * x for x in vector2)))
 
-    return cosine_similarity
+def get_similarity_df(query_emb, list_emb, image_files, topn=None):
+    """
+    Score a query embedding against all the images embeddings
+    Returns a df of image files sorted by descending similarity (topn rows only if topn is set)
+    """
+    index = get_similarity_index(list_emb)
+    k = len(index) if topn is None else topn
+    results = index.search(query_emb, k)
+
+    df = pd.DataFrame({
+        'image_file': [image_files[idx] for idx, _ in results],
+        'similarity': [simil for _, simil in results]
+    }, index=[idx for idx, _ in results])
+
+    return df
 
 
 def view_image(image_file):
@@ -123,54 +154,22 @@ def view_image(image_file):
     plt.show()
 
 
-def get_similar_images_using_image(list_emb, image_files, image_file):
+def get_similar_images_using_image(list_emb, image_files, image_file, topn=None):
     """
     Get similar images using an image with Azure Computer Vision 4 Florence
     """
     ref_emb = image_embedding(image_file)
-    idx = 0
-    results_list = []
 
-    for emb_image in list_emb:
-        simil = get_cosine_similarity(ref_emb, list_emb[idx])
-        results_list.append(simil)
-        idx += 1
+    return get_similarity_df(ref_emb, list_emb, image_files, topn=topn)
 
-    df_files = pd.DataFrame(image_files, columns=['image_file'])
-    df_simil = pd.DataFrame(results_list, columns=['similarity'])
-    df = pd.concat([df_files, df_simil], axis=1)
-    df.sort_values('similarity',
-                   axis=0,
-                   ascending=False,
-                   inplace=True,
-                   na_position='last')
 
-    return df
-
-
-def get_similar_images_using_prompt(prompt, image_files, list_emb):
+def get_similar_images_using_prompt(prompt, image_files, list_emb, topn=None):
     """
     Get similar umages using a prompt with Azure Computer Vision 4 Florence
     """
     prompt_emb = text_embedding(prompt)
-    idx = 0
-    results_list = []
 
-    for emb_image in list_emb:
-        simil = get_cosine_similarity(prompt_emb, list_emb[idx])
-        results_list.append(simil)
-        idx += 1
-
-    df_files = pd.DataFrame(image_files, columns=['image_file'])
-    df_simil = pd.DataFrame(results_list, columns=['similarity'])
-    df = pd.concat([df_files, df_simil], axis=1)
-    df.sort_values('similarity',
-                   axis=0,
-                   ascending=False,
-                   inplace=True,
-                   na_position='last')
-
-    return df
+    return get_similarity_df(prompt_emb, list_emb, image_files, topn=topn)
 
 
 def get_topn_images(df, topn=5, disp=False):
@@ -285,6 +284,17 @@ def get_img_embedding_multiprocessing(image_file):
     return emb
 
 
+def bulk_image_embeddings(images, store_path, max_concurrency=16, show_progress=True):
+    """
+    Compute embeddings of a directory or a list of image files with Azure Computer Vision 4 Florence
+    Requests run concurrently and back off on throttling; embeddings are streamed into the
+    embedding store at store_path and images already in the store are skipped
+    """
+    vectorizer = BulkImageVectorizer(endpoint, key, max_concurrency=max_concurrency)
+
+    return vectorizer.run(images, store_path, show_progress=show_progress)
+
+
 def remove_background(image_file):
     """
     Removing background from an image file using Azure Computer Vision 4
@@ -365,9 +375,9 @@ def describe_image_with_AzureCV4(image_file):
 def get_image_from_url(image_url):
     """
     Get an image from an url, download and save the image
+    (downloads are cached on disk and only repeated when the image changed)
     """
-    response = requests.get(image_url)
-    image = Image.open(BytesIO(response.content)).convert("RGB")
+    image = decode_image(get_image_fetcher().fetch(image_url), mode="RGB")
    
     output_image = 'download.jpg'
     image.save(output_image)
@@ -0,0 +1,234 @@
+import os
+import time
+import random
+import logging
+import threading
+import requests
+import numpy as np
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+
+from embedding_store import EmbeddingStore, META_FILE
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.webp')
+THROTTLE_STATUS_CODES = (429, 503)
+
+
+
+def list_images(directory, extensions = IMAGE_EXTENSIONS):
+    """
+    Recursively list the image files of a directory, in a stable order
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename.lower().endswith(extensions):
+                yield os.path.join(root, filename)
+
+
+
+def parse_retry_after(value):
+    """
+    Seconds to wait from a Retry-After header (delay in seconds or HTTP date), None if missing or invalid
+    """
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD concurrency limit: halved and paused on throttling, increased by one after a run of successes.
+    """
+
+    def __init__(self, max_concurrency, min_concurrency = 1, increase_after = 20):
+
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.increase_after = increase_after
+        self.limit = max_concurrency
+        self.paused_until = 0.0
+        self.successes = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+
+    def on_success(self):
+        with self.lock:
+            self.successes += 1
+            if (self.successes >= self.increase_after) and (self.limit < self.max_concurrency):
+                self.limit += 1
+                self.successes = 0
+
+
+    def on_throttle(self, delay):
+        with self.lock:
+            self.throttled += 1
+            self.successes = 0
+            self.limit = max(self.min_concurrency, self.limit // 2)
+            self.paused_until = max(self.paused_until, time.time() + delay)
+
+
+    def wait(self):
+        """
+        Block while the service asked us to back off
+        """
+        delay = self.paused_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+
+class BulkImageVectorizer:
+    """
+    Vectorize many images with Azure Computer Vision 4 and stream the embeddings into an EmbeddingStore.
+
+    Requests run on a thread pool over one pooled HTTP session. The number of requests in flight adapts
+    to 429/503 responses (honouring Retry-After), and images already present in the store are skipped,
+    so an interrupted run resumes where it stopped.
+    """
+
+    def __init__(self, endpoint, key, api_version = "2023-02-01-preview", model_version = "latest",
+                       max_concurrency = 16, max_retries = 8, timeout = 30, session = None):
+
+        if endpoint.endswith('/'):
+            endpoint = endpoint[:-1]
+
+        self.url = f"{endpoint}/computervision/retrieval:vectorizeImage?api-version={api_version}&modelVersion={model_version}"
+        self.headers = {'Content-type': 'application/octet-stream', 'Ocp-Apim-Subscription-Key': key}
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.session = session
+
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+
+
+    def vectorize(self, image_file):
+        """
+        Embedding of one image file, retried with backoff on throttling and transient errors
+        """
+        with open(image_file, 'rb') as f:
+            data = f.read()
+
+        for attempt in range(self.max_retries + 1):
+            self.concurrency.wait()
+            backoff = min(60, 2 ** attempt) * random.uniform(0.5, 1.0)
+
+            try:
+                r = self.session.post(self.url, data=data, headers=self.headers, timeout=self.timeout)
+            except requests.ConnectionError as e:
+                logging.warning(f"Connection error on {image_file}: {e}")
+                time.sleep(backoff)
+                continue
+
+            if r.status_code in THROTTLE_STATUS_CODES:
+                delay = parse_retry_after(r.headers.get('Retry-After'))
+                self.concurrency.on_throttle(backoff if delay is None else delay)
+                continue
+
+            if r.status_code >= 500:
+                time.sleep(backoff)
+                continue
+
+            r.raise_for_status()
+            self.concurrency.on_success()
+            return r.json()['vector']
+
+        raise RuntimeError(f"Could not vectorize {image_file} after {self.max_retries + 1} attempts")
+
+
+    def run(self, images, store, flush_every = 64, show_progress = True):
+        """
+        Vectorize a directory or an iterable of image paths into store (an EmbeddingStore or its path).
+        Returns a dict with the counts of vectorized, skipped and failed images and the throughput.
+        """
+        if isinstance(images, str):
+            images = list_images(images)
+
+        store_path = None
+        if isinstance(store, str):
+            # a new store is created on the first flush, once the embedding dimension is known
+            store_path = store
+            store = EmbeddingStore(store_path) if os.path.exists(os.path.join(store_path, META_FILE)) else None
+
+        stats = {'vectorized': 0, 'skipped': 0, 'failed': []}
+        pending_ids, pending_vectors = [], []
+        start = time.time()
+
+        def flush():
+            nonlocal store
+            if pending_ids:
+                if store is None:
+                    store = EmbeddingStore(store_path, dim=len(pending_vectors[0]))
+                store.append(pending_ids, np.array(pending_vectors))
+                pending_ids.clear()
+                pending_vectors.clear()
+
+        progress = tqdm(desc='Vectorizing', unit='img', disable=not show_progress)
+        images = iter(images)
+        in_flight = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            exhausted = False
+
+            while in_flight or not exhausted:
+
+                # keep as many requests in flight as the adaptive limit allows
+                while (not exhausted) and (len(in_flight) < self.concurrency.limit):
+                    image_file = next(images, None)
+                    if image_file is None:
+                        exhausted = True
+                        break
+                    if (store is not None) and (image_file in store):
+                        stats['skipped'] += 1
+                        continue
+                    in_flight[executor.submit(self.vectorize, image_file)] = image_file
+
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    image_file = in_flight.pop(future)
+                    try:
+                        pending_vectors.append(future.result())
+                        pending_ids.append(image_file)
+                        stats['vectorized'] += 1
+                    except Exception as e:
+                        logging.error(f"Failed to vectorize {image_file}: {e}")
+                        stats['failed'].append(image_file)
+                    progress.update(1)
+
+                if len(pending_ids) >= flush_every:
+                    flush()
+
+        flush()
+        progress.close()
+
+        elapsed = time.time() - start
+        stats['seconds'] = elapsed
+        stats['images_per_second'] = stats['vectorized'] / elapsed if elapsed > 0 else 0.0
+        stats['throttled'] = self.concurrency.throttled
+
+        return stats
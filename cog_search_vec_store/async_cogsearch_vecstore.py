@@ -0,0 +1,360 @@
+import copy
+import time
+import asyncio
+
+from cog_search_vec_store import cs_json
+from cog_search_vec_store import cs_builders
+from cog_search_vec_store import bulk_indexer
+from cog_search_vec_store import async_http_helpers
+from cog_search_vec_store import async_cv_helpers
+from cog_search_vec_store import query_preprocessor
+from cog_search_vec_store.fusion import reciprocal_rank_fusion
+from cog_search_vec_store.cogsearch_vecstore import CogSearchVecStore, NUM_TOP_MATCHES
+
+from embedding_cache import get_embedding_cache
+from utils import get_openai_embedding
+
+
+
+class AsyncCogSearchVecStore(CogSearchVecStore):
+    """
+    asyncio version of CogSearchVecStore for async web tiers.
+
+    Same surface as CogSearchVecStore, with coroutines for every call that reaches a service.
+    When a query contains image URLs, the images are analyzed concurrently and, as with
+    CogSearchVecStore.search, the analysis text is added to the query before it is embedded.
+    """
+
+    def __init__(self, api_key,
+                       search_service_name,
+                       index_name = "img-vec-index",
+                       api_version = "2023-07-01-Preview",
+                       session = None,
+                       cv = None,
+                       cache_results = False,
+                       cache_ttl = 300,
+                       cache_size = 1024,
+                       text_vectorizer = get_openai_embedding,
+                       text_batch_vectorizer = None):
+
+        super().__init__(api_key, search_service_name, index_name, api_version,
+                         cache_results = cache_results, cache_ttl = cache_ttl, cache_size = cache_size,
+                         text_vectorizer = text_vectorizer, text_batch_vectorizer = text_batch_vectorizer, cv = cv)
+
+        self.cv_session = session
+        self.http_req = async_http_helpers.AsyncCogSearchHttpRequest(api_key, search_service_name, index_name, api_version, session=session)
+
+
+    @property
+    def cv(self):
+        """
+        AsyncCV client shared by all the searches of the store, created on first use
+        (pass cv= to the constructor to inject one, e.g. with stub vectorizers)
+        """
+        if self._cv is None:
+            with self.cv_lock:
+                if self._cv is None:
+                    self._cv = async_cv_helpers.AsyncCV(session = self.cv_session, embedding_cache = get_embedding_cache())
+        return self._cv
+
+
+    async def close(self):
+        await self.http_req.close()
+        if self._cv is not None:
+            await self._cv.close()
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+
+    async def create_index(self):
+
+        index_dict = copy.deepcopy(cs_json.create_index_json)
+        index_dict['name'] = self.index_name
+
+        await self.http_req.put(body = index_dict)
+
+
+    async def get_index(self):
+        return await self.http_req.get()
+
+
+    async def delete_index(self):
+        self.invalidate_cache()
+        return await self.http_req.delete()
+
+
+    async def upload_documents(self, documents, batch_size = bulk_indexer.MAX_BATCH_DOCS, max_workers = 4, verbose = False):
+        """
+        Index documents from any iterable or generator, in batches sent concurrently.
+        Returns a report with the number of indexed documents, the failed ones and the throughput.
+        """
+        indexer = bulk_indexer.AsyncBulkIndexer(self.http_req, batch_size=batch_size, max_workers=max_workers)
+        report = await indexer.run(documents, serialize=self.get_upload_doc)
+        self.invalidate_cache()
+
+        if verbose: print(f"Indexed {report['indexed']}/{report['documents']} documents in {report['seconds']:.1f}s ({report['docs_per_second']:.0f} docs/s)")
+
+        return report
+
+
+    async def delete_documents(self, op='index', ids = [], batch_size = bulk_indexer.MAX_BATCH_DOCS, max_workers = 4):
+        indexer = bulk_indexer.AsyncBulkIndexer(self.http_req, batch_size=batch_size, max_workers=max_workers)
+        report = await indexer.run(ids, serialize=self.doc_builder.delete)
+        self.invalidate_cache()
+
+        return report
+
+
+
+    async def get_query_embedding(self, query, vector_name = None):
+        if (vector_name is None) or (vector_name == "aoi_text_vector"):
+            return "aoi_text_vector", await asyncio.to_thread(self.text_vectorizer, query)
+        elif vector_name == 'cv_text_vector':
+            return vector_name, await self.cv.get_text_embedding(query)
+        elif vector_name == 'cv_image_vector':
+            return vector_name, await self.cv.get_img_embedding(query)
+        else:
+            raise Exception(f'Invalid Vector Name {vector_name}')
+
+
+    async def analyze_url(self, url):
+        analysis = self.preprocessor.get_cached_analysis(url)
+        if analysis is None:
+            analysis = await self.cv.analyze_image(img_url=url, features=self.preprocessor.features)
+            self.preprocessor.store_analysis(url, analysis)
+        return analysis
+
+
+    async def preprocess_query(self, query):
+        urls = query_preprocessor.find_image_urls(query)
+        if not urls:
+            return query, urls, ''
+
+        analyses = await asyncio.gather(*[self.analyze_url(url) for url in urls])
+        text_query = query_preprocessor.remove_urls(query, urls)
+
+        return query_preprocessor.add_analyses(text_query, analyses), urls, analyses[0] if len(analyses) == 1 else list(analyses)
+
+
+    async def get_vector_fields(self, query, search_query, vector_name = None):
+        search_query.vector_fields, search_query.vector_value = await self.get_query_embedding(query, vector_name)
+
+        return search_query
+
+
+
+    async def search(self, query, search_type = 'vector', vector_name = None, select=None, filter=None, verbose=False):
+        analysis = ''
+
+        if search_type not in self.search_types:
+            raise Exception(f"search_type must be one of {self.search_types}")
+
+        cache_key = self.get_cache_key(query, 'search', search_type, vector_name, filter, select)
+        cached = self.get_cached_results(cache_key)
+        if cached is not None:
+            return cached
+
+        query, inp_urls, analysis = await self.preprocess_query(query)
+
+        search_query = self.get_search_json(query, search_type)
+        search_query = await self.get_vector_fields(query, search_query, vector_name)
+        search_query.filter = filter
+        search_query.select = ', '.join(self.all_fields) if select is None else select
+
+        results = await self.http_req.post(op ='search', data = search_query.to_json())
+        results = results['value'][:NUM_TOP_MATCHES]
+        if verbose: [print(r['@search.score']) for r in results]
+        if verbose: print(results)
+
+        context, links, scores = self.process_search_results(results)
+
+        if inp_urls:
+            return self.store_cached_results(cache_key, (['Analysis of the image in the question: ' + query + '\n\n'] + context, links, scores, analysis))
+        else:
+            return self.store_cached_results(cache_key, (context, links, scores, analysis))
+
+
+
+    async def search_many(self, queries, search_type = 'vector', vector_name = None, select=None, filter=None,
+                          max_workers = 8, embedding_batch_size = 16, verbose=False):
+        """
+        Run many searches in one call, like CogSearchVecStore.search_many: image analyses run concurrently,
+        the queries are embedded in batches (aoi_text_vector) or concurrently (cv vectors), then the search
+        requests are sent concurrently, at most max_workers at a time.
+        Returns the list of search() results in input order, and a list of per-query timings in seconds.
+        """
+        if search_type not in self.search_types:
+            raise Exception(f"search_type must be one of {self.search_types}")
+
+        n = len(queries)
+        results = [None] * n
+        timings = [{'analysis': 0.0, 'embedding': 0.0, 'search': 0.0, 'total': 0.0, 'cached': False} for _ in range(n)]
+        cache_keys = [self.get_cache_key(q, 'search', search_type, vector_name, filter, select) for q in queries]
+
+        for i in range(n):
+            results[i] = self.get_cached_results(cache_keys[i])
+            timings[i]['cached'] = results[i] is not None
+
+        todo = [i for i in range(n) if results[i] is None]
+        texts, analyses, urls = {}, {}, {}
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def analyze(i):
+            async with semaphore:
+                start = time.perf_counter()
+                texts[i], urls[i], analyses[i] = await self.preprocess_query(queries[i])
+                timings[i]['analysis'] = time.perf_counter() - start
+
+        async def embed(i):
+            async with semaphore:
+                start = time.perf_counter()
+                search_query = await self.get_vector_fields(texts[i], self.get_search_json(texts[i], search_type), vector_name)
+                timings[i]['embedding'] = time.perf_counter() - start
+                return search_query
+
+        async def run_search(i, search_query):
+            async with semaphore:
+                start = time.perf_counter()
+                search_results = (await self.run_search_query(search_query, select, filter))[:NUM_TOP_MATCHES]
+                timings[i]['search'] = time.perf_counter() - start
+
+            if verbose: [print(r['@search.score']) for r in search_results]
+            if verbose: print(search_results)
+            context, links, scores = self.process_search_results(search_results)
+            if urls[i]:
+                context = ['Analysis of the image in the question: ' + texts[i] + '\n\n'] + context
+            results[i] = self.store_cached_results(cache_keys[i], (context, links, scores, analyses[i]))
+
+        await asyncio.gather(*[analyze(i) for i in todo])
+
+        if (vector_name is None) or (vector_name == "aoi_text_vector"):
+            # the embeddings endpoint accepts a list of inputs: one request per batch of queries
+            start = time.perf_counter()
+            vectors = await asyncio.to_thread(self.text_batch_vectorizer, [texts[i] for i in todo], batch_size = embedding_batch_size)
+            elapsed = (time.perf_counter() - start) / max(1, len(todo))
+
+            search_queries = []
+            for i, vector in zip(todo, vectors):
+                search_query = self.get_search_json(texts[i], search_type)
+                search_query.vector_fields, search_query.vector_value = "aoi_text_vector", vector
+                search_queries.append(search_query)
+                timings[i]['embedding'] = elapsed
+        else:
+            search_queries = await asyncio.gather(*[embed(i) for i in todo])
+
+        await asyncio.gather(*[run_search(i, search_query) for i, search_query in zip(todo, search_queries)])
+
+        for t in timings:
+            t['total'] = t['analysis'] + t['embedding'] + t['search']
+
+        return results, timings
+
+
+
+    async def run_search_query(self, search_query, select=None, filter=None):
+        search_query.filter = filter
+        search_query.select = ', '.join(self.all_fields) if select is None else select
+
+        results = await self.http_req.post(op ='search', data = search_query.to_json())
+        return results['value']
+
+
+
+    async def search_multi_vector(self, query, vector_names = cs_builders.VECTOR_FIELDS, weights = None, search_type = 'vector',
+                                  select=None, filter=None, verbose=False):
+        analysis = ''
+
+        if search_type not in self.search_types:
+            raise Exception(f"search_type must be one of {self.search_types}")
+        if weights is not None and len(weights) != len(vector_names):
+            raise Exception(f"weights must have one entry per vector name {vector_names}")
+
+        cache_key = self.get_cache_key(query, 'multi_vector', tuple(vector_names), None if weights is None else tuple(weights), search_type, filter, select)
+        cached = self.get_cached_results(cache_key)
+        if cached is not None:
+            return cached
+
+        inp_url = self.find_image_url(query)
+        text_query = query_preprocessor.remove_urls(query, query_preprocessor.find_image_urls(query))
+
+        async def embed(vector_name):
+            if vector_name == 'cv_image_vector' and not inp_url:
+                return vector_name, (await self.get_query_embedding(text_query, 'cv_text_vector'))[1]
+            return await self.get_query_embedding(inp_url if vector_name == 'cv_image_vector' else text_query, vector_name)
+
+        if inp_url:
+            (query, _, analysis), *vectors = await asyncio.gather(self.preprocess_query(query), *[embed(v) for v in vector_names])
+        else:
+            vectors = await asyncio.gather(*[embed(v) for v in vector_names])
+
+        if weights is None:
+            search_query = self.get_search_json(query, search_type)
+            search_query.vectors = list(vectors)
+            results = await self.run_search_query(search_query, select, filter)
+        else:
+            search_queries = []
+            for vector in vectors:
+                search_query = self.get_search_json(query, search_type)
+                search_query.vector_fields, search_query.vector_value = vector
+                search_queries.append(search_query)
+            rankings = await asyncio.gather(*[self.run_search_query(q, select, filter) for q in search_queries])
+
+            key = lambda r: r.get('id', r.get('file'))
+            docs = {key(r): r for ranking in rankings for r in ranking}
+            fused = reciprocal_rank_fusion([[(key(r), r['@search.score']) for r in ranking] for ranking in rankings], weights=weights)
+            results = [{**docs[id], '@search.score': score} for id, score in fused]
+
+        results = results[:NUM_TOP_MATCHES]
+        if verbose: [print(r['@search.score']) for r in results]
+
+        context, links, scores = self.process_search_results(results)
+
+        if inp_url:
+            return self.store_cached_results(cache_key, (['Analysis of the image in the question: ' + query + '\n\n'] + context, links, scores, analysis))
+        else:
+            return self.store_cached_results(cache_key, (context, links, scores, analysis))
+
+
+
+    async def search_similar_images(self, query, analyze = False, select=None, filter=None, verbose=False):
+
+        analysis = ''
+        search_type = 'vector'
+        vector_name = 'cv_image_vector'
+
+        cache_key = self.get_cache_key(query, 'similar_images', analyze, filter, select)
+        cached = self.get_cached_results(cache_key)
+        if cached is not None:
+            return cached
+
+        url = self.find_image_url(query)
+
+        if url:
+            search_query = self.get_search_json(url, search_type)
+
+            if analyze:
+                analysis, search_query = await asyncio.gather(self.analyze_url(url),
+                                                              self.get_vector_fields(url, search_query, vector_name))
+            else:
+                search_query = await self.get_vector_fields(url, search_query, vector_name)
+
+            search_query.filter = filter
+            search_query.select = ', '.join(self.all_fields) if select is None else select
+
+            results = await self.http_req.post(op ='search', data = search_query.to_json())
+            results = results['value'][:NUM_TOP_MATCHES]
+            if verbose: [print(r['@search.score']) for r in results]
+
+            context, links, scores = self.process_search_results(results)
+
+            return self.store_cached_results(cache_key, (context, links, scores, analysis))
+
+        else:
+            return ["Sorry, no similar images have been found"], [], [], analysis
@@ -0,0 +1,133 @@
+import os
+import asyncio
+from dotenv import load_dotenv
+load_dotenv('../.env')
+
+from cog_search_vec_store import cv_helpers
+from cog_search_vec_store import async_http_helpers
+
+
+
+def read_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+
+class AsyncCV(cv_helpers.CV):
+
+    def __init__(self, api_key = os.getenv("azure_cv_key"),
+                       cog_serv_name  = os.getenv("azure_cv_endpoint"),
+                       api_version = "2023-02-01-preview",
+                       session = None,
+                       embedding_cache = None,
+                       text_vectorizer = None,
+                       image_vectorizer = None):
+
+
+        self.http_req = async_http_helpers.AsyncCVHttpRequest(api_key, cog_serv_name, api_version, session=session)
+        # injected vectorizers are plain callables, run in a worker thread
+        self.init_vectorizers(api_version, embedding_cache, text_vectorizer, image_vectorizer)
+
+
+    async def close(self):
+        await self.http_req.close()
+
+
+
+    async def analyze_image(self, img_url = None, filename = None, features = None):
+        params = self.get_analyze_params(features)
+
+        if filename is not None:
+            data = await asyncio.to_thread(read_file, filename)
+            response = await self.http_req.post(op='analyze_features', data=data, params=params)
+
+        else:
+            response = await self.http_req.post(op='analyze_features', headers=self.http_req.json_headers, body={'url': img_url}, params=params)
+
+        response = self.process_json(img_url, response)
+
+        return response
+
+
+    async def analyze_images(self, img_urls = None, filenames = None, features = None, max_workers = 8):
+        """
+        Async generator of the analyses of many images, in input order, with at most max_workers requests in flight
+        """
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def analyze(**kwargs):
+            async with semaphore:
+                return await self.analyze_image(features = features, **kwargs)
+
+        if filenames is not None:
+            tasks = [asyncio.create_task(analyze(filename = f)) for f in filenames]
+        else:
+            tasks = [asyncio.create_task(analyze(img_url = u)) for u in img_urls]
+
+        try:
+            for task in tasks:
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+    async def get_img_embedding(self, img_url = None, filename = None):
+        if self.image_vectorizer is not None:
+            return await asyncio.to_thread(self.image_vectorizer, img_url = img_url, filename = filename)
+
+        if self.embedding_cache is None or filename is None:
+            # embeddings of image URLs are not cached, see get_cache_key
+            return await self.vectorize_image(img_url, filename)
+
+        # the cache is backed by SQLite: its reads and writes run off the event loop
+        cache_key = await asyncio.to_thread(self.get_cache_key, img_url = img_url, filename = filename)
+        vector = await asyncio.to_thread(self.embedding_cache.get, cache_key)
+        if vector is None:
+            vector = await self.vectorize_image(img_url, filename)
+            if vector is not None:
+                await asyncio.to_thread(self.embedding_cache.put, cache_key, vector)
+
+        return vector
+
+
+    async def vectorize_image(self, img_url = None, filename = None):
+
+        if filename is not None:
+            data = await asyncio.to_thread(read_file, filename)
+            response = await self.http_req.post(op='img_embedding', data=data)
+        else:
+            response = await self.http_req.post(op='img_embedding', headers=self.http_req.json_headers, body={'url': img_url})
+
+        try:
+            return response['vector']
+        except:
+            return None
+
+
+
+    async def get_text_embedding(self, text):
+        if self.text_vectorizer is not None:
+            return await asyncio.to_thread(self.text_vectorizer, text)
+
+        if self.embedding_cache is None:
+            return await self.vectorize_text(text)
+
+        cache_key = self.get_cache_key(text = text)
+        vector = await asyncio.to_thread(self.embedding_cache.get, cache_key)
+        if vector is None:
+            vector = await self.vectorize_text(text)
+            if vector is not None:
+                await asyncio.to_thread(self.embedding_cache.put, cache_key, vector)
+
+        return vector
+
+
+    async def vectorize_text(self, text):
+        response = await self.http_req.post(op='text_embedding', headers=self.http_req.json_headers, body={'text': text})
+
+        try:
+            return response['vector']
+        except:
+            return None
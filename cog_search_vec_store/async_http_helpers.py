@@ -0,0 +1,133 @@
+import json
+import aiohttp
+
+from tenacity import (
+    retry,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from cog_search_vec_store import http_helpers
+from cog_search_vec_store.http_helpers import HTTPError
+
+
+
+class AsyncHTTPRequest:
+    """
+    asyncio counterpart of http_helpers.HTTPRequest, built on a shared aiohttp.ClientSession.
+
+    Mixed in front of the sync request classes, so URLs and headers come from them and only the
+    put/post/get/delete calls become coroutines. The session is created on first use inside the
+    running event loop; call close() (or use `async with`) when done.
+    """
+
+    def init_session(self, limit = 100, limit_per_host = 0, timeout = 60, session = None):
+        self.connector_limit = limit
+        self.connector_limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.session = session
+
+
+    def get_session(self):
+        if (self.session is None) or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connector_limit, limit_per_host=self.connector_limit_per_host)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+
+        return self.session
+
+
+    async def close(self):
+        if (self.session is not None) and (not self.session.closed):
+            await self.session.close()
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+    async def handle_response(self, response):
+        text = await response.text()
+
+        try:
+            response_data = json.loads(text)
+        except json.JSONDecodeError:
+            response_data = text
+
+        if response.status >= 400:
+            raise HTTPError(response.status, response_data)
+
+        return response_data
+
+
+    def get_headers(self, headers):
+        if headers is None:
+            return self.default_headers
+        else:
+            return {**self.default_headers, **headers}
+
+
+    @retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(4))
+    async def put(self, op = None, headers=None, body=None):
+
+        url = self.get_url(op)
+
+        if body is None:
+            body = {}
+
+        async with self.get_session().put(url, json=body, headers=self.get_headers(headers)) as response:
+            return await self.handle_response(response)
+
+
+    @retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(4))
+    async def post(self, op = None, headers=None, body=None, data=None, params=None):
+
+        url = self.get_url(op)
+        headers = self.get_headers(headers)
+
+        if data is not None:
+            request = self.get_session().post(url, data=data, headers=headers, params=params)
+        else:
+            request = self.get_session().post(url, json={} if body is None else body, headers=headers, params=params)
+
+        async with request as response:
+            return await self.handle_response(response)
+
+
+    @retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(2))
+    async def get(self, op = None, headers=None, params=None):
+
+        url = self.get_url(op)
+
+        async with self.get_session().get(url, headers=self.get_headers(headers), params=params or {}) as response:
+            return await self.handle_response(response)
+
+
+    @retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(4))
+    async def delete(self, op = None, id = None, headers=None):
+
+        url = self.get_url(op)
+
+        async with self.get_session().delete(url, headers=self.get_headers(headers)) as response:
+            return await self.handle_response(response)
+
+
+
+class AsyncCogSearchHttpRequest(AsyncHTTPRequest, http_helpers.CogSearchHttpRequest):
+
+    def __init__(self, api_key, search_service_name, index_name, api_version, session = None, limit = 100):
+        http_helpers.CogSearchHttpRequest.__init__(self, api_key, search_service_name, index_name, api_version)
+        self.init_session(limit=limit, session=session)
+
+
+
+class AsyncCVHttpRequest(AsyncHTTPRequest, http_helpers.CVHttpRequest):
+
+    def __init__(self, api_key, cog_serv_name, api_version,
+                 options = ['tags', 'objects', 'caption', 'read', 'smartCrops', 'denseCaptions', 'people'],
+                 session = None, limit = 100):
+        http_helpers.CVHttpRequest.__init__(self, api_key, cog_serv_name, api_version, options)
+        self.init_session(limit=limit, session=session)
@@ -0,0 +1,121 @@
+import re
+import math
+import numpy as np
+from collections import Counter
+
+from cog_search_vec_store import cs_json
+
+
+# Close to the standard Lucene analyzer used by default on searchable fields: word tokens, lowercased
+WORD_REGEX = re.compile(r"\w+", re.UNICODE)
+
+
+
+def analyze(text):
+    return [t.lower() for t in WORD_REGEX.findall(text or '')]
+
+
+
+def get_bm25_parameters(index_json = cs_json.create_index_json):
+    # the service defaults when the index leaves k1 and b unset
+    similarity = index_json.get('similarity') or {}
+    k1 = similarity.get('k1')
+    b = similarity.get('b')
+    return 1.2 if k1 is None else k1, 0.75 if b is None else b
+
+
+
+class BM25Index:
+    """
+    Inverted index over one text field, scored like Lucene's BM25Similarity:
+    idf(t) * tf / (tf + k1 * (1 - b + b * dl / avgdl)), with idf(t) = log(1 + (N - df + 0.5) / (df + 0.5)).
+
+    Rows are document positions in the store. As with Lucene segments, tombstoned rows still count
+    in the collection statistics and are only filtered out of the results.
+    """
+
+    def __init__(self, k1 = 1.2, b = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.arrays = {}
+        # document lengths of rows [0, n), in an array grown by doubling so that queries don't rebuild it
+        self.doc_lengths = np.zeros(1024, dtype=np.float32)
+        self.n = 0
+        self.total_length = 0
+
+
+    def __len__(self):
+        return self.n
+
+
+    def add(self, row, text):
+        if row != self.n:
+            raise Exception(f"BM25Index rows must be added in order, expected {self.n} got {row}")
+
+        terms = analyze(text)
+        if self.n == len(self.doc_lengths):
+            self.doc_lengths = np.concatenate([self.doc_lengths, np.zeros(len(self.doc_lengths), dtype=np.float32)])
+        self.doc_lengths[self.n] = len(terms)
+        self.n += 1
+        self.total_length += len(terms)
+
+        for term, tf in Counter(terms).items():
+            rows, tfs = self.postings.setdefault(term, ([], []))
+            rows.append(row)
+            tfs.append(tf)
+            self.arrays.pop(term, None)
+
+
+    def get_postings(self, term):
+        if term not in self.postings:
+            return None
+
+        # posting lists are turned into arrays once, and again only after new documents contain the term
+        arrays = self.arrays.get(term)
+        if arrays is None:
+            rows, tfs = self.postings[term]
+            arrays = self.arrays[term] = (np.array(rows, dtype=np.int64), np.array(tfs, dtype=np.float32))
+        return arrays
+
+
+    def scores(self, query):
+        """
+        BM25 score of every row for the query, as a dense array
+        """
+        n = self.n
+        scores = np.zeros(n, dtype=np.float32)
+        if n == 0:
+            return scores
+
+        doc_lengths = self.doc_lengths
+        avgdl = self.total_length / n if self.total_length else 1.0
+
+        for term, query_tf in Counter(analyze(query)).items():
+            postings = self.get_postings(term)
+            if postings is None:
+                continue
+            rows, tfs = postings
+            idf = math.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * doc_lengths[rows] / avgdl)
+            scores[rows] += query_tf * idf * tfs / (tfs + norm)
+
+        return scores
+
+
+    def search(self, query, top, allowed_rows = None):
+        """
+        Top (row, score) pairs matching at least one query term, restricted to the allowed rows if given
+        """
+        scores = self.scores(query)
+        if allowed_rows is not None:
+            # rows added after allowed_rows was computed are not allowed
+            scores = scores[:len(allowed_rows)]
+            scores[~allowed_rows[:len(scores)]] = 0
+
+        matches = np.nonzero(scores > 0)[0]
+        if len(matches) > top:
+            matches = matches[np.argpartition(-scores[matches], top - 1)[:top]]
+        matches = matches[np.argsort(-scores[matches], kind='stable')]
+
+        return [(int(r), float(scores[r])) for r in matches]
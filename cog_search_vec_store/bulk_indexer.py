@@ -0,0 +1,216 @@
+import json
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from cog_search_vec_store.cs_builders import index_batch_json
+
+
+# Cognitive Search accepts at most 1000 documents and 16 MB per index request
+MAX_BATCH_DOCS = 1000
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+
+# per-document status codes worth retrying in a 207 (multi-status) response
+RETRIABLE_STATUS_CODES = (409, 422, 429, 500, 503)
+
+
+
+class BulkIndexer:
+    """
+    Streaming indexer for Cognitive Search.
+
+    Documents are pulled lazily from any iterable, serialized once, grouped into batches capped by
+    document count and by payload size, and posted by a bounded pool of worker threads. Only the
+    documents reported as failed with a retriable status in a 207 response are sent again.
+    """
+
+    def __init__(self, http_req, batch_size = MAX_BATCH_DOCS, max_batch_bytes = int(MAX_BATCH_BYTES * 0.9),
+                       max_workers = 4, max_retries = 3, key_field = 'id'):
+
+        self.http_req = http_req
+        self.batch_size = min(batch_size, MAX_BATCH_DOCS)
+        self.max_batch_bytes = max_batch_bytes
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.key_field = key_field
+        self.headers = {'Content-Type': 'application/json'}
+
+
+    def batches(self, documents, serialize):
+        """
+        Yield lists of (key, json bytes) pairs respecting the count and size limits
+        """
+        batch, batch_bytes = [], 0
+
+        for doc in documents:
+            doc = serialize(doc)
+
+            if isinstance(doc, dict):
+                key, data = doc[self.key_field], json.dumps(doc).encode('utf-8')
+            else:
+                key, data = doc.id, doc.to_json()
+
+            if batch and ((len(batch) >= self.batch_size) or (batch_bytes + len(data) + 1 > self.max_batch_bytes)):
+                yield batch
+                batch, batch_bytes = [], 0
+
+            batch.append((key, data))
+            batch_bytes += len(data) + 1
+
+        if batch:
+            yield batch
+
+
+    def send_batch(self, batch):
+        """
+        Post one batch, resending the documents that failed with a retriable status.
+        Returns (number of documents indexed, list of (key, error message) of failed documents)
+        """
+        pending = dict(batch)
+        errors = {}
+
+        for attempt in range(self.max_retries + 1):
+            body = index_batch_json(pending.values())
+            response = self.http_req.post(op='index', headers=self.headers, data=body)
+
+            retry = self.get_retries(response, pending, errors)
+            if not retry:
+                break
+
+            logging.info(f"Retrying {len(retry)} of {len(pending)} documents")
+            pending = retry
+            time.sleep(min(30, 2 ** attempt))
+
+        return len(batch) - len(errors), list(errors.items())
+
+
+    def get_retries(self, response, pending, errors):
+        """
+        Record the per-document results of an index response in errors, and return the pending
+        documents that failed with a retriable status
+        """
+        retry = {}
+        for result in response.get('value', []):
+            key = result['key']
+            if result.get('status', False):
+                errors.pop(key, None)
+                continue
+            errors[key] = result.get('errorMessage', '')
+            if result.get('statusCode') in RETRIABLE_STATUS_CODES:
+                retry[key] = pending[key]
+
+        return retry
+
+
+    def collect(self, report, keys, outcome):
+        """
+        Add the outcome of a batch, (indexed, failed) or the exception it raised, to the report
+        """
+        if isinstance(outcome, Exception):
+            # a failed request only fails its own batch, the other batches are still reported
+            logging.warning(f"Batch of {len(keys)} documents failed: {outcome}")
+            outcome = 0, [(key, str(outcome)) for key in keys]
+
+        indexed, failed = outcome
+        report['indexed'] += indexed
+        report['failed'].extend(failed)
+
+
+    def add_batch(self, report, batch):
+        report['documents'] += len(batch)
+        report['batches'] += 1
+        report['bytes'] += sum(len(data) for _, data in batch)
+
+
+    def finish_report(self, report, start):
+        report['seconds'] = time.time() - start
+        report['docs_per_second'] = report['indexed'] / report['seconds'] if report['seconds'] > 0 else 0.0
+        report['mb_per_second'] = report['bytes'] / 1024 ** 2 / report['seconds'] if report['seconds'] > 0 else 0.0
+
+        return report
+
+
+    def run(self, documents, serialize = lambda doc: doc):
+        """
+        Index all the documents. serialize turns a source document into the JSON dict or the
+        cs_builders.IndexAction to send.
+        Returns a report with counts, failed documents and throughput.
+        """
+        report = {'documents': 0, 'indexed': 0, 'failed': [], 'batches': 0, 'bytes': 0}
+        start = time.time()
+        in_flight = set()
+        batch_keys = {}
+
+        def collect(done):
+            for future in done:
+                keys = batch_keys.pop(future)
+                self.collect(report, keys, future.exception() or future.result())
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+
+            for batch in self.batches(documents, serialize):
+                self.add_batch(report, batch)
+
+                # bounded parallelism: never hold more than max_workers batches in memory
+                if len(in_flight) >= self.max_workers:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+
+                future = executor.submit(self.send_batch, batch)
+                batch_keys[future] = [key for key, _ in batch]
+                in_flight.add(future)
+
+            collect(wait(in_flight).done)
+
+        return self.finish_report(report, start)
+
+
+
+class AsyncBulkIndexer(BulkIndexer):
+    """
+    asyncio version of BulkIndexer, for an AsyncCogSearchHttpRequest: same batching, same per-document
+    retries of 207 responses, with at most max_workers batches in flight.
+    """
+
+    async def send_batch(self, batch):
+        pending = dict(batch)
+        errors = {}
+
+        for attempt in range(self.max_retries + 1):
+            body = index_batch_json(pending.values())
+            response = await self.http_req.post(op='index', headers=self.headers, data=body)
+
+            retry = self.get_retries(response, pending, errors)
+            if not retry:
+                break
+
+            logging.info(f"Retrying {len(retry)} of {len(pending)} documents")
+            pending = retry
+            await asyncio.sleep(min(30, 2 ** attempt))
+
+        return len(batch) - len(errors), list(errors.items())
+
+
+    async def run(self, documents, serialize = lambda doc: doc):
+        report = {'documents': 0, 'indexed': 0, 'failed': [], 'batches': 0, 'bytes': 0}
+        start = time.time()
+        in_flight = {}
+
+        async def collect(return_when):
+            done, _ = await asyncio.wait(in_flight, return_when=return_when)
+            for task in done:
+                self.collect(report, in_flight.pop(task), task.exception() or task.result())
+
+        for batch in self.batches(documents, serialize):
+            self.add_batch(report, batch)
+
+            if len(in_flight) >= self.max_workers:
+                await collect(asyncio.FIRST_COMPLETED)
+
+            in_flight[asyncio.ensure_future(self.send_batch(batch))] = [key for key, _ in batch]
+
+        if in_flight:
+            await collect(asyncio.ALL_COMPLETED)
+
+        return self.finish_report(report, start)
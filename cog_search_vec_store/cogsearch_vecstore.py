@@ -1,16 +1,24 @@
-import uuid
 import os
 import logging
 import json
 import copy
-import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from cog_search_vec_store import http_helpers
 from cog_search_vec_store import cs_json
 from cog_search_vec_store import cv_helpers
-
+from cog_search_vec_store import bulk_indexer
+from cog_search_vec_store import cs_builders
+from cog_search_vec_store import query_cache
+from cog_search_vec_store import query_preprocessor
+from cog_search_vec_store.query_preprocessor import IMAGE_URL_PATTERN
+from cog_search_vec_store.fusion import reciprocal_rank_fusion
+
+from embedding_cache import get_embedding_cache
 from utils import get_embedding, get_cosine_similarity, get_text_embedding
-from utils import get_openai_embedding, analyze_image, save_obj_to_pkl
+from utils import get_openai_embedding, get_openai_embeddings, save_obj_to_pkl
 
 
 NUM_TOP_MATCHES = 5
@@ -21,14 +29,84 @@ class CogSearchVecStore:
     def __init__(self, api_key, 
                        search_service_name, 
                        index_name = "img-vec-index", 
-                       api_version = "2023-07-01-Preview"):
+                       api_version = "2023-07-01-Preview",
+                       session_pool = None,
+                       cache_results = False,
+                       cache_ttl = 300,
+                       cache_size = 1024,
+                       cv = None,
+                       text_vectorizer = get_openai_embedding,
+                       text_batch_vectorizer = None):
 
 
-        self.http_req = http_helpers.CogSearchHttpRequest(api_key, search_service_name, index_name, api_version)
+        self.http_req = http_helpers.CogSearchHttpRequest(api_key, search_service_name, index_name, api_version, session_pool)
         self.index_name = index_name
         self.all_fields = ['id', 'text', 'text_en', 'categoryId', 'file', 'class']
         self.search_types = ['vector', 'hybrid', 'semantic_hybrid']
-
+        self.doc_builder = cs_builders.DocumentBuilder(self.all_fields)
+        self.result_cache = query_cache.TTLCache(cache_size, cache_ttl) if cache_results else None
+        self.init_cv(cv, session_pool)
+        self.init_text_vectorizers(text_vectorizer, text_batch_vectorizer)
+
+
+
+    def init_cv(self, cv, session_pool):
+        self._cv = cv
+        self._preprocessor = None
+        self.cv_session_pool = session_pool
+        self.cv_lock = threading.Lock()
+
+
+    def init_text_vectorizers(self, text_vectorizer, text_batch_vectorizer):
+        """
+        text_vectorizer(text) embeds the queries searched on aoi_text_vector, text_batch_vectorizer(texts, batch_size=...)
+        the queries of search_many. Without a batch vectorizer, a custom text_vectorizer is called once per text.
+        """
+        self.text_vectorizer = text_vectorizer
+        if text_batch_vectorizer is None:
+            if text_vectorizer is get_openai_embedding:
+                text_batch_vectorizer = get_openai_embeddings
+            else:
+                text_batch_vectorizer = lambda texts, batch_size = None: [text_vectorizer(t) for t in texts]
+        self.text_batch_vectorizer = text_batch_vectorizer
+
+
+    @property
+    def cv(self):
+        """
+        CV client shared by all the searches of the store, created on first use
+        (pass cv= to the constructor to inject one, e.g. with stub vectorizers)
+        """
+        if self._cv is None:
+            with self.cv_lock:
+                if self._cv is None:
+                    self._cv = cv_helpers.CV(session_pool = self.cv_session_pool, embedding_cache = get_embedding_cache())
+        return self._cv
+
+
+    @property
+    def preprocessor(self):
+        """
+        Query pre-processor of the store, which memoizes the analyses of the images found in queries
+        """
+        if self._preprocessor is None:
+            cv = self.cv
+            with self.cv_lock:
+                if self._preprocessor is None:
+                    self._preprocessor = query_preprocessor.QueryPreprocessor(cv)
+        return self._preprocessor
+
+
+    def preprocess_query(self, query):
+        """
+        Query text followed by the analyses of its images, image URLs, and analysis
+        ('' without image, the analysis of the image, or the list of analyses when there are several images)
+        """
+        text_query, urls, analyses = self.preprocessor.process(query)
+        if not urls:
+            return query, urls, ''
+
+        return query_preprocessor.add_analyses(text_query, analyses), urls, analyses[0] if len(analyses) == 1 else analyses
 
 
     def create_index(self):
@@ -39,79 +117,111 @@ class CogSearchVecStore:
         self.http_req.put(body = index_dict)
 
 
+    def connection_stats(self):
+        return self.http_req.session_pool.stats()
+
+
+    def cache_stats(self):
+        return self.result_cache.stats() if self.result_cache is not None else None
+
+
+    def get_cache_key(self, *args):
+        if self.result_cache is None:
+            return None
+        return (query_cache.normalize_query(args[0]),) + args[1:]
+
+
+    def get_cached_results(self, cache_key):
+        if cache_key is None:
+            return None
+        results = self.result_cache.get(cache_key)
+        # hand out copies so callers can't alter the cached lists
+        return None if results is None else tuple(copy.copy(r) for r in results)
+
+
+    def store_cached_results(self, cache_key, results):
+        if cache_key is not None:
+            self.result_cache.put(cache_key, tuple(copy.copy(r) for r in results))
+        return results
+
+
+    def invalidate_cache(self):
+        if self.result_cache is not None:
+            self.result_cache.clear()
+
+
     def get_index(self):
         return self.http_req.get()
 
 
     def delete_index(self):
+        self.invalidate_cache()
         return self.http_req.delete()
 
 
-    def upload_documents(self, documents):
+    def upload_documents(self, documents, batch_size = bulk_indexer.MAX_BATCH_DOCS, max_workers = 4, verbose = False):
+        """
+        Index documents from any iterable or generator, in batches sent concurrently.
+        Returns a report with the number of indexed documents, the failed ones and the throughput.
+        """
+        indexer = bulk_indexer.BulkIndexer(self.http_req, batch_size=batch_size, max_workers=max_workers)
+        report = indexer.run(documents, serialize=self.get_upload_doc)
+        self.invalidate_cache()
 
-        docs_dict = copy.deepcopy(cs_json.upload_docs_json)
+        if verbose: print(f"Indexed {report['indexed']}/{report['documents']} documents in {report['seconds']:.1f}s ({report['docs_per_second']:.0f} docs/s)")
 
-        for doc in documents:
-            doc_dict = copy.deepcopy(cs_json.upload_doc_json)
-                        
-            for k in self.all_fields:
-                doc_dict[k] = doc.get(k, '')
+        return report
 
-            doc_dict['id'] = doc['id'] if doc.get('id', None) else str(uuid.uuid4())
-            doc_dict["aoi_text_vector"] = doc.get("aoi_text_vector", [])
-            doc_dict['cv_image_vector'] = doc.get('cv_image_vector', [])
-            doc_dict['cv_text_vector'] = doc.get('cv_text_vector', [])
-            doc_dict["@search.action"] = "upload"
-            docs_dict['value'].append(doc_dict)
-        
-        self.http_req.post(op ='index', body = docs_dict)
 
-        return docs_dict
+    def get_upload_json(self, documents):
+        return {'value': [self.get_upload_doc(doc).to_dict() for doc in documents]}
+
+
+    def get_upload_doc(self, doc):
+        return self.doc_builder.upload(doc)
+
 
 
+    def delete_documents(self, op='index', ids = [], batch_size = bulk_indexer.MAX_BATCH_DOCS, max_workers = 4):
+        indexer = bulk_indexer.BulkIndexer(self.http_req, batch_size=batch_size, max_workers=max_workers)
+        report = indexer.run(ids, serialize=self.doc_builder.delete)
+        self.invalidate_cache()
 
-    def delete_documents(self, op='index', ids = []):
-        docs_dict = copy.deepcopy(cs_json.upload_docs_json)
+        return report
 
-        for i in ids:
-            doc_dict = copy.deepcopy(cs_json.upload_doc_json)
-            doc_dict['id'] = i
-            doc_dict["aoi_text_vector"] = [0] * 1536 ## text-embedding-ada-002 dimensions
-            doc_dict["@search.action"] = "delete"
-            docs_dict['value'].append(doc_dict)
 
-        self.http_req.post(op ='index', body = docs_dict)
+    def get_delete_json(self, ids):
+        return {'value': [self.doc_builder.delete(i).to_dict() for i in ids]}
 
 
 
     def get_search_json(self, query, search_type = 'vector'):
-        if search_type == 'vector':
-            query_dict = copy.deepcopy(cs_json.search_dict_vector)
-        elif search_type == 'hybrid':
-            query_dict = copy.deepcopy(cs_json.search_dict_hybrid)
-            query_dict['search'] = query
-        elif search_type == 'semantic_hybrid':
-            query_dict = copy.deepcopy(cs_json.search_dict_semantic_hybrid)
-            query_dict['search'] = query
-        return query_dict
+        if search_type not in self.search_types:
+            raise Exception(f"search_type must be one of {self.search_types}")
+
+        return cs_builders.SearchQuery(search_type, search = query, k = NUM_TOP_MATCHES, top = NUM_TOP_MATCHES)
 
             
-    def get_vector_fields(self, query, query_dict, vector_name = None):
+    def get_query_embedding(self, query, vector_name = None):
         if (vector_name is None) or (vector_name == "aoi_text_vector"):
-            query_dict['vector']['fields'] = "aoi_text_vector"
-            query_dict['vector']['value'] = get_openai_embedding(query, 'text-embedding-ada-002')    
+            return "aoi_text_vector", self.text_vectorizer(query)
         elif vector_name == 'cv_text_vector':
-            cvr = cv_helpers.CV()
-            query_dict['vector']['fields'] = vector_name
-            query_dict['vector']['value'] = cvr.get_text_embedding(query)
+            return vector_name, self.cv.get_text_embedding(query)
         elif vector_name == 'cv_image_vector':
-            cvr = cv_helpers.CV()
-            query_dict['vector']['fields'] = vector_name
-            query_dict['vector']['value'] = cvr.get_img_embedding(query)
+            return vector_name, self.cv.get_img_embedding(query)
         else:
             raise Exception(f'Invalid Vector Name {vector_name}')
-        
-        return query_dict
+
+
+    def get_vector_fields(self, query, search_query, vector_name = None):
+        search_query.vector_fields, search_query.vector_value = self.get_query_embedding(query, vector_name)
+
+        return search_query
+
+
+    def find_image_url(self, query):
+        match = IMAGE_URL_PATTERN.search(query)
+        return match.group(1) if match else None
 
 
 
@@ -121,32 +231,177 @@ class CogSearchVecStore:
         if search_type not in self.search_types:
             raise Exception(f"search_type must be one of {self.search_types}")
 
-        regex = r"(https?:\/\/[^\/\s]+(?:\/[^\/\s]+)*\/[^?\/\s]+(?:\.jpg|\.jpeg|\.png)(?:\?[^\s'\"]+)?)"
-        match = re.search(regex, query)
+        cache_key = self.get_cache_key(query, 'search', search_type, vector_name, filter, select)
+        cached = self.get_cached_results(cache_key)
+        if cached is not None:
+            return cached
+
+        query, inp_urls, analysis = self.preprocess_query(query)
+
+        search_query = self.get_search_json(query, search_type)
+        search_query = self.get_vector_fields(query, search_query, vector_name)
+        context, links, scores = self.execute_search(search_query, select, filter, verbose)
+
+        if inp_urls:
+            return self.store_cached_results(cache_key, (['Analysis of the image in the question: ' + query + '\n\n'] + context, links, scores, analysis))
+        else:
+            return self.store_cached_results(cache_key, (context, links, scores, analysis))
+
+
+    def run_search_query(self, search_query, select=None, filter=None):
+        search_query.filter = filter
+        search_query.select = ', '.join(self.all_fields) if select is None else select
 
-        if match:
-            inp_url = match.group(1)
-            cvr = cv_helpers.CV()
-            analysis = cvr.analyze_image(img_url=inp_url)
-            query = query.replace(inp_url, '') + '\n' + analysis['text']
+        return self.http_req.post(op ='search', data = search_query.to_json())['value']
 
-        query_dict = self.get_search_json(query, search_type)
-        query_dict = self.get_vector_fields(query, query_dict, vector_name)
-        query_dict['vector']['k'] = f"{NUM_TOP_MATCHES}"
-        query_dict['filter'] = filter
-        query_dict['select'] = ', '.join(self.all_fields) if select is None else select
 
-        results = self.http_req.post(op ='search', body = query_dict)
-        results = results['value'][:NUM_TOP_MATCHES]
+    def execute_search(self, search_query, select=None, filter=None, verbose=False):
+        results = self.run_search_query(search_query, select, filter)[:NUM_TOP_MATCHES]
         if verbose: [print(r['@search.score']) for r in results]
         if verbose: print(results)
 
+        return self.process_search_results(results)
+
+
+
+    def search_many(self, queries, search_type = 'vector', vector_name = None, select=None, filter=None,
+                    max_workers = 8, embedding_batch_size = 16, verbose=False):
+        """
+        Run many searches in one call: image analyses run concurrently, the queries are embedded in batches
+        (aoi_text_vector) or concurrently (cv vectors), then the search requests are sent concurrently.
+        Returns the list of search() results in input order, and a list of per-query timings in seconds.
+        """
+        if search_type not in self.search_types:
+            raise Exception(f"search_type must be one of {self.search_types}")
+
+        n = len(queries)
+        results = [None] * n
+        timings = [{'analysis': 0.0, 'embedding': 0.0, 'search': 0.0, 'total': 0.0, 'cached': False} for _ in range(n)]
+        cache_keys = [self.get_cache_key(q, 'search', search_type, vector_name, filter, select) for q in queries]
+
+        for i in range(n):
+            results[i] = self.get_cached_results(cache_keys[i])
+            timings[i]['cached'] = results[i] is not None
+
+        todo = [i for i in range(n) if results[i] is None]
+        texts, analyses, urls = {}, {}, {}
+
+        def analyze(i):
+            start = time.perf_counter()
+            texts[i], urls[i], analyses[i] = self.preprocess_query(queries[i])
+            timings[i]['analysis'] = time.perf_counter() - start
+
+        def embed(i):
+            start = time.perf_counter()
+            search_query = self.get_vector_fields(texts[i], self.get_search_json(texts[i], search_type), vector_name)
+            timings[i]['embedding'] = time.perf_counter() - start
+            return search_query
+
+        def run_search(i, search_query):
+            start = time.perf_counter()
+            context, links, scores = self.execute_search(search_query, select, filter, verbose)
+            timings[i]['search'] = time.perf_counter() - start
+
+            if urls[i]:
+                context = ['Analysis of the image in the question: ' + texts[i] + '\n\n'] + context
+            results[i] = self.store_cached_results(cache_keys[i], (context, links, scores, analyses[i]))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(analyze, todo))
+
+            if (vector_name is None) or (vector_name == "aoi_text_vector"):
+                # the embeddings endpoint accepts a list of inputs: one request per batch of queries
+                start = time.perf_counter()
+                vectors = self.text_batch_vectorizer([texts[i] for i in todo], batch_size = embedding_batch_size)
+                elapsed = (time.perf_counter() - start) / max(1, len(todo))
+
+                search_queries = []
+                for i, vector in zip(todo, vectors):
+                    search_query = self.get_search_json(texts[i], search_type)
+                    search_query.vector_fields, search_query.vector_value = "aoi_text_vector", vector
+                    search_queries.append(search_query)
+                    timings[i]['embedding'] = elapsed
+            else:
+                search_queries = list(executor.map(embed, todo))
+
+            list(executor.map(run_search, todo, search_queries))
+
+        for t in timings:
+            t['total'] = t['analysis'] + t['embedding'] + t['search']
+
+        return results, timings
+
+
+
+    def get_multi_vector_embeddings(self, text_query, url, vector_names, executor):
+        """
+        Embeddings of the query for each vector field, computed concurrently. cv_image_vector is queried with
+        the image of the url if there is one, otherwise with the CV text embedding, which lives in the same space.
+        """
+        def embed(vector_name):
+            if vector_name == 'cv_image_vector' and not url:
+                return vector_name, self.get_query_embedding(text_query, 'cv_text_vector')[1]
+            return self.get_query_embedding(url if vector_name == 'cv_image_vector' else text_query, vector_name)
+
+        return list(executor.map(embed, vector_names))
+
+
+    def search_multi_vector(self, query, vector_names = cs_builders.VECTOR_FIELDS, weights = None, search_type = 'vector',
+                            select=None, filter=None, verbose=False):
+        """
+        Search several vector fields at once. The embeddings (and the analysis of an image in the query) are
+        computed in parallel. Without weights, one request carries all the vectors and the service fuses them
+        with RRF; with weights, one search per field runs concurrently and the rankings are fused here with
+        weighted RRF.
+        """
+        analysis = ''
+
+        if search_type not in self.search_types:
+            raise Exception(f"search_type must be one of {self.search_types}")
+        if weights is not None and len(weights) != len(vector_names):
+            raise Exception(f"weights must have one entry per vector name {vector_names}")
+
+        cache_key = self.get_cache_key(query, 'multi_vector', tuple(vector_names), None if weights is None else tuple(weights), search_type, filter, select)
+        cached = self.get_cached_results(cache_key)
+        if cached is not None:
+            return cached
+
+        inp_url = self.find_image_url(query)
+        text_query = query_preprocessor.remove_urls(query, query_preprocessor.find_image_urls(query))
+
+        with ThreadPoolExecutor(max_workers=len(vector_names) + 1) as executor:
+            if inp_url:
+                analysis_future = executor.submit(self.preprocess_query, query)
+            vectors = self.get_multi_vector_embeddings(text_query, inp_url, vector_names, executor)
+
+            if inp_url:
+                query, _, analysis = analysis_future.result()
+
+            if weights is None:
+                search_query = self.get_search_json(query, search_type)
+                search_query.vectors = vectors
+                results = self.run_search_query(search_query, select, filter)
+            else:
+                def run_one(vector):
+                    search_query = self.get_search_json(query, search_type)
+                    search_query.vector_fields, search_query.vector_value = vector
+                    return self.run_search_query(search_query, select, filter)
+
+                rankings = list(executor.map(run_one, vectors))
+                key = lambda r: r.get('id', r.get('file'))
+                docs = {key(r): r for ranking in rankings for r in ranking}
+                fused = reciprocal_rank_fusion([[(key(r), r['@search.score']) for r in ranking] for ranking in rankings], weights=weights)
+                results = [{**docs[id], '@search.score': score} for id, score in fused]
+
+        results = results[:NUM_TOP_MATCHES]
+        if verbose: [print(r['@search.score']) for r in results]
+
         context, links, scores = self.process_search_results(results)
 
-        if match:
-            return ['Analysis of the image in the question: ' + query + '\n\n'] + context, links, scores, analysis
+        if inp_url:
+            return self.store_cached_results(cache_key, (['Analysis of the image in the question: ' + query + '\n\n'] + context, links, scores, analysis))
         else:
-            return context, links, scores, analysis
+            return self.store_cached_results(cache_key, (context, links, scores, analysis))
 
 
 
@@ -159,27 +414,22 @@ class CogSearchVecStore:
         if search_type not in self.search_types:
             raise Exception(f"search_type must be one of {self.search_types}")
 
-        regex = r"(https?:\/\/[^\/\s]+(?:\/[^\/\s]+)*\/[^?\/\s]+(?:\.jpg|\.jpeg|\.png)(?:\?[^\s'\"]+)?)"
-        match = re.search(regex, query)
+        cache_key = self.get_cache_key(query, 'similar_images', analyze, filter, select)
+        cached = self.get_cached_results(cache_key)
+        if cached is not None:
+            return cached
 
-        if match:
-            url = match.group(1)
-            query_dict = self.get_search_json(url, search_type)
-            query_dict = self.get_vector_fields(url, query_dict, vector_name)
-            if analyze: 
-                cvr = cv_helpers.CV()
-                analysis = cvr.analyze_image(img_url=url)
-            query_dict['vector']['k'] = NUM_TOP_MATCHES
-            query_dict['filter'] = filter
-            query_dict['select'] = ', '.join(self.all_fields) if select is None else select
+        url = self.find_image_url(query)
 
-            results = self.http_req.post(op ='search', body = query_dict)
-            results = results['value'][:NUM_TOP_MATCHES]
-            if verbose: [print(r['@search.score']) for r in results]
+        if url:
+            search_query = self.get_search_json(url, search_type)
+            search_query = self.get_vector_fields(url, search_query, vector_name)
+            if analyze: 
+                analysis = self.preprocessor.analyze(url)
 
-            context, links, scores = self.process_search_results(results)
+            context, links, scores = self.execute_search(search_query, select, filter, verbose)
 
-            return context, links, scores, analysis
+            return self.store_cached_results(cache_key, (context, links, scores, analysis))
         
         else:
             return ["Sorry, no similar images have been found"], [], [], analysis
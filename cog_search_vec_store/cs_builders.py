@@ -0,0 +1,114 @@
+import json
+import uuid
+
+from cog_search_vec_store import cs_json
+
+
+json_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+
+VECTOR_FIELDS = ('aoi_text_vector', 'cv_image_vector', 'cv_text_vector')
+SEMANTIC_OPTIONS = {k: cs_json.search_dict_semantic_hybrid[k]
+                    for k in ('queryType', 'semanticConfiguration', 'queryLanguage', 'captions', 'answers')}
+
+
+
+def to_list(vector):
+    return vector.tolist() if hasattr(vector, 'tolist') else vector
+
+
+
+class IndexAction:
+    """
+    One entry of an index request ('upload', 'merge', 'delete'...), serialized straight to JSON bytes
+    """
+    __slots__ = ('action', 'id', 'fields')
+
+    def __init__(self, action, id, fields = None):
+        self.action = action
+        self.id = id
+        self.fields = fields
+
+
+    def to_dict(self):
+        d = {'@search.action': self.action, 'id': self.id}
+        if self.fields:
+            d.update(self.fields)
+        return d
+
+
+    def to_json(self):
+        return json_encoder.encode(self.to_dict()).encode('utf-8')
+
+
+
+def index_batch_json(actions_json):
+    """
+    Body of an index request from already serialized actions
+    """
+    return b'{"value":[' + b','.join(actions_json) + b']}'
+
+
+
+class DocumentBuilder:
+    """
+    Builds index actions for the fields of the index, without copying JSON templates
+    """
+
+    def __init__(self, all_fields):
+        self.all_fields = [f for f in all_fields if f != 'id']
+
+
+    def upload(self, doc):
+        fields = {k: doc.get(k, '') for k in self.all_fields}
+        for k in VECTOR_FIELDS:
+            fields[k] = to_list(doc.get(k, []))
+
+        return IndexAction('upload', doc['id'] if doc.get('id', None) else str(uuid.uuid4()), fields)
+
+
+    def delete(self, id):
+        # a delete action only needs the document key
+        return IndexAction('delete', id)
+
+
+
+class SearchQuery:
+    """
+    Body of a vector, hybrid or semantic hybrid search request.
+    When `vectors` holds several (field, value) pairs, they are all sent in one request and fused by the service.
+    """
+    __slots__ = ('search_type', 'search', 'vector_value', 'vector_fields', 'k', 'select', 'filter', 'top', 'vectors')
+
+    def __init__(self, search_type = 'vector', search = '', vector_value = None, vector_fields = 'aoi_text_vector',
+                       k = 5, select = '*', filter = None, top = 5, vectors = None):
+        self.search_type = search_type
+        self.search = search
+        self.vector_value = vector_value if vector_value is not None else []
+        self.vector_fields = vector_fields
+        self.k = k
+        self.select = select
+        self.filter = filter
+        self.top = top
+        self.vectors = vectors
+
+
+    def to_dict(self):
+        d = {'select': self.select, 'filter': self.filter}
+
+        if self.vectors:
+            d['vectors'] = [{'value': to_list(value), 'fields': field, 'k': self.k} for field, value in self.vectors]
+        else:
+            d['vector'] = {'value': to_list(self.vector_value), 'fields': self.vector_fields, 'k': self.k}
+
+        if self.search_type != 'vector':
+            d['search'] = self.search
+            d['top'] = self.top
+
+        if self.search_type == 'semantic_hybrid':
+            d.update(SEMANTIC_OPTIONS)
+
+        return d
+
+
+    def to_json(self):
+        return json_encoder.encode(self.to_dict()).encode('utf-8')
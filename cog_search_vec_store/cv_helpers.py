@@ -6,53 +6,142 @@ import uuid
 import logging
 import json
 import copy
+from concurrent.futures import ThreadPoolExecutor
 from cog_search_vec_store import http_helpers
 
+from embedding_cache import EmbeddingCache
+
+
+# Features needed for the text summary of process_json(), a subset of what the service can return
+TEXT_FEATURES = ['caption', 'read', 'denseCaptions', 'tags']
+
 
 
 
 class CV:
+    """
+    Computer Vision client, safe to share between threads.
+
+    embedding_cache (an EmbeddingCache) caches text embeddings and the embeddings of local image files,
+    keyed by the text or the file bytes. Images given by URL are not cached: the image behind a URL can
+    change. text_vectorizer(text) and image_vectorizer(img_url, filename)
+    replace the service calls for the embeddings, e.g. with a local model or a stub in load tests.
+    """
 
     def __init__(self, api_key = os.getenv("azure_cv_key"), 
                        cog_serv_name  = os.getenv("azure_cv_endpoint"), 
-                       api_version = "2023-02-01-preview"):
+                       api_version = "2023-02-01-preview",
+                       session_pool = None,
+                       embedding_cache = None,
+                       text_vectorizer = None,
+                       image_vectorizer = None):
+
+
+        self.http_req = http_helpers.CVHttpRequest(api_key, cog_serv_name, api_version, session_pool=session_pool)
+        self.init_vectorizers(api_version, embedding_cache, text_vectorizer, image_vectorizer)
 
 
-        self.http_req = http_helpers.CVHttpRequest(api_key, cog_serv_name, api_version)
+    def init_vectorizers(self, api_version, embedding_cache, text_vectorizer, image_vectorizer):
+        self.api_version = api_version
+        self.embedding_cache = embedding_cache
+        self.text_vectorizer = text_vectorizer
+        self.image_vectorizer = image_vectorizer
+
+
+    def get_cache_key(self, text = None, img_url = None, filename = None):
+        """
+        Embedding cache key, with the same model names as the utils embedding helpers.
+        None for an image URL: the image behind a URL can change, and the cache never expires entries.
+        """
+        if text is not None:
+            return EmbeddingCache.make_key(text, "cv-text-latest", self.api_version)
+        if filename is not None:
+            with open(filename, 'rb') as f:
+                return EmbeddingCache.make_key(f.read(), "cv-image-latest", self.api_version)
+        return None
 
 
 
     def process_json(self, img_url, response):
         res = {}
+        text = [f"[{img_url}] This is an image."]
+
+        # only the features that were requested are in the response
+        if 'captionResult' in response:
+            res['main_caption'] = response['captionResult']['text']
+            text.append(f" Main Caption: {res['main_caption']}")
+        if 'readResult' in response:
+            res['ocr'] = response['readResult']['content']
+            text.append(f"\nOCR: {res['ocr']}")
+        if 'denseCaptionsResult' in response:
+            res['captions'] = [caption['text'] for caption in response['denseCaptionsResult']['values']]
+            text.append(f"\nDense Captions: {', '.join(res['captions'])}")
+        if 'tagsResult' in response:
+            res['tags'] = [tag['name'] for tag in response['tagsResult']['values']]
+            text.append(f"\nTags: {', '.join(res['tags'])}")
+
+        res['text'] = ''.join(text)
 
-        res['main_caption'] = response['captionResult']['text']
-        res['tags'] = [tag['name'] for tag in response['tagsResult']['values']]
-        res['ocr'] = response['readResult']['content']
-        res['captions'] = [caption['text'] for caption in response['denseCaptionsResult']['values']]
+        return res
 
-        res['text'] = f"[{img_url}] This is an image. Main Caption: {res['main_caption']}\nOCR: {res['ocr']}\nDense Captions: {', '.join(res['captions'])}\nTags: {', '.join(res['tags'])}"
 
-        return res
+    def get_analyze_params(self, features = None):
+        if features is None:
+            return {'features': self.http_req.options}
+        return {'features': ','.join(features) if isinstance(features, (list, tuple)) else features}
 
 
 
-    def analyze_image(self, img_url = None, filename = None):
+    def analyze_image(self, img_url = None, filename = None, features = None):
+        """
+        Analyze an image, requesting only the given features (all of them by default).
+        TEXT_FEATURES is enough for the 'text' summary.
+        """
+        params = self.get_analyze_params(features)
 
         if filename is not None: 
         
             with open(filename, 'rb') as f:
                 data = f.read()
-            response = self.http_req.post(op='analyze', data=data)
+            response = self.http_req.post(op='analyze_features', data=data, params=params)
 
         else:
-            response = self.http_req.post(op='analyze', headers=self.http_req.json_headers, body={'url': img_url})
+            response = self.http_req.post(op='analyze_features', headers=self.http_req.json_headers, body={'url': img_url}, params=params)
             
         response = self.process_json(img_url, response)
 
         return response
 
 
+    def analyze_images(self, img_urls = None, filenames = None, features = None, max_workers = 8):
+        """
+        Analyze many images concurrently. Returns a generator of the parsed results, in input order,
+        each yielded as soon as it (and the ones before it) is ready.
+        """
+        if filenames is not None:
+            analyze = lambda filename: self.analyze_image(filename = filename, features = features)
+            items = filenames
+        else:
+            analyze = lambda img_url: self.analyze_image(img_url = img_url, features = features)
+            items = img_urls
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            yield from executor.map(analyze, items)
+
+
     def get_img_embedding(self, img_url = None, filename = None):
+        if self.image_vectorizer is not None:
+            return self.image_vectorizer(img_url = img_url, filename = filename)
+
+        if self.embedding_cache is None or filename is None:
+            # embeddings of image URLs are not cached, see get_cache_key
+            return self.vectorize_image(img_url, filename)
+
+        cache_key = self.get_cache_key(img_url = img_url, filename = filename)
+        return self.embedding_cache.get_or_compute(cache_key, lambda: self.vectorize_image(img_url, filename))
+
+
+    def vectorize_image(self, img_url = None, filename = None):
 
         if filename is not None: 
             with open(filename, 'rb') as f:
@@ -71,6 +160,16 @@ class CV:
 
 
     def get_text_embedding(self, text):
+        if self.text_vectorizer is not None:
+            return self.text_vectorizer(text)
+
+        if self.embedding_cache is None:
+            return self.vectorize_text(text)
+
+        return self.embedding_cache.get_or_compute(self.get_cache_key(text = text), lambda: self.vectorize_text(text))
+
+
+    def vectorize_text(self, text):
         response = self.http_req.post(op='text_embedding', headers=self.http_req.json_headers, body={'text': text})
 
         try:
@@ -0,0 +1,22 @@
+from collections import defaultdict
+
+
+# Constant of the reciprocal rank fusion used by the service for hybrid queries
+RRF_K = 60
+
+
+
+def reciprocal_rank_fusion(rankings, k = RRF_K, weights = None):
+    """
+    Merge ranked lists of (key, score) pairs: each key scores sum(weight / (k + rank)) over the lists it appears in.
+    Returns (key, fused score) pairs, best first.
+    """
+    if weights is None:
+        weights = [1.0] * len(rankings)
+
+    fused = defaultdict(float)
+    for ranking, weight in zip(rankings, weights):
+        for rank, (key, _) in enumerate(ranking, start=1):
+            fused[key] += weight / (k + rank)
+
+    return sorted(fused.items(), key=lambda kv: kv[1], reverse=True)
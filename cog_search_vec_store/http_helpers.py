@@ -1,6 +1,9 @@
 import requests
 import json
+import threading
 
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
 from tenacity import (
     retry,
     stop_after_attempt,
@@ -38,11 +41,96 @@ class HTTPError(Exception):
 
 
 
+class SessionPool:
+    """
+    Shared requests.Session with one keep-alive connection pool per host.
+
+    host_pool_sizes maps a host name to its pool size (pool_maxsize is used for other hosts).
+    timeout is the default (connect, read) timeout of every request.
+    """
+
+    def __init__(self, pool_maxsize = 10, host_pool_sizes = None, timeout = (3.05, 60), pool_block = False):
+        self.pool_maxsize = pool_maxsize
+        self.host_pool_sizes = host_pool_sizes or {}
+        self.timeout = timeout
+        self.pool_block = pool_block
+
+        self.session = requests.Session()
+        self.session.headers['Connection'] = 'keep-alive'
+        self.adapters = {}
+        self.lock = threading.Lock()
+
+
+    def get_adapter(self, url):
+        parts = urlsplit(url)
+        prefix = f"{parts.scheme}://{parts.netloc}"
+
+        if prefix not in self.adapters:
+            with self.lock:
+                if prefix not in self.adapters:
+                    size = self.host_pool_sizes.get(parts.hostname, self.pool_maxsize)
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size, pool_block=self.pool_block)
+                    self.session.mount(prefix, adapter)
+                    self.adapters[prefix] = adapter
+
+        return self.adapters[prefix]
+
+
+    def request(self, method, url, **kwargs):
+        self.get_adapter(url)
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+
+    def stats(self):
+        """
+        Connections opened and requests sent per host. reused = requests served on an already open connection.
+        """
+        stats = {}
+
+        for prefix, adapter in self.adapters.items():
+            pools = adapter.poolmanager.pools
+            connections = requests_sent = 0
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+                    requests_sent += pool.num_requests
+
+            stats[prefix] = {'connections': connections,
+                             'requests': requests_sent,
+                             'reused': max(0, requests_sent - connections)}
+
+        return stats
+
+
+    def close(self):
+        self.session.close()
+
+
+
+default_session_pool = SessionPool()
+
+
+def configure_session_pool(**kwargs):
+    """
+    Replace the default session pool shared by all HTTPRequest objects created afterwards
+    """
+    global default_session_pool
+
+    default_session_pool.close()
+    default_session_pool = SessionPool(**kwargs)
+
+    return default_session_pool
+
+
+
 class HTTPRequest:
-    def __init__(self, url = '', api_key = ''):
+    def __init__(self, url = '', api_key = '', session_pool = None):
         self.url = url
         self.api_key = api_key
         self.default_headers = {'Content-Type': 'application/json', 'api-key': self.api_key}
+        self.session_pool = session_pool if session_pool is not None else default_session_pool
         
         
     def initialize_for_cogsearch(self, api_key, search_service_name, index_name, api_version):
@@ -86,12 +174,12 @@ class HTTPRequest:
         if body is None:
             body = {}
         
-        response = requests.put(url, json=body, headers=headers)
+        response = self.session_pool.request('PUT', url, json=body, headers=headers)
         return self.handle_response(response)
 
 
     @retry(wait=wait_random_exponential(min=1, max=4), stop=stop_after_attempt(4))
-    def post(self, op = None, headers=None, body=None, data=None):
+    def post(self, op = None, headers=None, body=None, data=None, params=None):
 
         url = self.get_url(op)
 
@@ -104,11 +192,11 @@ class HTTPRequest:
             body = {}
         
         if data is not None:
-            response = requests.post(url, data=data, headers=headers)
+            response = self.session_pool.request('POST', url, data=data, headers=headers, params=params)
         elif body is not None:
-            response = requests.post(url, json=body, headers=headers)
+            response = self.session_pool.request('POST', url, json=body, headers=headers, params=params)
         else:
-            response = requests.post(url, headers=headers)
+            response = self.session_pool.request('POST', url, headers=headers, params=params)
 
         return self.handle_response(response)
 
@@ -126,7 +214,7 @@ class HTTPRequest:
         if params is None:
             params = {}
         
-        response = requests.get(url, headers=headers, params=params)
+        response = self.session_pool.request('GET', url, headers=headers, params=params)
         return self.handle_response(response)
 
 
@@ -140,7 +228,7 @@ class HTTPRequest:
         else:
             headers = {**self.default_headers, **headers}
         
-        response = requests.delete(url, headers=headers)
+        response = self.session_pool.request('DELETE', url, headers=headers)
         return self.handle_response(response)
 
 
@@ -149,8 +237,9 @@ class HTTPRequest:
 
 class CogSearchHttpRequest(HTTPRequest):
 
-    def __init__(self, api_key, search_service_name, index_name, api_version):
+    def __init__(self, api_key, search_service_name, index_name, api_version, session_pool = None):
         self.api_key = api_key
+        self.session_pool = session_pool if session_pool is not None else default_session_pool
         self.search_service_name = search_service_name
         self.index_name = index_name
         self.api_version = api_version
@@ -176,9 +265,11 @@ class CogSearchHttpRequest(HTTPRequest):
 class CVHttpRequest(HTTPRequest):
 
     def __init__(self, api_key, cog_serv_name, api_version, 
-                 options = ['tags', 'objects', 'caption', 'read', 'smartCrops', 'denseCaptions', 'people']):
+                 options = ['tags', 'objects', 'caption', 'read', 'smartCrops', 'denseCaptions', 'people'],
+                 session_pool = None):
 
         self.api_key = api_key
+        self.session_pool = session_pool if session_pool is not None else default_session_pool
 
         if cog_serv_name.endswith('/'):
             cog_serv_name = cog_serv_name[:-1]
@@ -187,7 +278,10 @@ class CVHttpRequest(HTTPRequest):
         self.api_version = api_version
 
         options = ','.join(options).replace(' ', '') if isinstance(options, list) else options
+        self.options = options
         self.url = f"{cog_serv_name}/computervision/imageanalysis:analyze?api-version={api_version}&modelVersion=latest&features={options}"
+        # the features are sent as a query parameter, per call
+        self.analyze_url = f"{cog_serv_name}/computervision/imageanalysis:analyze?api-version={api_version}&modelVersion=latest"
         self.imgvec_url = f"{cog_serv_name}/computervision/retrieval:vectorizeImage?api-version={api_version}&modelVersion=latest"
         self.txtvec_url = f"{cog_serv_name}/computervision/retrieval:vectorizeText?api-version={api_version}&modelVersion=latest"
         
@@ -202,6 +296,8 @@ class CVHttpRequest(HTTPRequest):
             url = self.imgvec_url
         elif op == 'text_embedding':
             url = self.txtvec_url            
+        elif op == 'analyze_features':
+            url = self.analyze_url
         else:
             url = self.url
 
@@ -0,0 +1,402 @@
+import os
+import json
+import shutil
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import faiss
+
+from cog_search_vec_store import cs_json
+from cog_search_vec_store import query_cache
+from cog_search_vec_store import cs_builders
+from cog_search_vec_store import bm25
+from cog_search_vec_store.fusion import reciprocal_rank_fusion
+from cog_search_vec_store.odata_filter import compile_filter
+from cog_search_vec_store.cogsearch_vecstore import CogSearchVecStore
+
+from utils import get_openai_embedding
+
+
+DOCUMENTS_FILE = 'documents.jsonl'
+DELETED_FILE = 'deleted.json'
+INDEX_FILE = 'index.json'
+# filters whose compiled predicate and mask of allowed rows are kept
+FILTER_CACHE_SIZE = 64
+
+
+
+def get_hnsw_parameters(index_json = cs_json.create_index_json):
+    for config in index_json['vectorSearch']['algorithmConfigurations']:
+        if config['kind'] == 'hnsw':
+            return config['hnswParameters']
+    return {'m': 10, 'efConstruction': 400, 'metric': 'cosine'}
+
+
+
+class VectorField:
+    """
+    HNSW index of one vector field. Faiss labels are positions in `rows`, which holds the matching document rows.
+    Each field has its own lock, so that searches on different fields run in parallel.
+    """
+
+    def __init__(self, name, dimensions, m, ef_construction, ef_search):
+        self.name = name
+        self.dimensions = dimensions
+        self.index = faiss.IndexHNSWFlat(dimensions, m, faiss.METRIC_INNER_PRODUCT)
+        self.index.hnsw.efConstruction = ef_construction
+        self.index.hnsw.efSearch = ef_search
+        self.rows = np.empty(0, dtype=np.int64)
+        self.lock = threading.Lock()
+
+
+    def add(self, rows, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimensions)
+        faiss.normalize_L2(vectors)
+        with self.lock:
+            self.index.add(vectors)
+            self.rows = np.concatenate([self.rows, np.asarray(rows, dtype=np.int64)])
+
+
+    def search(self, vector, k, allowed_rows = None):
+        """
+        Top-k (document row, cosine similarity) pairs, restricted to the allowed document rows if given
+        """
+        if self.index.ntotal == 0:
+            return []
+
+        query = np.asarray(vector, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(query)
+
+        params = None
+        if allowed_rows is not None:
+            # rows uploaded after allowed_rows was computed are not allowed
+            rows = self.rows
+            allowed = np.zeros(len(rows), dtype=bool)
+            known = rows < len(allowed_rows)
+            allowed[known] = allowed_rows[rows[known]]
+            labels = np.nonzero(allowed)[0].astype(np.int64)
+            if len(labels) == 0:
+                return []
+            params = faiss.SearchParametersHNSW(sel=faiss.IDSelectorBatch(labels), efSearch=self.index.hnsw.efSearch)
+
+        with self.lock:
+            similarities, labels = self.index.search(query, k, params=params)
+
+        return [(int(self.rows[l]), float(s)) for s, l in zip(similarities[0], labels[0]) if l >= 0]
+
+
+    def save(self, path):
+        faiss.write_index(self.index, path + '.faiss')
+        np.save(path + '.rows.npy', self.rows)
+
+
+    def load(self, path):
+        if os.path.exists(path + '.faiss'):
+            self.index = faiss.read_index(path + '.faiss')
+            self.rows = np.load(path + '.rows.npy')
+
+
+
+class LocalVecStore(CogSearchVecStore):
+    """
+    Offline drop-in for CogSearchVecStore, backed by local faiss HNSW indexes.
+
+    Implements create_index, upload_documents, delete_documents and search (with vector_name, select
+    and OData filters) over the same index definition as cs_json.create_index_json. Documents and
+    indexes are persisted under index_dir/index_name and loaded on first use. Deleted or replaced
+    documents are tombstoned and skipped at query time.
+
+    Hybrid searches rank text_en with BM25 and fuse it with the vector results by reciprocal rank
+    fusion, like the service. There is no semantic ranker offline: semantic_hybrid ranks as hybrid.
+    """
+
+    def __init__(self, index_dir,
+                       index_name = "img-vec-index",
+                       ef_search = 128,
+                       cache_results = False,
+                       cache_ttl = 300,
+                       cache_size = 1024,
+                       cv = None,
+                       text_vectorizer = get_openai_embedding,
+                       text_batch_vectorizer = None):
+
+        self.http_req = None
+        self.index_name = index_name
+        self.path = os.path.join(index_dir, index_name)
+        self.all_fields = ['id', 'text', 'text_en', 'categoryId', 'file', 'class']
+        self.search_types = ['vector', 'hybrid', 'semantic_hybrid']
+        self.text_field = 'text_en'
+        self.doc_builder = cs_builders.DocumentBuilder(self.all_fields)
+        self.result_cache = query_cache.TTLCache(cache_size, cache_ttl) if cache_results else None
+        self.init_cv(cv, None)
+        self.init_text_vectorizers(text_vectorizer, text_batch_vectorizer)
+
+        self.hnsw = get_hnsw_parameters()
+        self.ef_search = ef_search
+        self.lock = threading.RLock()
+        self.loaded = False
+        # filter -> (predicate, version, allowed rows); the version changes on every upload or delete
+        self.filters = OrderedDict()
+        self.version = 0
+
+
+
+    def new_vector_fields(self, index_json):
+        return {f['name']: VectorField(f['name'], f['dimensions'], self.hnsw['m'], self.hnsw['efConstruction'], self.ef_search)
+                for f in index_json['fields'] if f['type'] == 'Collection(Edm.Single)'}
+
+
+    def load(self):
+        """
+        Load documents and indexes from disk, once
+        """
+        with self.lock:
+            if self.loaded:
+                return
+
+            if not os.path.exists(os.path.join(self.path, INDEX_FILE)):
+                raise Exception(f"Index {self.index_name} does not exist in {self.path}, call create_index() first")
+
+            with open(os.path.join(self.path, INDEX_FILE)) as f:
+                self.index_json = json.load(f)
+
+            self.documents = []
+            with open(os.path.join(self.path, DOCUMENTS_FILE)) as f:
+                for line in f:
+                    self.documents.append(json.loads(line))
+
+            with open(os.path.join(self.path, DELETED_FILE)) as f:
+                deleted = set(json.load(f))
+
+            self.live = np.ones(len(self.documents), dtype=bool)
+            self.live[list(deleted)] = False
+            self.id_to_row = {d['id']: i for i, d in enumerate(self.documents) if self.live[i]}
+
+            self.vector_fields = self.new_vector_fields(self.index_json)
+            for name, field in self.vector_fields.items():
+                field.load(os.path.join(self.path, name))
+
+            self.on_load()
+            self.loaded = True
+
+
+    def on_load(self):
+        # the text index is rebuilt from the documents rather than persisted
+        k1, b = bm25.get_bm25_parameters(self.index_json)
+        self.text_index = bm25.BM25Index(k1, b)
+        self.on_upload(0, self.documents)
+        self.filters.clear()
+        self.version += 1
+
+
+    def save(self):
+        with open(os.path.join(self.path, DELETED_FILE), 'w') as f:
+            json.dump(np.nonzero(~self.live)[0].tolist(), f)
+
+        for name, field in self.vector_fields.items():
+            field.save(os.path.join(self.path, name))
+
+
+
+    def create_index(self):
+
+        index_json = json.loads(json.dumps(cs_json.create_index_json))
+        index_json['name'] = self.index_name
+
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, INDEX_FILE), 'w') as f:
+                json.dump(index_json, f)
+            open(os.path.join(self.path, DOCUMENTS_FILE), 'w').close()
+            with open(os.path.join(self.path, DELETED_FILE), 'w') as f:
+                json.dump([], f)
+
+            self.loaded = False
+            self.load()
+            self.save()
+
+
+    def connection_stats(self):
+        return {}
+
+
+    def get_index(self):
+        self.load()
+        return {**self.index_json, 'documentCount': int(self.live.sum())}
+
+
+    def delete_index(self):
+        self.invalidate_cache()
+        with self.lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.loaded = False
+
+
+
+    def upload_documents(self, documents, verbose = False, **kwargs):
+        self.load()
+        actions = [self.get_upload_doc(doc) for doc in documents]
+
+        with self.lock:
+            first_row = len(self.documents)
+            new_docs = []
+            vectors = {name: ([], []) for name in self.vector_fields}
+
+            for row, action in enumerate(actions, start=first_row):
+                doc = {'id': action.id}
+                for k, v in action.fields.items():
+                    if k in self.vector_fields:
+                        if len(v) > 0:
+                            vectors[k][0].append(row)
+                            vectors[k][1].append(v)
+                    else:
+                        doc[k] = v
+                new_docs.append(doc)
+
+                # an upload replaces the previous version of the document
+                if action.id in self.id_to_row:
+                    self.live[self.id_to_row[action.id]] = False
+                self.id_to_row[action.id] = row
+
+            with open(os.path.join(self.path, DOCUMENTS_FILE), 'a') as f:
+                f.writelines(json.dumps(d) + '\n' for d in new_docs)
+
+            self.documents.extend(new_docs)
+            self.live = np.concatenate([self.live, np.ones(len(new_docs), dtype=bool)])
+            # a document uploaded twice in the same batch: only the last one stays live
+            for row, doc in enumerate(new_docs, start=first_row):
+                if self.id_to_row[doc['id']] != row:
+                    self.live[row] = False
+
+            for name, (rows, vecs) in vectors.items():
+                if rows:
+                    self.vector_fields[name].add(rows, vecs)
+
+            self.on_upload(first_row, new_docs)
+            self.version += 1
+            self.save()
+
+        self.invalidate_cache()
+        report = {'documents': len(actions), 'indexed': len(actions), 'failed': []}
+        if verbose: print(f"Indexed {report['indexed']} documents in {self.path}")
+
+        return report
+
+
+    def on_upload(self, first_row, new_docs):
+        for row, doc in enumerate(new_docs, start=first_row):
+            self.text_index.add(row, doc.get(self.text_field, ''))
+
+
+    def delete_documents(self, op='index', ids = [], **kwargs):
+        self.load()
+        deleted = 0
+
+        with self.lock:
+            for i in ids:
+                row = self.id_to_row.pop(i, None)
+                if row is not None:
+                    self.live[row] = False
+                    deleted += 1
+            self.version += 1
+            self.save()
+
+        self.invalidate_cache()
+        return {'documents': len(ids), 'indexed': deleted, 'failed': []}
+
+
+
+    def snapshot(self):
+        """
+        (live mask, documents, version) as of now: uploads and deletes during a query don't change what it sees.
+        The documents list only grows, so its first len(live) rows stay valid.
+        """
+        with self.lock:
+            return self.live.copy(), self.documents, self.version
+
+
+    def get_allowed_rows(self, filter, live, documents, version):
+        """
+        Boolean mask of the live documents matching the filter, over the rows of a snapshot.
+        Repeated filters reuse their mask until the next upload or delete.
+        """
+        if not filter:
+            return live
+
+        with self.lock:
+            entry = self.filters.get(filter)
+            if entry is not None:
+                self.filters.move_to_end(filter)
+                if entry[1] == version:
+                    return entry[2]
+
+        predicate = entry[0] if entry is not None else compile_filter(filter)
+        allowed = live.copy()
+        for row in np.nonzero(allowed)[0]:
+            allowed[row] = predicate(documents[row])
+        # shared by the queries with the same filter
+        allowed.setflags(write=False)
+
+        with self.lock:
+            # a query on an older snapshot doesn't replace a newer mask
+            if version == self.version:
+                self.filters[filter] = (predicate, version, allowed)
+                self.filters.move_to_end(filter)
+                while len(self.filters) > FILTER_CACHE_SIZE:
+                    self.filters.popitem(last=False)
+
+        return allowed
+
+
+    def format_results(self, scored_rows, select, documents):
+        fields = self.all_fields if select is None else [f.strip() for f in select.split(',')]
+        if fields == ['*']:
+            fields = self.all_fields
+
+        results = []
+        for row, score in scored_rows:
+            doc = documents[row]
+            result = {k: doc.get(k, '') for k in fields}
+            result['@search.score'] = score
+            results.append(result)
+
+        return results
+
+
+    def vector_search(self, vector_field, vector, k, allowed_rows):
+        n = len(allowed_rows)
+        if allowed_rows.all():
+            allowed_rows = None
+
+        scored = self.vector_fields[vector_field].search(vector, int(k), allowed_rows)
+
+        # same scale as the cosine @search.score of the service: 1 / (1 + cosine distance)
+        return [(row, 1.0 / (2.0 - similarity)) for row, similarity in scored if row < n]
+
+
+    def text_search(self, search_query, allowed_rows):
+        with self.lock:
+            return self.text_index.search(search_query.search, int(search_query.top), allowed_rows)
+
+
+    def run_search_query(self, search_query, select=None, filter=None):
+        self.load()
+
+        # everything below indexes the snapshot, never the live arrays
+        live, documents, version = self.snapshot()
+        allowed_rows = self.get_allowed_rows(filter, live, documents, version)
+
+        if search_query.vectors:
+            # one scan per vector field, in parallel, fused like the service fuses multi-vector queries
+            with ThreadPoolExecutor(max_workers=len(search_query.vectors)) as executor:
+                rankings = list(executor.map(lambda v: self.vector_search(v[0], v[1], search_query.k, allowed_rows), search_query.vectors))
+        else:
+            rankings = [self.vector_search(search_query.vector_fields, search_query.vector_value, search_query.k, allowed_rows)]
+
+        if search_query.search_type != 'vector' and search_query.search:
+            rankings.append(self.text_search(search_query, allowed_rows))
+
+        scored_rows = rankings[0] if len(rankings) == 1 else reciprocal_rank_fusion(rankings)
+
+        return self.format_results(scored_rows, select, documents)
@@ -0,0 +1,167 @@
+import re
+
+
+# Subset of the OData $filter syntax used with Cognitive Search:
+#   field eq 'value', ne, gt, ge, lt, le, and, or, not, parentheses, null, true/false, numbers
+#   search.in(field, 'a,b,c') and search.in(field, 'a|b', '|')
+TOKEN_REGEX = re.compile(r"""\s*(?:
+    (?P<string>'(?:[^']|'')*') |
+    (?P<number>-?\d+(?:\.\d+)?) |
+    (?P<punct>[(),]) |
+    (?P<word>[A-Za-z_@][\w.\-/@]*)
+)""", re.VERBOSE)
+
+COMPARISONS = {
+    'eq': lambda a, b: a == b,
+    'ne': lambda a, b: a != b,
+    'gt': lambda a, b: a is not None and a > b,
+    'ge': lambda a, b: a is not None and a >= b,
+    'lt': lambda a, b: a is not None and a < b,
+    'le': lambda a, b: a is not None and a <= b,
+}
+
+
+
+class FilterSyntaxError(Exception):
+    pass
+
+
+
+def tokenize(expr):
+    tokens, pos = [], 0
+    expr = expr.rstrip()
+
+    while pos < len(expr):
+        m = TOKEN_REGEX.match(expr, pos)
+        if m is None or m.end() == pos:
+            raise FilterSyntaxError(f"Unexpected character at {pos} in filter: {expr}")
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == 'string':
+            value = value[1:-1].replace("''", "'")
+        elif kind == 'number':
+            value = float(value) if '.' in value else int(value)
+        tokens.append((kind, value))
+        pos = m.end()
+
+    return tokens
+
+
+
+class FilterParser:
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.tokens = tokenize(expr)
+        self.pos = 0
+
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+
+    def expect(self, value):
+        kind, v = self.next()
+        if v != value:
+            raise FilterSyntaxError(f"Expected '{value}' in filter: {self.expr}")
+
+
+    def parse(self):
+        predicate = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise FilterSyntaxError(f"Unexpected '{self.peek()[1]}' in filter: {self.expr}")
+        return predicate
+
+
+    def parse_or(self):
+        left = self.parse_and()
+        while self.peek() == ('word', 'or'):
+            self.next()
+            right = self.parse_and()
+            left = (lambda l, r: lambda doc: l(doc) or r(doc))(left, right)
+        return left
+
+
+    def parse_and(self):
+        left = self.parse_not()
+        while self.peek() == ('word', 'and'):
+            self.next()
+            right = self.parse_not()
+            left = (lambda l, r: lambda doc: l(doc) and r(doc))(left, right)
+        return left
+
+
+    def parse_not(self):
+        if self.peek() == ('word', 'not'):
+            self.next()
+            inner = self.parse_not()
+            return lambda doc: not inner(doc)
+        return self.parse_primary()
+
+
+    def parse_primary(self):
+        kind, value = self.next()
+
+        if value == '(':
+            inner = self.parse_or()
+            self.expect(')')
+            return inner
+
+        if kind == 'word' and value == 'search.in':
+            return self.parse_search_in()
+
+        if kind != 'word':
+            raise FilterSyntaxError(f"Expected a field name in filter: {self.expr}")
+
+        field = value
+        op_kind, op = self.next()
+        if op not in COMPARISONS:
+            raise FilterSyntaxError(f"Unsupported operator '{op}' in filter: {self.expr}")
+
+        literal = self.parse_literal()
+        compare = COMPARISONS[op]
+        return lambda doc: compare(doc.get(field), literal)
+
+
+    def parse_literal(self):
+        kind, value = self.next()
+        if kind in ('string', 'number'):
+            return value
+        if value in ('true', 'false'):
+            return value == 'true'
+        if value == 'null':
+            return None
+        raise FilterSyntaxError(f"Expected a literal in filter: {self.expr}")
+
+
+    def parse_search_in(self):
+        self.expect('(')
+        kind, field = self.next()
+        self.expect(',')
+        kind, values = self.next()
+        delimiters = ' ,'
+
+        if self.peek()[1] == ',':
+            self.next()
+            kind, delimiters = self.next()
+        self.expect(')')
+
+        allowed = set(v for v in re.split('[' + re.escape(delimiters) + ']', values) if v)
+        return lambda doc: doc.get(field) in allowed
+
+
+
+def compile_filter(expr):
+    """
+    Compile an OData filter expression into a predicate over document dicts (None or '' match everything)
+    """
+    if not expr:
+        return lambda doc: True
+
+    return FilterParser(expr).parse()
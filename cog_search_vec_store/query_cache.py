@@ -0,0 +1,85 @@
+import time
+import threading
+from collections import OrderedDict
+
+from cog_search_vec_store import query_preprocessor
+
+
+
+def normalize_query(query):
+    """
+    Collapse whitespace and case so near-identical questions share a cache entry.
+    Image URLs are kept as they are: their paths and SAS tokens are case-sensitive.
+    """
+    # the URL pattern has one capture group: odd parts are the URLs
+    parts = query_preprocessor.IMAGE_URL_PATTERN.split(query)
+    query = ''.join(part if i % 2 else part.casefold() for i, part in enumerate(parts))
+    return ' '.join(query.split())
+
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire ttl seconds after they were stored
+    """
+
+    def __init__(self, maxsize = 1024, ttl = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.invalidations = 0
+
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.invalidations += 1
+
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'invalidations': self.invalidations,
+        }
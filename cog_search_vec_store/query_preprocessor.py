@@ -0,0 +1,88 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from cog_search_vec_store import cv_helpers
+from cog_search_vec_store import query_cache
+
+
+IMAGE_URL_REGEX = r"(https?:\/\/[^\/\s]+(?:\/[^\/\s]+)*\/[^?\/\s]+(?:\.jpg|\.jpeg|\.png)(?:\?[^\s'\"]+)?)"
+IMAGE_URL_PATTERN = re.compile(IMAGE_URL_REGEX)
+
+
+
+def find_image_urls(query):
+    """
+    Image URLs of a query, without duplicates, in order of appearance
+    """
+    return list(dict.fromkeys(IMAGE_URL_PATTERN.findall(query)))
+
+
+
+def remove_urls(query, urls):
+    for url in urls:
+        query = query.replace(url, '')
+    return query
+
+
+
+def add_analyses(text_query, analyses):
+    """
+    Query text followed by the text summary of the analysis of each of its images
+    """
+    return '\n'.join([text_query] + [a['text'] for a in analyses])
+
+
+
+class QueryPreprocessor:
+    """
+    Splits a query into its text and image URLs, and analyzes the images.
+
+    Analyses are memoized per URL (and feature set) in an LRU with a TTL, so follow-up
+    questions about the same picture do not call the service again.
+    """
+
+    def __init__(self, cv, features = cv_helpers.TEXT_FEATURES, cache_size = 256, cache_ttl = 3600, max_workers = 4):
+        self.cv = cv
+        self.features = features
+        self.max_workers = max_workers
+        self.analyses = query_cache.TTLCache(cache_size, cache_ttl)
+
+
+    def get_cache_key(self, url):
+        return (url, tuple(self.features) if self.features is not None else None)
+
+
+    def get_cached_analysis(self, url):
+        return self.analyses.get(self.get_cache_key(url))
+
+
+    def store_analysis(self, url, analysis):
+        self.analyses.put(self.get_cache_key(url), analysis)
+        return analysis
+
+
+    def analyze(self, url):
+        analysis = self.get_cached_analysis(url)
+        if analysis is None:
+            analysis = self.store_analysis(url, self.cv.analyze_image(img_url=url, features=self.features))
+        return analysis
+
+
+    def analyze_all(self, urls):
+        if len(urls) <= 1:
+            return [self.analyze(url) for url in urls]
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(urls))) as executor:
+            return list(executor.map(self.analyze, urls))
+
+
+    def process(self, query):
+        """
+        (text of the query without its image URLs, image URLs, analyses of the images)
+        """
+        urls = find_image_urls(query)
+        return remove_urls(query, urls), urls, self.analyze_all(urls)
+
+
+    def stats(self):
+        return self.analyses.stats()
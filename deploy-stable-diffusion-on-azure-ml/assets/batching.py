@@ -0,0 +1,115 @@
+import time
+import logging
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future
+
+
+class BatchScheduler:
+    """
+    Micro-batching in front of a batched function.
+
+    submit() queues a request and blocks until its result is ready. A worker thread takes the oldest request,
+    waits up to max_wait seconds for compatible requests (same key_fn(request)) and runs run_batch(requests)
+    on at most max_batch_size units (size_fn(request), e.g. images). run_batch returns one result per request.
+    Requests whose key is None are never batched. With max_batch_size=1 and max_wait=0, the scheduler only
+    runs the requests one at a time, in order.
+    """
+
+    def __init__(self, run_batch, key_fn, size_fn=lambda request: 1, max_batch_size=8, max_wait=0.02):
+        self.run_batch = run_batch
+        self.key_fn = key_fn
+        self.size_fn = size_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.pending = deque()
+        self.condition = threading.Condition()
+
+        self.requests = 0
+        self.batches = 0
+        self.batch_sizes = Counter()
+        self.max_queue_depth = 0
+        self.wait_seconds = 0.0
+
+        self.worker = threading.Thread(target=self.work, name='batch-scheduler', daemon=True)
+        self.worker.start()
+
+    def submit(self, request):
+        return self.submit_async(request).result()
+
+    def submit_async(self, request):
+        """
+        Queue a request without waiting: returns the Future of its result
+        """
+        future = Future()
+        with self.condition:
+            self.pending.append((request, self.key_fn(request), future, time.monotonic()))
+            self.max_queue_depth = max(self.max_queue_depth, len(self.pending))
+            self.condition.notify()
+
+        return future
+
+    def next_batch(self):
+        """
+        Oldest pending request and the compatible requests queued behind it, removed from the queue
+        """
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+
+            first = self.pending[0]
+            if first[1] is not None:
+                # give compatible requests a short window to arrive
+                deadline = first[3] + self.max_wait
+                while time.monotonic() < deadline and self.batch_units(first[1]) < self.max_batch_size:
+                    self.condition.wait(deadline - time.monotonic())
+
+            batch, size = [], 0
+            for item in list(self.pending):
+                if item is not first and (first[1] is None or item[1] != first[1]):
+                    continue
+                item_size = self.size_fn(item[0])
+                if batch and size + item_size > self.max_batch_size:
+                    break
+                batch.append(item)
+                size += item_size
+                self.pending.remove(item)
+                if first[1] is None:
+                    break
+
+            return batch, size
+
+    def batch_units(self, key):
+        return sum(self.size_fn(item[0]) for item in self.pending if item[1] == key)
+
+    def work(self):
+        while True:
+            batch, size = self.next_batch()
+            now = time.monotonic()
+
+            self.requests += len(batch)
+            self.batches += 1
+            self.batch_sizes[len(batch)] += 1
+            self.wait_seconds += sum(now - item[3] for item in batch)
+            logging.info(f"Running a batch of {len(batch)} requests ({size} images), {len(self.pending)} queued")
+
+            try:
+                results = self.run_batch([item[0] for item in batch])
+                for item, result in zip(batch, results):
+                    item[2].set_result(result)
+            except Exception as e:
+                for item in batch:
+                    if not item[2].done():
+                        item[2].set_exception(e)
+
+    def stats(self):
+        return {
+            'queue_depth': len(self.pending),
+            'max_queue_depth': self.max_queue_depth,
+            'requests': self.requests,
+            'batches': self.batches,
+            'mean_batch_size': self.requests / self.batches if self.batches else 0.0,
+            'batch_sizes': dict(self.batch_sizes),
+            'mean_wait_seconds': self.wait_seconds / self.requests if self.requests else 0.0,
+        }
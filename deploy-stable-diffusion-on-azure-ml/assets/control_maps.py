@@ -0,0 +1,76 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def image_digest(image):
+    """
+    Content hash of a PIL image: the same picture downloaded twice gets the same digest
+    """
+    digest = hashlib.sha256(f"{image.mode}:{image.size}".encode('utf-8'))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+class ControlImagePreprocessor:
+    """
+    Runs control image detectors (canny, depth...) on a worker pool and caches the control maps.
+
+    detectors maps a name to a function(image, **params) returning a PIL image. Maps are cached in an LRU of
+    cache_size entries keyed by (image digest, detector name, params), so requests iterating on the prompt over
+    the same source image skip detection. Concurrent requests for the same map share one detection.
+    """
+
+    def __init__(self, detectors, cache_size=64, max_workers=4):
+        self.detectors = detectors
+        self.cache_size = cache_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='control')
+        self.maps = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def submit(self, image, maps):
+        """
+        Futures of the control maps of image, one per (detector name, params dict) of maps. The detections run
+        concurrently with each other and with the caller.
+        """
+        digest = image_digest(image)
+        futures = []
+        for name, params in maps:
+            key = (digest, name, tuple(sorted(params.items())))
+            with self.lock:
+                future = self.maps.get(key)
+                if future is not None:
+                    self.maps.move_to_end(key)
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    future = self.executor.submit(self.detectors[name], image, **params)
+                    self.maps[key] = future
+                    future.add_done_callback(lambda f, key=key: self.forget_failed(key, f))
+                    while len(self.maps) > self.cache_size:
+                        self.maps.popitem(last=False)
+            futures.append(future)
+
+        return futures
+
+    def prepare(self, image, maps):
+        """
+        Control maps of image, one per (detector name, params dict) of maps
+        """
+        return [future.result() for future in self.submit(image, maps)]
+
+    def forget_failed(self, key, future):
+        if future.exception() is not None:
+            logging.warning(f"Control map {key[1]} failed: {future.exception()}")
+            with self.lock:
+                if self.maps.get(key) is future:
+                    del self.maps[key]
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.maps), 'max_entries': self.cache_size, 'hits': self.hits, 'misses': self.misses}
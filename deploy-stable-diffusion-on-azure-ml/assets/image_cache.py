@@ -0,0 +1,203 @@
+import os
+import io
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import requests
+from PIL import Image
+
+
+class InputImageCache:
+    """
+    Cache of the input images (image_url, mask_image) of the requests, in memory and on disk.
+
+    Images fetched less than max_age seconds ago are served without any request; older ones are revalidated
+    with If-None-Match / If-Modified-Since and only downloaded again when they changed. The memory cache keeps
+    the most recently used images up to max_memory_bytes, the disk cache evicts the least recently used files
+    over max_disk_bytes.
+
+    The revalidation follows image_fetch.ImageFetcher at the repository root, which can't be imported here:
+    the assets directory is deployed to Azure ML on its own.
+    """
+
+    def __init__(self, cache_dir, max_disk_bytes=2**30, max_memory_bytes=256 * 2**20, max_age=60, timeout=30):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self.max_age = max_age
+        self.timeout = timeout
+        self.session = requests.Session()
+
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.disk_bytes = sum(os.path.getsize(os.path.join(cache_dir, f)) for f in os.listdir(cache_dir))
+
+        self.hits = 0
+        self.revalidated = 0
+        self.downloads = 0
+
+    def get_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def get_cached(self, url):
+        """
+        (data, validators, fetch time) of a cached URL, from memory or else from disk, None if not cached
+        """
+        with self.lock:
+            entry = self.memory.get(url)
+            if entry is not None:
+                self.memory.move_to_end(url)
+                return entry
+
+        path = self.get_path(url)
+        try:
+            with open(path + '.bin', 'rb') as f:
+                data = f.read()
+            with open(path + '.json') as f:
+                meta = json.load(f)
+            os.utime(path + '.bin')
+        except (OSError, ValueError):
+            return None
+
+        entry = (data, meta['validators'], meta['fetched'])
+        self.put_memory(url, entry)
+        return entry
+
+    def put_memory(self, url, entry):
+        size = len(entry[0])
+        if size > self.max_memory_bytes:
+            return
+
+        with self.lock:
+            previous = self.memory.pop(url, None)
+            if previous is not None:
+                self.memory_bytes -= len(previous[0])
+            self.memory[url] = entry
+            self.memory_bytes += size
+
+            while self.memory_bytes > self.max_memory_bytes:
+                _, (data, _, _) = self.memory.popitem(last=False)
+                self.memory_bytes -= len(data)
+
+    def put(self, url, data, validators):
+        entry = (data, validators, time.time())
+        self.put_memory(url, entry)
+
+        path = self.get_path(url)
+        meta = json.dumps({'url': url, 'validators': validators, 'fetched': entry[2]}).encode('utf-8')
+        written = 0
+        # os.replace is atomic: a reader gets the previous file or the new one, never a partial one
+        for suffix, content in (('.bin', data), ('.json', meta)):
+            tmp = f"{path}{suffix}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(content)
+            previous = os.path.getsize(path + suffix) if os.path.exists(path + suffix) else 0
+            os.replace(tmp, path + suffix)
+            written += len(content) - previous
+
+        with self.lock:
+            self.disk_bytes += written
+            if self.disk_bytes > self.max_disk_bytes:
+                self.prune()
+
+    def touch(self, url, entry):
+        """
+        Mark a revalidated entry as fresh
+        """
+        entry = (entry[0], entry[1], time.time())
+        self.put_memory(url, entry)
+        path = self.get_path(url) + '.json'
+        try:
+            previous = os.path.getsize(path)
+            with open(path, 'w') as f:
+                json.dump({'url': url, 'validators': entry[1], 'fetched': entry[2]}, f)
+            with self.lock:
+                self.disk_bytes += os.path.getsize(path) - previous
+        except OSError:
+            pass
+
+    def prune(self):
+        """
+        Remove the least recently used files until the disk cache is under 90% of its cap
+        """
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.bin'):
+                path = os.path.join(self.cache_dir, name[:-len('.bin')])
+                try:
+                    files.append((os.path.getmtime(path + '.bin'), path))
+                except OSError:
+                    continue
+
+        for _, path in sorted(files):
+            if self.disk_bytes <= 0.9 * self.max_disk_bytes:
+                break
+            for suffix in ('.bin', '.json'):
+                try:
+                    size = os.path.getsize(path + suffix)
+                    os.remove(path + suffix)
+                    self.disk_bytes -= size
+                except OSError:
+                    continue
+
+    def fetch(self, url):
+        """
+        Bytes of the image at url
+        """
+        entry = self.get_cached(url)
+        if entry is not None and time.time() - entry[2] < self.max_age:
+            self.count('hits')
+            return entry[0]
+
+        headers = {}
+        if entry is not None:
+            if entry[1].get('etag'): headers['If-None-Match'] = entry[1]['etag']
+            if entry[1].get('last_modified'): headers['If-Modified-Since'] = entry[1]['last_modified']
+
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException:
+            if entry is not None:
+                logging.warning(f"Could not revalidate {url}, using the cached image")
+                return entry[0]
+            raise
+
+        if response.status_code == 304 and entry is not None:
+            self.count('revalidated')
+            self.touch(url, entry)
+            return entry[0]
+
+        response.raise_for_status()
+        self.count('downloads')
+        self.put(url, response.content, {'etag': response.headers.get('ETag'),
+                                         'last_modified': response.headers.get('Last-Modified')})
+        return response.content
+
+    def get_image(self, url, mode="RGB"):
+        """
+        Image at url, decoded from memory
+        """
+        return Image.open(io.BytesIO(self.fetch(url))).convert(mode)
+
+    def count(self, counter):
+        # fetches run on several threads at once
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'memory_entries': len(self.memory),
+                'memory_bytes': self.memory_bytes,
+                'disk_bytes': self.disk_bytes,
+                'hits': self.hits,
+                'revalidated': self.revalidated,
+                'downloads': self.downloads,
+            }
@@ -0,0 +1,271 @@
+import gc
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import torch
+
+
+def iter_modules(obj, depth=0):
+    """
+    Yields the torch modules held by a model object: a module, a diffusers pipeline (its components),
+    a transformers pipeline (its model), a detector wrapping modules, or a dict/list of those.
+    """
+    if obj is None or depth > 2:
+        return
+
+    if isinstance(obj, torch.nn.Module):
+        yield obj
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            yield from iter_modules(value, depth + 1)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            yield from iter_modules(value, depth + 1)
+    elif isinstance(getattr(obj, 'components', None), dict):
+        yield from iter_modules(obj.components, depth + 1)
+    elif hasattr(obj, '__dict__'):
+        for value in vars(obj).values():
+            if isinstance(value, (torch.nn.Module, dict, list, tuple)):
+                yield from iter_modules(value, depth + 1)
+
+
+def tensor_bytes(obj, seen=None):
+    """
+    Bytes of the parameters and buffers of a model object. Tensors already in `seen` are not counted again,
+    so components shared between pipelines are only counted once.
+    """
+    seen = set() if seen is None else seen
+    total = 0
+
+    for module in iter_modules(obj):
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            key = (tensor.device, tensor.data_ptr())
+            if key not in seen:
+                seen.add(key)
+                total += tensor.numel() * tensor.element_size()
+
+    return total
+
+
+class ModelEntry:
+    """
+    A model registered in a ModelRegistry, loaded by loader(*dependencies) on first use
+    """
+
+    def __init__(self, name, loader, depends_on=(), pinned=False):
+        self.name = name
+        self.loader = loader
+        self.depends_on = tuple(depends_on)
+        self.pinned = pinned
+        self.value = None
+        # bytes added to the resident models by the last load, to make room before the next one
+        self.size = None
+        # number of requests using the model: it is not evicted while in use
+        self.in_use = 0
+        self.last_used = 0.0
+        self.load_seconds = 0.0
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+
+class ModelRegistry:
+    """
+    Loads models on first use and keeps the resident ones under a memory budget.
+
+    Each model is registered with a loader and the names of the models it is built from (e.g. a pipeline
+    built from the components of another one). Getting a model loads its dependencies first. When the
+    parameters of the resident models exceed memory_budget bytes, the least recently used models that no
+    resident model depends on, and that no request is using (see using()), are evicted. Shared tensors are
+    only counted once.
+
+    The size of a model is only known once it has been loaded. Models loaded before are evicted ahead of
+    reloading them to make room; on the first load of a model, eviction happens after loading, so the
+    resident models briefly go over the budget by up to the size of that model.
+
+    Loaders are plain callables, so the registry can be exercised on CPU with tiny random-weight models.
+    """
+
+    def __init__(self, memory_budget=None):
+        self.memory_budget = memory_budget
+        self.entries = {}
+        self.lock = threading.RLock()
+
+    def register(self, name, loader, depends_on=(), pinned=False):
+        self.entries[name] = ModelEntry(name, loader, depends_on, pinned)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def is_loaded(self, name):
+        return self.entries[name].value is not None
+
+    def get(self, name):
+        """
+        The model registered as name, loaded (with its dependencies) if it is not resident
+        """
+        return self.load([name])[name]
+
+    @contextmanager
+    def using(self, names):
+        """
+        Context manager loading the models registered as names (dict of the models), and keeping them and their
+        dependencies from being evicted until the block exits, even by the loads of concurrent requests
+        """
+        closure = self.get_closure(names)
+        with self.lock:
+            for name in closure:
+                self.entries[name].in_use += 1
+
+        try:
+            yield self.load(names)
+        finally:
+            with self.lock:
+                for name in closure:
+                    self.entries[name].in_use -= 1
+
+    def load(self, names):
+        """
+        Dict of the models registered as names, all resident together
+        """
+        if self.memory_budget is not None:
+            # make room for the models that are not resident, if their size is known from a previous load
+            closure = self.get_closure(names)
+            missing = [self.entries[n] for n in closure if self.entries[n].value is None]
+            needed = sum(e.size or 0 for e in missing)
+            if needed:
+                self.evict(keep=closure, budget=self.memory_budget - needed)
+
+        models, loaded = {}, False
+        for name in names:
+            models[name], model_loaded = self.get_or_load(name)
+            loaded = loaded or model_loaded
+
+        # evict once the models and all their dependencies are resident
+        if loaded and self.memory_budget is not None:
+            self.evict(keep=self.get_closure(names))
+
+        return models
+
+    def get_or_load(self, name):
+        if name not in self.entries:
+            raise KeyError(f"Unknown model {name}")
+
+        entry = self.entries[name]
+        loaded = False
+        dependencies = []
+        for d in entry.depends_on:
+            value, dependency_loaded = self.get_or_load(d)
+            dependencies.append(value)
+            loaded = loaded or dependency_loaded
+
+        # one loader at a time per model, other models can load concurrently
+        with entry.lock:
+            value = entry.value
+            if value is None:
+                logging.info(f"Loading model {name}")
+                start = time.perf_counter()
+                value = entry.loader(*dependencies)
+                entry.load_seconds = time.perf_counter() - start
+                entry.loads += 1
+                resident = self.resident_bytes()
+                entry.value = value
+                entry.size = self.resident_bytes() - resident
+                loaded = True
+            else:
+                entry.hits += 1
+            entry.last_used = time.monotonic()
+
+        return value, loaded
+
+    def get_closure(self, names):
+        """
+        Names and their transitive dependencies
+        """
+        closure, todo = set(), list(names)
+        while todo:
+            name = todo.pop()
+            if name not in closure:
+                closure.add(name)
+                todo.extend(self.entries[name].depends_on)
+        return closure
+
+    def resident_bytes(self):
+        seen = set()
+        return sum(tensor_bytes(e.value, seen) for e in self.entries.values() if e.value is not None)
+
+    def footprint(self, names):
+        """
+        Bytes of the resident models among names and their dependencies, shared tensors counted once
+        """
+        seen = set()
+        return sum(tensor_bytes(self.entries[n].value, seen) for n in self.get_closure(names) if self.entries[n].value is not None)
+
+    def evict(self, keep=(), budget=None):
+        """
+        Evict least recently used models until the resident models fit in budget (the memory budget by default).
+        Pinned models, models in use and the models in keep are never evicted.
+        """
+        budget = self.memory_budget if budget is None else budget
+        with self.lock:
+            while self.resident_bytes() > budget:
+                loaded = [e for e in self.entries.values() if e.value is not None]
+                needed = {d for e in loaded for d in e.depends_on}
+                candidates = [e for e in loaded if not e.pinned and not e.in_use and e.name not in keep and e.name not in needed]
+                if not candidates:
+                    logging.warning(f"Models use {self.resident_bytes() / 2**30:.1f} GB, over the budget of "
+                                    f"{budget / 2**30:.1f} GB, but none can be evicted")
+                    return
+
+                self.unload(min(candidates, key=lambda e: e.last_used).name)
+
+    def unload(self, name):
+        entry = self.entries[name]
+        with entry.lock:
+            if entry.value is None:
+                return
+            logging.info(f"Evicting model {name}")
+            entry.value = None
+            entry.evictions += 1
+
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def stats(self):
+        models = {}
+        for name, e in self.entries.items():
+            models[name] = {
+                'loaded': e.value is not None,
+                'in_use': e.in_use,
+                'bytes': tensor_bytes(e.value) if e.value is not None else 0,
+                'load_seconds': e.load_seconds,
+                'loads': e.loads,
+                'hits': e.hits,
+                'evictions': e.evictions,
+            }
+
+        return {'resident_bytes': self.resident_bytes(), 'memory_budget': self.memory_budget, 'models': models}
+
+
+class RegistryView:
+    """
+    Read-only mapping over some models of a registry, loading them on access.
+    names is a list of registry names, or a dict of keys to registry names.
+    """
+
+    def __init__(self, registry, names):
+        self.registry = registry
+        self.names = dict(names) if isinstance(names, dict) else {name: name for name in names}
+
+    def __getitem__(self, key):
+        return self.registry.get(self.names[key])
+
+    def __contains__(self, key):
+        return key in self.names
+
+    def keys(self):
+        return list(self.names)
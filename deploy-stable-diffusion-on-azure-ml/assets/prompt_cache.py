@@ -0,0 +1,118 @@
+import itertools
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+
+import torch
+
+
+def embedding_bytes(value):
+    """
+    Bytes of an encoded prompt: a tensor, or a tuple of tensors (SDXL embeddings and pooled embeddings)
+    """
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (list, tuple)):
+        return sum(embedding_bytes(v) for v in value)
+    return 0
+
+
+class PromptEmbeddingCache:
+    """
+    LRU of encoded prompts, keyed by (encoder, prompt text), holding at most max_bytes of tensors.
+
+    The tensors stay where the text encoder put them (usually the GPU), so a hit costs no copy and no
+    text encoder forward pass. Callers must not modify the returned tensors in place.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value[0]
+
+    def put(self, key, value):
+        size = embedding_bytes(value)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def drop(self, encoder_key):
+        """
+        Remove the prompts encoded by an encoder, e.g. when its model is evicted
+        """
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == encoder_key]:
+                self.size -= self.entries.pop(key)[1]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class CachedCompel:
+    """
+    Compel processor whose encoded prompts go through a PromptEmbeddingCache.
+
+    Each instance is a distinct encoder for the cache: a processor rebuilt after its pipeline was evicted
+    and reloaded never gets the embeddings of the previous one, which are dropped with it.
+    """
+
+    ids = itertools.count()
+
+    def __init__(self, compel, cache, name='compel'):
+        self.compel = compel
+        self.cache = cache
+        self.encoder_key = (name, next(CachedCompel.ids))
+        weakref.finalize(self, cache.drop, self.encoder_key)
+
+    def __call__(self, prompt):
+        # only plain prompts are cached, lists of prompts go straight to the encoder
+        if not isinstance(prompt, str):
+            return self.compel(prompt)
+
+        key = (self.encoder_key, prompt)
+        value = self.cache.get(key)
+        if value is None:
+            value = self.compel(prompt)
+            self.cache.put(key, value)
+        else:
+            logging.debug(f"Prompt embeddings of {self.encoder_key[0]} served from cache")
+
+        return value
+
+    def __getattr__(self, name):
+        # e.g. pad_conditioning_tensors_to_same_length
+        return getattr(self.compel, name)
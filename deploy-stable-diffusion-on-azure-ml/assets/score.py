@@ -4,12 +4,13 @@ import os
 import logging
 import json
 import math
+import inspect
 import cv2
 import numpy as np
 from compel import Compel, ReturnedEmbeddingsType
 from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image, ImageDraw
-from fastdownload import FastDownload
 from safetensors.torch import load_file
 from azureml.contrib.services.aml_response import AMLResponse
 
@@ -20,6 +21,73 @@ from controlnet_aux import ContentShuffleDetector, HEDdetector, MLSDdetector
 from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_controlnet import MultiControlNetModel
 from diffusers import StableDiffusionPipeline, StableDiffusionControlNetPipeline, StableDiffusionControlNetInpaintPipeline, ControlNetModel, StableDiffusionImg2ImgPipeline, StableDiffusionInpaintPipeline, StableDiffusionXLImg2ImgPipeline, StableDiffusionXLPipeline, StableDiffusionXLInpaintPipeline
 
+from model_registry import ModelRegistry, RegistryView
+from batching import BatchScheduler
+from prompt_cache import CachedCompel, PromptEmbeddingCache
+from streaming import ImageStream, get_preview_kwargs
+from control_maps import ControlImagePreprocessor
+from image_cache import InputImageCache
+
+
+# Checkpoints, overridable from the environment (e.g. with tiny random-weight models to test on CPU)
+MODEL_IDS = {
+    'sd15': os.getenv('SD15_MODEL_ID', "charapennikaurm/Reliberate"),
+    'sdxl_base': os.getenv('SDXL_BASE_MODEL_ID', "stabilityai/stable-diffusion-xl-base-1.0"),
+    'sdxl_refiner': os.getenv('SDXL_REFINER_MODEL_ID', "stabilityai/stable-diffusion-xl-refiner-1.0"),
+    'inpaint': os.getenv('INPAINT_MODEL_ID', "redstonehero/dreamshaper-inpainting"),
+    'cnet_scribble': os.getenv('CNET_SCRIBBLE_MODEL_ID', "lllyasviel/control_v11p_sd15_scribble"),
+    'cnet_depth': os.getenv('CNET_DEPTH_MODEL_ID', "lllyasviel/control_v11f1p_sd15_depth"),
+    'cnet_shuffle': os.getenv('CNET_SHUFFLE_MODEL_ID', "lllyasviel/control_v11e_sd15_shuffle"),
+    'cnet_inpaint': os.getenv('CNET_INPAINT_MODEL_ID', "lllyasviel/control_v11p_sd15_inpaint"),
+    'annotators': os.getenv('ANNOTATORS_MODEL_ID', 'lllyasviel/ControlNet'),
+    'depth_estimator': os.getenv('DEPTH_ESTIMATOR_MODEL_ID', "Intel/dpt-hybrid-midas"),
+}
+
+# Models needed by each design_type, loaded on the first request of that type
+DESIGN_TYPE_MODELS = {
+    'TXT_TO_IMG': ['pipe_txt_img', 'compel_sd'],
+    'IMG_TO_IMG': ['pipe_img_img', 'compel_sd'],
+    'TXT_TO_IMG_SDXL': ['pipe_base_sdxl', 'pipe_sdxl_refiner', 'compel_sdxl', 'compel_sdxl_refiner'],
+    'IMG_TO_IMG_SDXL': ['pipe_sdxl_refiner'],
+    'CNET_CANNY': ['cnet_pipe', 'cnet_model_scribble', 'compel_sd'],
+    'CNET_CANNY_DEPTH': ['cnet_pipe', 'cnet_model_scribble', 'cnet_model_depth', 'depth_estimator', 'compel_sd'],
+    'IN_PAINTING': ['pipe_inpaint', 'compel_inpaint'],
+}
+
+BASE_MODEL_NAMES = ['cnet_pipe', 'pipe_img_img', 'pipe_txt_img', 'pipe_base_sdxl', 'pipe_sdxl_refiner', 'pipe_inpaint', 'pipe_inpaint_cnet']
+CNET_MODEL_NAMES = ['cnet_model_scribble', 'cnet_model_depth', 'cnet_model_shuffle', 'cnet_model_inpaint', 'hed', 'mlsd', 'depth_estimator']
+COMPEL_NAMES = {'sd': 'compel_sd', 'sdxl': 'compel_sdxl', 'sdxl_refiner': 'compel_sdxl_refiner', 'inpaint': 'compel_inpaint'}
+
+# TXT_TO_IMG_SDXL refines the base latents of all the images in one refiner call ('latent'),
+# or decodes them and refines each image on its own ('image'). Overridable per request in other_args.
+SDXL_REFINER_MODE = os.getenv('SDXL_REFINER_MODE', 'latent')
+
+# Design types whose requests can share one forward pass when they use the same settings
+BATCHABLE_DESIGN_TYPES = {'TXT_TO_IMG'}
+
+
+def get_device():
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def get_dtype():
+    """
+    fp16 on GPU. On CPU (e.g. tests with tiny models) fp16 kernels are missing, so models load in fp32.
+    """
+    return torch.float16 if torch.cuda.is_available() else torch.float32
+
+
+def get_variant():
+    """
+    The fp16 weights of the checkpoints that publish them, only when the models are loaded in fp16.
+    """
+    return "fp16" if get_dtype() == torch.float16 else None
+
+
+def enable_memory_efficient_attention(pipe):
+    if torch.cuda.is_available():
+        pipe.enable_xformers_memory_efficient_attention()
+
 
 def prepare_canny_image(image_base, low_threshold=200, high_threshold=200):
     """
@@ -48,35 +116,38 @@ def handle_style_image(image_path, shuffle=False):
     return img
 
 
-def prepare_hed_scribble_image(image_base, hed, image_width):
+def prepare_hed_scribble_image(image_base, hed=None, image_width=512):
     """
     This function takes an image, HED detector, and image width as input, and returns the HED detected image with scribbles at the specified image width.
+    Without a detector, the one of the model registry is used (loaded once).
     """
     if not hed:
-        hed = HEDdetector.from_pretrained('lllyasviel/ControlNet')
+        hed = cnet_models['hed']
 
     image = hed(image_base, scribble=True, detect_resolution=image_width, image_resolution=image_width)
 
     return image
 
 
-def prepare_mlsd_image(image_base, mlsd, image_width):
+def prepare_mlsd_image(image_base, mlsd=None, image_width=512):
     """
     This function takes an image, MLSD detector, and image width as input, and returns the MLSD detected image at the specified image width.
+    Without a detector, the one of the model registry is used (loaded once).
     """
     if not mlsd:
-        mlsd = MLSDdetector.from_pretrained('lllyasviel/ControlNet')
+        mlsd = cnet_models['mlsd']
 
     image = mlsd(image_base, detect_resolution=image_width, image_resolution=image_width)
 
     return image
 
-def prepare_depth_image(image_base, depth_estimator):
+def prepare_depth_image(image_base, depth_estimator=None):
     """
     This function takes an image and a depth estimator, and returns a depth estimated image.
+    Without a depth estimator, the one of the model registry is used (loaded once).
     """
     if not depth_estimator:
-        depth_estimator = pipeline('depth-estimation')
+        depth_estimator = cnet_models['depth_estimator']
 
     image = depth_estimator(image_base)['depth']
     image = np.array(image)
@@ -87,26 +158,43 @@ def prepare_depth_image(image_base, depth_estimator):
     return image
 
 
-def get_control_net_to_img(model_id="SG161222/Realistic_Vision_V2.0", cont_model="lllyasviel/sd-controlnet-scribble"):
+# Control map detectors of the ControlNet design types, run by the ControlImagePreprocessor
+CONTROL_DETECTORS = {
+    'canny': prepare_canny_image,
+    'depth': prepare_depth_image,
+    'hed': prepare_hed_scribble_image,
+    'mlsd': prepare_mlsd_image,
+}
+
+# Control maps needed by each ControlNet design type, as (detector, params)
+DESIGN_TYPE_CONTROL_MAPS = {
+    'CNET_CANNY': [('canny', {})],
+    'CNET_CANNY_DEPTH': [('canny', {}), ('depth', {})],
+}
+
+
+def get_control_net_to_img(model_id="SG161222/Realistic_Vision_V2.0", cont_model="lllyasviel/sd-controlnet-scribble", controlnet=None):
     """
     This function takes a model ID and a control model as input, and returns a pre-trained StableDiffusionControlNetPipeline object with the specified controlnet and scheduler.
+    An already loaded controlnet can be passed instead of cont_model.
     """
-    controlnet = get_control_net_model(cont_model)
+    if controlnet is None:
+        controlnet = get_control_net_model(cont_model)
     
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = get_device()
     print('device', device)
     print('Controlnet downloaded')
     pipe = StableDiffusionControlNetPipeline.from_pretrained(model_id, 
                                                             controlnet=controlnet, 
                                                             safety_checker=None, 
-                                                            torch_dtype=torch.float16, 
+                                                            torch_dtype=get_dtype(), 
                                                             # cache_dir=cache_dir
                                                             ).to(device)
     
     print('Pipe downloaded')
     pipe.scheduler = EulerAncestralDiscreteScheduler.from_pretrained(model_id, subfolder="scheduler")
     print('Schedule Set')
-    pipe.enable_xformers_memory_efficient_attention()
+    enable_memory_efficient_attention(pipe)
     print('Xformer Set')
 
     return pipe
@@ -116,12 +204,12 @@ def get_txt_img_pipeline(model_id):
     """
     This function takes a model ID as input, and returns a pre-trained StableDiffusionPipeline object with Euler Ancestral Discrete Scheduler.
     """
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = get_device()
     print('device', device)
-    pipe = StableDiffusionPipeline.from_pretrained(model_id, torch_dtype=torch.float16).to(device)
+    pipe = StableDiffusionPipeline.from_pretrained(model_id, torch_dtype=get_dtype()).to(device)
     eulerScheduler = EulerAncestralDiscreteScheduler.from_pretrained(model_id, subfolder="scheduler")
     pipe.scheduler = eulerScheduler
-    pipe.enable_xformers_memory_efficient_attention()
+    enable_memory_efficient_attention(pipe)
 
     return pipe
 
@@ -130,7 +218,7 @@ def get_control_net_model(cont_model):
     """
     This function takes a control model as input, and returns a pre-trained ControlNetModel object.
     """
-    controlnet = ControlNetModel.from_pretrained(cont_model, torch_dtype=torch.float16).to("cuda")
+    controlnet = ControlNetModel.from_pretrained(cont_model, torch_dtype=get_dtype()).to(get_device())
 
     return controlnet
 
@@ -138,12 +226,12 @@ def get_img_img_pipeline(model_id):
     """
     This function takes a model ID as input, and returns a pre-trained StableDiffusionImg2ImgPipeline object with Euler Ancestral Discrete Scheduler.
     """
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = get_device()
     print('device', device)
-    pipe = StableDiffusionImg2ImgPipeline.from_pretrained(model_id, torch_dtype=torch.float16).to(device)
+    pipe = StableDiffusionImg2ImgPipeline.from_pretrained(model_id, torch_dtype=get_dtype()).to(device)
     eulerScheduler = EulerAncestralDiscreteScheduler.from_pretrained(model_id, subfolder="scheduler")
     pipe.scheduler = eulerScheduler
-    pipe.enable_xformers_memory_efficient_attention()
+    enable_memory_efficient_attention(pipe)
 
     return pipe
 
@@ -151,11 +239,11 @@ def get_base_sdxl_pipeline(model_id="stabilityai/stable-diffusion-xl-base-1.0"):
     """
     This function takes a model ID as input, and returns a pre-trained StableDiffusionXLPipeline object with Euler Ancestral Discrete Scheduler.
     """
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = get_device()
     print('device', device)
-    pipe = StableDiffusionXLPipeline.from_pretrained(model_id, torch_dtype=torch.float16, variant="fp16", use_safetensors=True).to(device)
+    pipe = StableDiffusionXLPipeline.from_pretrained(model_id, torch_dtype=get_dtype(), variant=get_variant(), use_safetensors=True).to(device)
     pipe.scheduler = EulerAncestralDiscreteScheduler.from_pretrained(model_id, subfolder="scheduler")
-    pipe.enable_xformers_memory_efficient_attention()
+    enable_memory_efficient_attention(pipe)
 
     return pipe
 
@@ -164,11 +252,11 @@ def get_img_img_sdxl_pipeline(model_id):
     """
     This function takes a model ID as input, and returns a pre-trained StableDiffusionXLImg2ImgPipeline object with Euler Ancestral Discrete Scheduler.
     """
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = get_device()
     print('device', device)
-    pipe_img_t_img = StableDiffusionXLImg2ImgPipeline.from_pretrained(model_id, torch_dtype=torch.float16, variant="fp16", use_safetensors=True).to(device)
+    pipe_img_t_img = StableDiffusionXLImg2ImgPipeline.from_pretrained(model_id, torch_dtype=get_dtype(), variant=get_variant(), use_safetensors=True).to(device)
     pipe_img_t_img.scheduler = EulerAncestralDiscreteScheduler.from_pretrained(model_id, subfolder="scheduler")
-    pipe_img_t_img.enable_xformers_memory_efficient_attention()
+    enable_memory_efficient_attention(pipe_img_t_img)
 
     return pipe_img_t_img
 
@@ -177,106 +265,190 @@ def get_inpainting_pipeline(model_id):
     """
     This function takes a model ID as input, and returns a pre-trained StableDiffusionInpaintPipeline object with Euler Ancestral Discrete Scheduler.
     """
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = get_device()
     print('device', device)
-    pipe = StableDiffusionInpaintPipeline.from_pretrained(model_id, torch_dtype=torch.float16).to(device)
+    pipe = StableDiffusionInpaintPipeline.from_pretrained(model_id, torch_dtype=get_dtype()).to(device)
     eulerScheduler = EulerAncestralDiscreteScheduler.from_pretrained(model_id, subfolder="scheduler")
     pipe.scheduler = eulerScheduler
-    pipe.enable_xformers_memory_efficient_attention()
+    enable_memory_efficient_attention(pipe)
 
     return pipe
 
+def get_pipeline_from_components(pipeline_class, base_pipe, **components):
+    """
+    This function builds a pipeline_class pipeline on the already loaded components (UNet, VAE, text encoder...) of base_pipe,
+    so pipeline variants of a checkpoint cost no extra memory or load time. components adds or replaces components (e.g. controlnet).
+    Each pipeline gets its own scheduler, since design() may change it.
+    """
+    components['scheduler'] = EulerAncestralDiscreteScheduler.from_config(base_pipe.scheduler.config)
+
+    if hasattr(pipeline_class, 'from_pipe'):
+        return pipeline_class.from_pipe(base_pipe, **components)
+
+    # older diffusers: pass the components the pipeline class accepts
+    accepted = inspect.signature(pipeline_class.__init__).parameters
+    shared = {k: v for k, v in base_pipe.components.items() if k in accepted}
+    shared.update(components)
+
+    return pipeline_class(**shared)
+
+
 def get_inpainting_cnet_pipeline(model_id):
     """
     This function takes a model ID as input, and returns a pre-trained StableDiffusionInpaintPipeline object with Euler Ancestral Discrete Scheduler.
     """
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = get_device()
     print('device', device)
-    controlnet = ControlNetModel.from_pretrained("lllyasviel/control_v11p_sd15_inpaint", torch_dtype=torch.float16).to(device)
-    pipe = StableDiffusionControlNetInpaintPipeline.from_pretrained(model_id, controlnet=controlnet, torch_dtype=torch.float16).to("cuda")
+    controlnet = ControlNetModel.from_pretrained(MODEL_IDS['cnet_inpaint'], torch_dtype=get_dtype()).to(device)
+    pipe = StableDiffusionControlNetInpaintPipeline.from_pretrained(model_id, controlnet=controlnet, torch_dtype=get_dtype()).to(device)
     eulerScheduler = EulerAncestralDiscreteScheduler.from_pretrained(model_id, subfolder="scheduler")
     pipe.scheduler = eulerScheduler
-    pipe.enable_xformers_memory_efficient_attention()
+    enable_memory_efficient_attention(pipe)
 
     return pipe
 
-def load_model():
+def get_compel(pipe, prompt_cache=None, name='compel_sd'):
+    compel = Compel(tokenizer=pipe.tokenizer, text_encoder=pipe.text_encoder)
+    return CachedCompel(compel, prompt_cache, name) if prompt_cache else compel
+
+
+def get_compel_sdxl(pipe, prompt_cache=None):
+    compel = Compel(tokenizer=[pipe.tokenizer, pipe.tokenizer_2] , text_encoder=[pipe.text_encoder, pipe.text_encoder_2], returned_embeddings_type=ReturnedEmbeddingsType.PENULTIMATE_HIDDEN_STATES_NON_NORMALIZED, requires_pooled=[False, True])
+    # (embeddings, pooled embeddings) are cached together
+    return CachedCompel(compel, prompt_cache, 'compel_sdxl') if prompt_cache else compel
+
+
+def get_compel_sdxl_refiner(pipe, prompt_cache=None):
+    # the refiner only has the second SDXL text encoder
+    compel = Compel(tokenizer=pipe.tokenizer_2, text_encoder=pipe.text_encoder_2, returned_embeddings_type=ReturnedEmbeddingsType.PENULTIMATE_HIDDEN_STATES_NON_NORMALIZED, requires_pooled=True)
+    return CachedCompel(compel, prompt_cache, 'compel_sdxl_refiner') if prompt_cache else compel
+
+
+def build_registry(memory_budget=None, prompt_cache=None):
     """
-    This function loads the necessary models and their dependencies for image generation tasks and returns them as dictionaries.
+    This function registers the loaders of all the models and their dependencies in a ModelRegistry, without loading anything.
+    Each model is loaded on first use and the least recently used ones are evicted when memory_budget (bytes) is exceeded.
+    Compel processors encode prompts through prompt_cache (a PromptEmbeddingCache) if given.
     """
-    model_name_sd15 = "charapennikaurm/Reliberate"
-    cnet_model_name = "lllyasviel/control_v11p_sd15_scribble"
-    print(f'the model name: [{model_name_sd15}]')
+    registry = ModelRegistry(memory_budget=memory_budget)
 
-    pipe_txt_img = get_txt_img_pipeline(model_name_sd15)
-    pipe_img_img = get_img_img_pipeline(model_name_sd15)
-    pipe_base_sdxl = get_base_sdxl_pipeline("stabilityai/stable-diffusion-xl-base-1.0")
-    pipe_sdxl_refiner = get_img_img_sdxl_pipeline("stabilityai/stable-diffusion-xl-refiner-1.0")
+    # SD1.5 pipelines share the components of pipe_txt_img, the inpainting ones those of pipe_inpaint
+    registry.register('pipe_txt_img', lambda: get_txt_img_pipeline(MODEL_IDS['sd15']))
+    registry.register('pipe_img_img', lambda pipe: get_pipeline_from_components(StableDiffusionImg2ImgPipeline, pipe), depends_on=['pipe_txt_img'])
+    registry.register('pipe_base_sdxl', lambda: get_base_sdxl_pipeline(MODEL_IDS['sdxl_base']))
+    registry.register('pipe_sdxl_refiner', lambda: get_img_img_sdxl_pipeline(MODEL_IDS['sdxl_refiner']))
 
-    cnet_pipe = get_control_net_to_img(model_name_sd15, cnet_model_name)
-    cnet_model_scribble = get_control_net_model("lllyasviel/control_v11p_sd15_scribble")
-    cnet_model_depth = get_control_net_model("lllyasviel/control_v11f1p_sd15_depth")
-    cnet_model_shuffle = get_control_net_model("lllyasviel/control_v11e_sd15_shuffle")
+    registry.register('cnet_model_scribble', lambda: get_control_net_model(MODEL_IDS['cnet_scribble']))
+    registry.register('cnet_model_depth', lambda: get_control_net_model(MODEL_IDS['cnet_depth']))
+    registry.register('cnet_model_shuffle', lambda: get_control_net_model(MODEL_IDS['cnet_shuffle']))
+    registry.register('cnet_model_inpaint', lambda: get_control_net_model(MODEL_IDS['cnet_inpaint']))
+    # the scribble controlnet of the pipeline is the same model as cnet_model_scribble
+    registry.register('cnet_pipe', lambda pipe, controlnet: get_pipeline_from_components(StableDiffusionControlNetPipeline, pipe, controlnet=controlnet, safety_checker=None),
+                      depends_on=['pipe_txt_img', 'cnet_model_scribble'])
 
-    print('Model objects and their dependencies are loaded')
+    registry.register('hed', lambda: HEDdetector.from_pretrained(MODEL_IDS['annotators']))
+    registry.register('mlsd', lambda: MLSDdetector.from_pretrained(MODEL_IDS['annotators']))
+    registry.register('depth_estimator', lambda: pipeline("depth-estimation", model=MODEL_IDS['depth_estimator']))
 
-    mlsd = MLSDdetector.from_pretrained('lllyasviel/ControlNet')
-    depth_estimator = pipeline("depth-estimation", model ="Intel/dpt-hybrid-midas")
+    registry.register('pipe_inpaint', lambda: get_inpainting_pipeline(MODEL_IDS['inpaint']))
+    registry.register('pipe_inpaint_cnet', lambda pipe, controlnet: get_pipeline_from_components(StableDiffusionControlNetInpaintPipeline, pipe, controlnet=controlnet),
+                      depends_on=['pipe_inpaint', 'cnet_model_inpaint'])
 
+    registry.register('compel_sd', lambda pipe: get_compel(pipe, prompt_cache), depends_on=['pipe_txt_img'])
+    # the inpainting checkpoint has its own text encoder
+    registry.register('compel_inpaint', lambda pipe: get_compel(pipe, prompt_cache, 'compel_inpaint'), depends_on=['pipe_inpaint'])
+    registry.register('compel_sdxl', lambda pipe: get_compel_sdxl(pipe, prompt_cache), depends_on=['pipe_base_sdxl'])
+    registry.register('compel_sdxl_refiner', lambda pipe: get_compel_sdxl_refiner(pipe, prompt_cache), depends_on=['pipe_sdxl_refiner'])
 
-    inpaint_model_name = "redstonehero/dreamshaper-inpainting"
-    pipe_inpaint = get_inpainting_pipeline(inpaint_model_name)
+    return registry
 
-    pipe_inpaint_cnet = get_inpainting_cnet_pipeline(inpaint_model_name)
 
-    compel = Compel(tokenizer=pipe_img_img.tokenizer, text_encoder=pipe_img_img.text_encoder)
-    compel_sdxl = Compel(tokenizer=[pipe_base_sdxl.tokenizer, pipe_base_sdxl.tokenizer_2] , text_encoder=[pipe_base_sdxl.text_encoder, pipe_base_sdxl.text_encoder_2], returned_embeddings_type=ReturnedEmbeddingsType.PENULTIMATE_HIDDEN_STATES_NON_NORMALIZED, requires_pooled=[False, True])
+def load_model(preload=None, memory_budget=None, prompt_cache=None):
+    """
+    This function builds the model registry and returns lazy views of the models as dictionaries.
+    preload lists design types whose models are loaded right away (all of them if None, use [] to load nothing).
+    """
+    registry = build_registry(memory_budget, prompt_cache)
 
+    for design_type in (DESIGN_TYPE_MODELS if preload is None else preload):
+        print(f'Preloading models of {design_type}')
+        registry.load(DESIGN_TYPE_MODELS[design_type])
 
-    base_models = {
-        'cnet_pipe': cnet_pipe,
-        'pipe_img_img': pipe_img_img,
-        'pipe_txt_img': pipe_txt_img,
-        'pipe_base_sdxl': pipe_base_sdxl,
-        'pipe_sdxl_refiner': pipe_sdxl_refiner,
-        'pipe_inpaint': pipe_inpaint,
-        'pipe_inpaint_cnet': pipe_inpaint_cnet,
-    }
+    print('Model objects and their dependencies are registered')
 
-    cnet_models = {
-        'cnet_model_scribble': cnet_model_scribble,
-        'cnet_model_depth': cnet_model_depth,
-        'cnet_model_shuffle': cnet_model_shuffle,
-        'mlsd': mlsd,
-        'depth_estimator': depth_estimator
-    }
+    base_models = RegistryView(registry, BASE_MODEL_NAMES)
+    cnet_models = RegistryView(registry, CNET_MODEL_NAMES)
+    compel_proc = RegistryView(registry, COMPEL_NAMES)
 
-    compel_proc = {
-        'sd': compel,
-        'sdxl': compel_sdxl
-    }
+    return registry, base_models, cnet_models, compel_proc
 
-    return base_models, cnet_models, compel_proc
 
 def init():
     """
     This function is called when the container is initialized/started, typically after create/update of the deployment.
-    You can write the logic here to perform init operations like caching the model in memory
+    Models are loaded on first use of their design_type. PRELOAD_DESIGN_TYPES (comma separated) lists the design types
+    loaded at startup, MODEL_MEMORY_BUDGET_GB caps the memory of the resident models.
+    PROMPT_CACHE_MB caps the memory of the cached prompt embeddings (0 disables the cache).
     """
-    global base_models, cnet_models, compel_proc
-    
-    base_models, cnet_models, compel_proc = load_model()
+    global registry, base_models, cnet_models, compel_proc, scheduler, prompt_cache, encode_executor, control_preprocessor, image_cache, fetch_executor
+
+    preload = [d.strip() for d in os.getenv('PRELOAD_DESIGN_TYPES', '').split(',') if d.strip()]
+    budget_gb = os.getenv('MODEL_MEMORY_BUDGET_GB')
+    memory_budget = int(float(budget_gb) * 2**30) if budget_gb else None
+
+    # negative prompts are reused across most requests, their embeddings stay on the device
+    prompt_cache_mb = float(os.getenv('PROMPT_CACHE_MB', '256'))
+    prompt_cache = PromptEmbeddingCache(int(prompt_cache_mb * 2**20)) if prompt_cache_mb > 0 else None
+
+    registry, base_models, cnet_models, compel_proc = load_model(preload, memory_budget, prompt_cache)
 
+    # all generation runs on the scheduler's worker thread: the pipelines are shared and stateful (schedulers, controlnets).
+    # BATCH_MAX_IMAGES=0 disables micro-batching, requests then run one at a time without waiting
+    max_batch_images = int(os.getenv('BATCH_MAX_IMAGES', '8'))
+    batch_wait = float(os.getenv('BATCH_WAIT_MS', '20')) / 1000 if max_batch_images > 0 else 0
+    scheduler = BatchScheduler(design_batch, key_fn=get_batch_key, size_fn=lambda r: r['num_images_per_prompt'],
+                               max_batch_size=max(max_batch_images, 1), max_wait=batch_wait)
+
+    # control maps of a source image are detected once, while the prompts are encoded
+    control_preprocessor = ControlImagePreprocessor(CONTROL_DETECTORS, cache_size=int(os.getenv('CONTROL_CACHE_SIZE', '64')),
+                                                    max_workers=int(os.getenv('CONTROL_WORKERS', '4')))
+
+    # input images and masks are cached in memory and on disk, and revalidated with their ETag
+    image_cache = InputImageCache(os.getenv('INPUT_IMAGE_CACHE_DIR', '/tmp/input-images'),
+                                  max_disk_bytes=int(float(os.getenv('INPUT_IMAGE_CACHE_DISK_MB', '1024')) * 2**20),
+                                  max_memory_bytes=int(float(os.getenv('INPUT_IMAGE_CACHE_MEMORY_MB', '256')) * 2**20))
+    fetch_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='fetch')
+
+    # JPEG encoding of streamed images overlaps with the denoising of the next ones
+    encode_executor = ThreadPoolExecutor(max_workers=int(os.getenv('ENCODE_WORKERS', '2')), thread_name_prefix='encode')
+
+    logging.info(f"Memory of the preloaded design types: {json.dumps(memory_report())}")
     logging.info("Init complete")
 
 
+def memory_report():
+    """
+    This function returns the memory (GB of parameters and buffers) used by the models of each design type, with
+    components shared between pipelines counted once. Design types whose models are not all loaded report None.
+    """
+    report = {}
+    for design_type, names in DESIGN_TYPE_MODELS.items():
+        loaded = all(registry.is_loaded(n) for n in registry.get_closure(names))
+        report[design_type] = round(registry.footprint(names) / 2**30, 3) if loaded else None
+
+    report['resident'] = round(registry.resident_bytes() / 2**30, 3)
+    if registry.memory_budget is not None:
+        report['budget'] = round(registry.memory_budget / 2**30, 3)
+
+    return report
+
+
 def get_image_object(image_url):
     """
     This function takes an image URL and returns an Image object.
+    The image is served from the input image cache when it did not change, and decoded from memory.
     """
-    p = FastDownload().download(image_url, force=True)
-    init_image = Image.open(p).convert("RGB")
-    return init_image
+    return image_cache.get_image(image_url)
 
 def prepare_response(images):
     """
@@ -295,88 +467,208 @@ def prepare_response(images):
 
 
 
-def design(prompt, image=None, num_images_per_prompt=4, negative_prompt=None, strength=0.65, guidance_scale=7.5, num_inference_steps=50, seed=None, design_type='TXT_TO_IMG', mask=None, other_args=None):
+def get_generator(seed):
+    """
+    This function returns a new CPU generator seeded with seed (0 if not set), so that a request's images only depend on its seed.
+    """
+    return torch.Generator().manual_seed(seed or 0)
+
+
+def design(prompt, image=None, num_images_per_prompt=4, negative_prompt=None, strength=0.65, guidance_scale=7.5, num_inference_steps=50, seed=None, design_type='TXT_TO_IMG', mask=None, other_args=None, stream=None, preview_steps=0):
     """
     This function takes various parameters like prompt, image, seed, design_type, etc., and generates images based on the specified design type. It returns a list of generated images.
+    With an ImageStream, images are also put in the stream as they are produced, with a latent preview every preview_steps steps.
     """
-    generator = None
-    if seed:
-        generator = torch.manual_seed(seed)
-    else:
-        generator = torch.manual_seed(0)
+    # all the models of the design type are resident together, and kept from eviction until the request is done
+    with registry.using(DESIGN_TYPE_MODELS.get(design_type, [])):
+        generator = get_generator(seed)
+
+        # control maps are detected on the worker pool while the prompts are encoded
+        control_maps = control_preprocessor.submit(image, DESIGN_TYPE_CONTROL_MAPS[design_type]) if design_type in DESIGN_TYPE_CONTROL_MAPS else []
+
+        print('other_args', other_args)
+        dic_conditioning_scales = {}
+
+        if other_args and 'CNET_CONFIGS' in other_args and design_type.startswith('CNET'):
+            cnet_configs = other_args['CNET_CONFIGS']
+            dic_conditioning_scales = cnet_configs['controlnet_conditioning_scale']
+            if 'Scheduler' in cnet_configs and cnet_configs['Scheduler'] == 'DPM':
+                print('converting scheduler to DPM')
+                base_models["cnet_pipe"].scheduler = DPMSolverMultistepScheduler.from_config(base_models["cnet_pipe"].scheduler.config)
+            else:
+                base_models["cnet_pipe"].scheduler = EulerAncestralDiscreteScheduler.from_config(base_models["cnet_pipe"].scheduler.config)
+
+        print('dic_conditioning_scales', dic_conditioning_scales)
+
+        prompt_emd = None
+        negative_prompt_emd = None
+        pooled = None
+        pooled_neg = None
+
+        if 'TXT_TO_IMG_SDXL' in design_type:
+            prompt_emd, pooled = compel_proc['sdxl'](prompt)
+            negative_prompt_emd, pooled_neg = compel_proc['sdxl'](negative_prompt)
+        elif design_type == 'IN_PAINTING':
+            prompt_emd = compel_proc['inpaint'](prompt)
+            negative_prompt_emd = compel_proc['inpaint'](negative_prompt)
+        elif design_type != 'IMG_TO_IMG_SDXL':
+            # the SDXL refiner takes the prompts as text, no need to load the SD1.5 text encoder for it
+            prompt_emd = compel_proc['sd'](prompt)
+            negative_prompt_emd = compel_proc['sd'](negative_prompt)
+
+        previews = get_preview_kwargs(stream, preview_steps, 'sdxl' if 'SDXL' in design_type else 'sd')
+
+        li_images = []
+        if design_type == 'TXT_TO_IMG':
+            # same seeding as design_batch, so that a request gets the same images whether it is batched or not
+            li_images = base_models["pipe_txt_img"](prompt_embeds=prompt_emd, num_images_per_prompt=num_images_per_prompt, negative_prompt_embeds=negative_prompt_emd, guidance_scale=guidance_scale, num_inference_steps=num_inference_steps,
+                                                    generator=[generator] * num_images_per_prompt, **previews).images
+
+        elif design_type == 'IMG_TO_IMG':
+            li_images = base_models["pipe_img_img"](prompt_embeds=prompt_emd, image=image, num_images_per_prompt=num_images_per_prompt, negative_prompt_embeds=negative_prompt_emd, strength=strength, guidance_scale=guidance_scale, num_inference_steps=num_inference_steps, generator=generator, **previews).images
+
+        elif design_type == 'TXT_TO_IMG_SDXL':
+            refiner_mode = (other_args or {}).get('SDXL_REFINER_MODE', SDXL_REFINER_MODE)
+            output_type = 'latent' if refiner_mode == 'latent' else 'pil'
+            li_base_images = base_models["pipe_base_sdxl"](prompt_embeds=prompt_emd, pooled_prompt_embeds=pooled, num_images_per_prompt=num_images_per_prompt, negative_prompt_embeds=negative_prompt_emd, negative_pooled_prompt_embeds=pooled_neg, guidance_scale=guidance_scale, num_inference_steps=num_inference_steps, output_type=output_type, generator=generator, **previews).images
+            if refiner_mode == 'latent':
+                li_images = refine_sdxl_latents(li_base_images, prompt, negative_prompt, guidance_scale, num_inference_steps, strength, generator)
+            else:
+                li_images = refine_sdxl_images(li_base_images, prompt, negative_prompt, guidance_scale, num_inference_steps, strength, generator, stream)
+
+        elif design_type == 'IMG_TO_IMG_SDXL':
+            li_images = base_models["pipe_sdxl_refiner"](prompt=prompt, image=image, num_images_per_prompt=num_images_per_prompt, negative_prompt=negative_prompt, strength=strength, guidance_scale=guidance_scale, num_inference_steps=num_inference_steps, generator=generator, **previews).images
+
+        elif design_type == 'CNET_CANNY':
+            canny_p = dic_conditioning_scales.get('CANNY', 1.0)
+            canny_image = control_maps[0].result()
+
+            base_models["cnet_pipe"].controlnet = cnet_models['cnet_model_scribble']
+            li_images = base_models["cnet_pipe"](prompt_embeds=prompt_emd, image=canny_image, controlnet_conditioning_scale=canny_p, num_images_per_prompt=num_images_per_prompt, negative_prompt_embeds=negative_prompt_emd, guidance_scale=guidance_scale, generator=generator, num_inference_steps=num_inference_steps, **previews).images
+            li_images.append(canny_image)
+
+        elif design_type == "CNET_CANNY_DEPTH":
+            canny_image, depth_image = [f.result() for f in control_maps]
+
+            canny_p = dic_conditioning_scales.get('CANNY', 1.0)
+            depth_p = dic_conditioning_scales.get('DEPTH', 0.3)
+
+            base_models["cnet_pipe"].controlnet = MultiControlNetModel([cnet_models['cnet_model_scribble'], cnet_models['cnet_model_depth']])
+            li_images = base_models["cnet_pipe"](prompt_embeds=prompt_emd, image=[canny_image, depth_image], controlnet_conditioning_scale=[canny_p, depth_p], num_images_per_prompt=num_images_per_prompt, negative_prompt_embeds=negative_prompt_emd, guidance_scale=guidance_scale, generator=generator, num_inference_steps=num_inference_steps, **previews).images
+            li_images.append(canny_image)
+            li_images.append(depth_image)
+
+        elif design_type == 'IN_PAINTING':
+            li_images = base_models["pipe_inpaint"](prompt_embeds=prompt_emd, image=image.resize((512, 512)), mask_image=mask.resize((512, 512)), num_images_per_prompt=num_images_per_prompt, negative_prompt_embeds=negative_prompt_emd, guidance_scale=guidance_scale, num_inference_steps=num_inference_steps, generator=generator, **previews).images
+
+        if stream is not None:
+            # images not streamed yet (all of them, except with the per-image SDXL refiner)
+            for image in li_images[stream.images:]:
+                stream.put_image(image)
+
+        return li_images
+
+
+def refine_sdxl_latents(latents, prompt, negative_prompt, guidance_scale, num_inference_steps, strength, generator=None):
+    """
+    This function refines the latents of a batch of SDXL base images in one refiner call, without decoding them first.
+    The prompts are encoded once for the whole batch.
+    """
+    prompt_emd, pooled = compel_proc['sdxl_refiner'](prompt)
+    negative_prompt_emd, pooled_neg = compel_proc['sdxl_refiner'](negative_prompt)
+
+    return base_models["pipe_sdxl_refiner"](prompt_embeds=prompt_emd, pooled_prompt_embeds=pooled, negative_prompt_embeds=negative_prompt_emd, negative_pooled_prompt_embeds=pooled_neg,
+                                            image=latents, num_images_per_prompt=len(latents), num_inference_steps=num_inference_steps, guidance_scale=guidance_scale, strength=strength, generator=generator).images
 
-    print('other_args', other_args)
-    dic_conditioning_scales = {}
-    
-    if other_args and 'CNET_CONFIGS' in other_args:
-        cnet_configs = other_args['CNET_CONFIGS']
-        dic_conditioning_scales = cnet_configs['controlnet_conditioning_scale']
-        if 'Scheduler' in cnet_configs and cnet_configs['Scheduler'] == 'DPM':
-            print('converting scheduler to DPM')
-            base_models["cnet_pipe"].scheduler = DPMSolverMultistepScheduler.from_config(base_models["cnet_pipe"].scheduler.config)
-        else:
-            base_models["cnet_pipe"].scheduler = EulerAncestralDiscreteScheduler.from_config(base_models["cnet_pipe"].scheduler.config)
-
-    print('dic_conditioning_scales', dic_conditioning_scales)
-
-    prompt_emd = None
-    negative_prompt_emd = None
-    pooled = None
-    pooled_neg = None
-
-    if 'TXT_TO_IMG_SDXL' in design_type:
-        prompt_emd, pooled = compel_proc['sdxl'](prompt)
-        negative_prompt_emd, pooled_neg = compel_proc['sdxl'](negative_prompt)
-    else:
-        prompt_emd = compel_proc['sd'](prompt)
-        negative_prompt_emd = compel_proc['sd'](negative_prompt)
-
-    li_images = []
-    if design_type == 'TXT_TO_IMG':
-        li_images = base_models["pipe_txt_img"](prompt_embeds=prompt_emd, num_images_per_prompt=num_images_per_prompt, negative_prompt_embeds=negative_prompt_emd, guidance_scale=guidance_scale, num_inference_steps=num_inference_steps).images
-
-    elif design_type == 'IMG_TO_IMG':
-        li_images = base_models["pipe_img_img"](prompt_embeds=prompt_emd, image=image, num_images_per_prompt=num_images_per_prompt, negative_prompt_embeds=negative_prompt_emd, strength=strength, guidance_scale=guidance_scale, num_inference_steps=num_inference_steps).images
-        
-    elif design_type == 'TXT_TO_IMG_SDXL':
-        li_base_images = base_models["pipe_base_sdxl"](prompt_embeds=prompt_emd, pooled_prompt_embeds=pooled, num_images_per_prompt=num_images_per_prompt, negative_prompt_embeds=negative_prompt_emd, negative_pooled_prompt_embeds=pooled_neg, guidance_scale=guidance_scale, num_inference_steps=num_inference_steps).images
-        for image in li_base_images:
-            refined_image = base_models["pipe_sdxl_refiner"](prompt=prompt, negative_prompt=negative_prompt, num_inference_steps=num_inference_steps, guidance_scale=guidance_scale, strength=strength, image=image).images[0]
-            li_images.append(refined_image)
-
-    elif design_type == 'IMG_TO_IMG_SDXL':
-        li_images = base_models["pipe_sdxl_refiner"](prompt=prompt, image=image, num_images_per_prompt=num_images_per_prompt, negative_prompt=negative_prompt, strength=strength, guidance_scale=guidance_scale, num_inference_steps=num_inference_steps).images
-    
-    elif design_type == 'CNET_CANNY':
-        canny_p = dic_conditioning_scales.get('CANNY', 1.0)
-        canny_image = prepare_canny_image(image)
-        
-        base_models["cnet_pipe"].controlnet = cnet_models['cnet_model_scribble']
-        li_images = base_models["cnet_pipe"](prompt_embeds=prompt_emd, image=canny_image, controlnet_conditioning_scale=canny_p, num_images_per_prompt=num_images_per_prompt, negative_prompt_embeds=negative_prompt_emd, guidance_scale=guidance_scale, generator=generator, num_inference_steps=num_inference_steps).images
-        li_images.append(canny_image)
 
-    elif design_type == "CNET_CANNY_DEPTH":
-        canny_image = prepare_canny_image(image)
-        depth_image = prepare_depth_image(image, cnet_models["depth_estimator"])
+def refine_sdxl_images(images, prompt, negative_prompt, guidance_scale, num_inference_steps, strength, generator=None, stream=None):
+    """
+    This function refines decoded SDXL base images one at a time, putting each one in the stream as soon as it is refined.
+    """
+    refined_images = []
+    for image in images:
+        refined_image = base_models["pipe_sdxl_refiner"](prompt=prompt, negative_prompt=negative_prompt, num_inference_steps=num_inference_steps, guidance_scale=guidance_scale, strength=strength, image=image, generator=generator).images[0]
+        refined_images.append(refined_image)
+        if stream is not None:
+            stream.put_image(refined_image)
+
+    return refined_images
+
+
+def get_batch_key(request):
+    """
+    This function returns the settings that requests must share to run in the same batch, or None if the request can't be batched.
+    """
+    if request['design_type'] not in BATCHABLE_DESIGN_TYPES or request.get('other_args') or request.get('stream'):
+        return None
+
+    return (request['design_type'], request['num_inference_steps'], request['guidance_scale'])
+
+
+def design_batch(requests):
+    """
+    This function generates the images of several compatible requests (see get_batch_key) in one forward pass
+    and returns the list of images of each request.
+    """
+    with torch.inference_mode():
+        if len(requests) == 1:
+            return [design(**requests[0])]
+
+        counts = [r['num_images_per_prompt'] for r in requests]
 
-        canny_p = dic_conditioning_scales.get('CANNY', 1.0)
-        depth_p = dic_conditioning_scales.get('DEPTH', 0.3)
-        
-        base_models["cnet_pipe"].controlnet = MultiControlNetModel([cnet_models['cnet_model_scribble'], cnet_models['cnet_model_depth']])
-        li_images = base_models["cnet_pipe"](prompt_embeds=prompt_emd, image=[canny_image, depth_image], controlnet_conditioning_scale=[canny_p, depth_p], num_images_per_prompt=num_images_per_prompt, negative_prompt_embeds=negative_prompt_emd, guidance_scale=guidance_scale, generator=generator, num_inference_steps=num_inference_steps).images
-        li_images.append(canny_image)
-        li_images.append(depth_image)
+        with registry.using(DESIGN_TYPE_MODELS[requests[0]['design_type']]):
+            compel = compel_proc['sd']
 
-    elif design_type == 'IN_PAINTING':
-        li_images = base_models["pipe_inpaint"](prompt_embeds=prompt_emd, image=image.resize((512, 512)), mask_image=mask.resize((512, 512)), num_images_per_prompt=num_images_per_prompt, negative_prompt_embeds=negative_prompt_emd, guidance_scale=guidance_scale, num_inference_steps=num_inference_steps).images
+            # prompts of different lengths are padded to the same number of tokens
+            embeds = compel.pad_conditioning_tensors_to_same_length([compel(r['prompt']) for r in requests] + [compel(r['negative_prompt']) for r in requests])
+            prompt_embeds = torch.cat([e.repeat(n, 1, 1) for e, n in zip(embeds[:len(requests)], counts)])
+            negative_embeds = torch.cat([e.repeat(n, 1, 1) for e, n in zip(embeds[len(requests):], counts)])
 
-    return li_images
+            # one generator per request, so that each request gets the images of its seed whatever it is batched with
+            generators = []
+            for r, n in zip(requests, counts):
+                generators.extend([get_generator(r['seed'])] * n)
+
+            first = requests[0]
+            images = base_models["pipe_txt_img"](prompt_embeds=prompt_embeds, negative_prompt_embeds=negative_embeds, num_images_per_prompt=1, generator=generators,
+                                                 guidance_scale=first['guidance_scale'], num_inference_steps=first['num_inference_steps']).images
+
+    results, start = [], 0
+    for n in counts:
+        results.append(images[start:start + n])
+        start += n
+
+    return results
+
+
+def metrics():
+    """
+    This function returns the batching metrics (queue depth, batch sizes, wait), the prompt embedding, control map and
+    input image cache metrics and the model memory report.
+    """
+    return {'batching': scheduler.stats(),
+            'prompt_cache': prompt_cache.stats() if prompt_cache else None,
+            'control_maps': control_preprocessor.stats(),
+            'input_images': image_cache.stats(),
+            'memory': memory_report()}
+
+
+def close_stream(stream, future):
+    """
+    This function closes the stream of a streamed request once its design() call on the scheduler is done.
+    """
+    error = future.exception()
+    if error is not None:
+        logging.error(f"Streamed design failed: {error}")
+    stream.close(error=error)
 
 
 def run(raw_data):
     """
      This function takes raw data as input, processes it, and calls the design function to generate images.
      It then prepares the response and returns it.
+     With "stream": true, the images are returned as a multipart/mixed stream of JPEGs, sent as soon as each one is
+     ready, with a latent preview of each image every "preview_steps" steps if set.
     """
     logging.info("Request received")
     print(f'raw data: {raw_data}')
@@ -398,9 +690,10 @@ def run(raw_data):
     image = None
     strength = data['strength']
 
+    # image and mask are downloaded concurrently
     if 'mask_image' in data:
         mask_url = data['mask_image']
-        mask = get_image_object(mask_url)
+        mask = fetch_executor.submit(get_image_object, mask_url)
 
     if 'other_args' in data:
         other_args = data['other_args']
@@ -408,17 +701,31 @@ def run(raw_data):
 
     if 'image_url' in data:
         image_url = data['image_url']
-        image = get_image_object(image_url)
+        image = fetch_executor.submit(get_image_object, image_url)
+
+    image = image.result() if image else None
+    mask = mask.result() if mask else None
 
     if 'strength' in data:
         strength = data['strength']
 
-    with torch.inference_mode():
-        images = design(prompt=prompt, image=image, 
-                        num_images_per_prompt=num_images_per_prompt, 
-                        negative_prompt=negative_prompt, strength=strength, 
-                        guidance_scale=guidance_scale, num_inference_steps=num_inference_steps,
-                        seed=seed, design_type=design_type, mask=mask, other_args=other_args)
+    request = dict(prompt=prompt, image=image, 
+                   num_images_per_prompt=num_images_per_prompt, 
+                   negative_prompt=negative_prompt, strength=strength, 
+                   guidance_scale=guidance_scale, num_inference_steps=num_inference_steps,
+                   seed=seed, design_type=design_type, mask=mask, other_args=other_args)
+
+    if data.get('stream'):
+        # generated on the scheduler's worker like the other requests, the response streams while it runs
+        stream = ImageStream(encode_executor)
+        future = scheduler.submit_async({**request, 'stream': stream, 'preview_steps': data.get('preview_steps', 0)})
+        future.add_done_callback(lambda f: close_stream(stream, f))
+        resp = AMLResponse(iter(stream), 200)
+        resp.headers['Content-Type'] = stream.content_type
+        return resp
+
+    # concurrent compatible requests share a forward pass
+    images = scheduler.submit(request)
     
     preped_response = prepare_response(images)
     resp = AMLResponse(message=preped_response, status_code=200, json_str=True)
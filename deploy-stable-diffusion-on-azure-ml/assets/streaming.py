@@ -0,0 +1,110 @@
+import io
+import json
+import uuid
+import queue
+import logging
+
+import torch
+from PIL import Image
+
+
+# Linear approximations of the VAE decoder, latent channels -> RGB
+LATENT_RGB_FACTORS = {
+    'sd': [[0.298, 0.207, 0.208], [0.187, 0.286, 0.173], [-0.158, 0.189, 0.264], [-0.184, -0.271, -0.473]],
+    'sdxl': [[0.3920, 0.4054, 0.4549], [-0.2634, -0.0196, 0.0653], [0.0568, 0.1687, -0.0755], [-0.3112, -0.1419, -0.0310]],
+}
+
+
+def encode_jpeg(image, quality=90):
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+
+def latents_to_images(latents, family='sd'):
+    """
+    Rough previews of a batch of latents (1/8 of the image resolution) without running the VAE
+    """
+    factors = torch.tensor(LATENT_RGB_FACTORS[family], dtype=latents.dtype, device=latents.device)
+    rgb = torch.einsum('bchw,cr->bhwr', latents, factors)
+    rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).to(torch.uint8).cpu().numpy()
+    return [Image.fromarray(x) for x in rgb]
+
+
+class ImageStream:
+    """
+    multipart/mixed response body fed by the generation thread.
+
+    put_image() and put_preview() hand the images to an encoding thread pool and return right away, so JPEG
+    encoding overlaps with the next denoising steps. Iterating the stream yields one part per image, in the
+    order they were put, each one as soon as it is encoded, then the closing boundary. Parts carry the raw
+    JPEG bytes with X-Image-Kind (final or preview) and X-Image-Index headers; an error ends the stream with
+    an application/json part.
+    """
+
+    def __init__(self, executor, quality=90, preview_quality=60):
+        self.executor = executor
+        self.quality = quality
+        self.preview_quality = preview_quality
+        self.boundary = uuid.uuid4().hex
+        self.parts = queue.Queue()
+        self.images = 0
+        self.previews = 0
+
+    @property
+    def content_type(self):
+        return f'multipart/mixed; boundary={self.boundary}'
+
+    def put_image(self, image):
+        headers = {'X-Image-Kind': 'final', 'X-Image-Index': str(self.images)}
+        self.parts.put((headers, self.executor.submit(encode_jpeg, image, self.quality)))
+        self.images += 1
+
+    def put_preview(self, image, index, step):
+        headers = {'X-Image-Kind': 'preview', 'X-Image-Index': str(index), 'X-Step': str(step)}
+        self.parts.put((headers, self.executor.submit(encode_jpeg, image, self.preview_quality)))
+        self.previews += 1
+
+    def close(self, error=None):
+        if error is not None:
+            self.parts.put(({'Content-Type': 'application/json'}, json.dumps({'error': str(error)}).encode('utf-8')))
+        self.parts.put(None)
+
+    def format_part(self, headers, body):
+        headers = {'Content-Type': 'image/jpeg', **headers, 'Content-Length': str(len(body))}
+        head = ''.join(f'{k}: {v}\r\n' for k, v in headers.items())
+        return f'--{self.boundary}\r\n{head}\r\n'.encode('utf-8') + body + b'\r\n'
+
+    def __iter__(self):
+        while True:
+            part = self.parts.get()
+            if part is None:
+                break
+
+            headers, body = part
+            if not isinstance(body, bytes):
+                try:
+                    body = body.result()
+                except Exception as e:
+                    logging.exception("Image encoding failed")
+                    headers, body = {'Content-Type': 'application/json'}, json.dumps({'error': str(e)}).encode('utf-8')
+            yield self.format_part(headers, body)
+
+        yield f'--{self.boundary}--\r\n'.encode('utf-8')
+
+
+def get_preview_kwargs(stream, preview_steps, family='sd'):
+    """
+    Pipeline arguments that put a preview of each image in stream every preview_steps denoising steps,
+    none if previews are disabled
+    """
+    if stream is None or not preview_steps:
+        return {}
+
+    def on_step_end(pipe, step, timestep, callback_kwargs):
+        if (step + 1) % preview_steps == 0:
+            for index, image in enumerate(latents_to_images(callback_kwargs['latents'], family)):
+                stream.put_preview(image, index, step + 1)
+        return callback_kwargs
+
+    return {'callback_on_step_end': on_step_end, 'callback_on_step_end_tensor_inputs': ['latents']}
@@ -0,0 +1,76 @@
+"""
+Compares the two TXT_TO_IMG_SDXL refiner paths of assets/score.py:
+  latent: base latents refined in one batched refiner call
+  image:  base images decoded, then refined one refiner call per image
+
+    python benchmark_sdxl_refiner.py --num_images 4 --steps 30 --repeats 3
+
+Checkpoints can be swapped for tiny ones with the *_MODEL_ID environment variables read by score.py.
+"""
+import os
+import sys
+import time
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets'))
+
+os.environ.setdefault('PRELOAD_DESIGN_TYPES', 'TXT_TO_IMG_SDXL')
+os.environ.setdefault('BATCH_MAX_IMAGES', '0')
+# each run encodes its prompts, as a request with new prompts would
+os.environ.setdefault('PROMPT_CACHE_MB', '0')
+
+import torch
+import score
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--prompt", type=str, default="product studio photography of a tin of hair wax on a cosmetics shelf")
+parser.add_argument("--negative_prompt", type=str, default="worst quality, low quality, jpeg artifacts, blurry")
+parser.add_argument("--num_images", type=int, default=4)
+parser.add_argument("--steps", type=int, default=30)
+parser.add_argument("--strength", type=float, default=0.3)
+parser.add_argument("--repeats", type=int, default=3)
+args = parser.parse_args()
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def run_design(mode):
+    with torch.inference_mode():
+        images = score.design(prompt=args.prompt, negative_prompt=args.negative_prompt, num_images_per_prompt=args.num_images,
+                              num_inference_steps=args.steps, strength=args.strength, seed=0, design_type='TXT_TO_IMG_SDXL',
+                              other_args={'SDXL_REFINER_MODE': mode})
+    synchronize()
+    return images
+
+
+score.init()
+
+results = {}
+for mode in ['image', 'latent']:
+    # warm-up: kernels, allocator, lazily built compel processors
+    run_design(mode)
+
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+    timings = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        images = run_design(mode)
+        timings.append(time.perf_counter() - start)
+
+    results[mode] = {
+        'images': len(images),
+        'mean_seconds': sum(timings) / len(timings),
+        'min_seconds': min(timings),
+        'seconds_per_image': min(timings) / len(images),
+        'peak_memory_gb': round(torch.cuda.max_memory_allocated() / 2**30, 2) if torch.cuda.is_available() else None,
+    }
+
+results['speedup'] = results['image']['min_seconds'] / results['latent']['min_seconds']
+print(json.dumps(results, indent=2))
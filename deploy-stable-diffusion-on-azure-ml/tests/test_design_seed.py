@@ -0,0 +1,96 @@
+import os
+import sys
+import types
+
+import pytest
+
+# score.py imports the whole inference stack
+for module in ['torch', 'cv2', 'compel', 'diffusers', 'transformers', 'controlnet_aux', 'safetensors', 'azureml.contrib.services.aml_response']:
+    pytest.importorskip(module)
+
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'assets'))
+
+import score
+from control_maps import ControlImagePreprocessor
+from model_registry import ModelRegistry, RegistryView
+
+
+class FakePipeline:
+    """
+    Stands in for a diffusers pipeline: its "images" are the initial latents drawn from the generator it gets
+    """
+
+    def __call__(self, num_images_per_prompt=1, generator=None, **kwargs):
+        generators = generator if isinstance(generator, list) else [generator] * num_images_per_prompt
+        return types.SimpleNamespace(images=[torch.randn(4, 8, 8, generator=g) for g in generators])
+
+
+class FakeCompel:
+
+    def __init__(self, pooled=False):
+        self.pooled = pooled
+
+    def __call__(self, prompt):
+        embeds = torch.zeros(1, 77, 8)
+        return (embeds, torch.zeros(1, 8)) if self.pooled else embeds
+
+    def pad_conditioning_tensors_to_same_length(self, conditionings):
+        return conditionings
+
+
+@pytest.fixture(autouse=True)
+def fake_models(monkeypatch):
+    registry = ModelRegistry()
+    for name in score.BASE_MODEL_NAMES + score.CNET_MODEL_NAMES:
+        registry.register(name, FakePipeline)
+    for family, name in score.COMPEL_NAMES.items():
+        registry.register(name, lambda pooled=family.startswith('sdxl'): FakeCompel(pooled))
+
+    monkeypatch.setattr(score, 'registry', registry, raising=False)
+    monkeypatch.setattr(score, 'base_models', RegistryView(registry, score.BASE_MODEL_NAMES), raising=False)
+    monkeypatch.setattr(score, 'cnet_models', RegistryView(registry, score.CNET_MODEL_NAMES), raising=False)
+    monkeypatch.setattr(score, 'compel_proc', RegistryView(registry, score.COMPEL_NAMES), raising=False)
+    monkeypatch.setattr(score, 'control_preprocessor', ControlImagePreprocessor({'canny': lambda image: image, 'depth': lambda image: image}), raising=False)
+    monkeypatch.setattr(score, 'MultiControlNetModel', list)
+
+
+def run_design(design_type, other_args=None):
+    # the global RNG changes between runs: only the request seed may decide the latents
+    torch.seed()
+    image = Image.new('RGB', (64, 64), 'white')
+    with torch.inference_mode():
+        return score.design(prompt='a tin of hair wax', negative_prompt='blurry', image=image, mask=image, seed=1234,
+                            num_images_per_prompt=2, num_inference_steps=2, design_type=design_type, other_args=other_args)[:2]
+
+
+@pytest.mark.parametrize('design_type, other_args', [
+    ('TXT_TO_IMG', None),
+    ('IMG_TO_IMG', None),
+    ('TXT_TO_IMG_SDXL', {'SDXL_REFINER_MODE': 'latent'}),
+    ('TXT_TO_IMG_SDXL', {'SDXL_REFINER_MODE': 'image'}),
+    ('IMG_TO_IMG_SDXL', None),
+    ('CNET_CANNY', None),
+    ('CNET_CANNY_DEPTH', None),
+    ('IN_PAINTING', None),
+])
+def test_same_seed_gives_same_latents(design_type, other_args):
+    first, second = run_design(design_type, other_args), run_design(design_type, other_args)
+
+    assert len(first) == 2
+    for a, b in zip(first, second):
+        assert torch.equal(a, b)
+
+
+def test_batched_and_single_requests_get_the_same_latents():
+    request = dict(prompt='a tin of hair wax', negative_prompt='blurry', image=None, mask=None, seed=7, num_images_per_prompt=2,
+                   strength=0.65, guidance_scale=7.5, num_inference_steps=2, design_type='TXT_TO_IMG', other_args=None)
+
+    with torch.inference_mode():
+        single = score.design(**request)
+    batched = score.design_batch([request, {**request, 'seed': 8}])[0]
+
+    for a, b in zip(single, batched):
+        assert torch.equal(a, b)
@@ -0,0 +1,176 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'gen-cv', 'embeddings.sqlite')
+
+
+
+def normalize_text(text):
+    """
+    Normalize text before hashing so whitespace-only differences hit the same cache entry
+    """
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache keyed by content hash, model name and API version.
+
+    Lookups go to an in-process LRU first, then to a SQLite file. The SQLite tier is capped
+    at max_disk_bytes: least recently used entries are evicted when the cap is exceeded.
+    """
+
+    def __init__(self, path = DEFAULT_CACHE_PATH, max_memory_items = 10000, max_disk_bytes = 1024 ** 3):
+
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+                                key TEXT PRIMARY KEY,
+                                vector BLOB NOT NULL,
+                                size INTEGER NOT NULL,
+                                last_access REAL NOT NULL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings (last_access)")
+        self.conn.commit()
+        self.disk_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+
+    @staticmethod
+    def make_key(content, model, api_version = None):
+        """
+        Cache key of image bytes or text for a given model and API version
+        """
+        if isinstance(content, str):
+            content = normalize_text(content).encode('utf-8')
+
+        h = hashlib.sha256(content).hexdigest()
+        return f"{model}|{api_version}|{h}"
+
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return list(self.memory[key])
+
+            row = self.conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.conn.execute("UPDATE embeddings SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            vector = np.frombuffer(row[0], dtype=np.float32).tolist()
+            self._remember(key, vector)
+            self.hits += 1
+            self.disk_hits += 1
+            return list(vector)
+
+
+    def put(self, key, vector):
+        blob = np.asarray(vector, dtype=np.float32).tobytes()
+
+        with self.lock:
+            self._remember(key, list(vector))
+
+            old = self.conn.execute("SELECT size FROM embeddings WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO embeddings (key, vector, size, last_access) VALUES (?, ?, ?, ?)",
+                              (key, blob, len(blob), time.time()))
+            self.disk_bytes += len(blob) - (old[0] if old else 0)
+
+            if self.disk_bytes > self.max_disk_bytes:
+                self._evict()
+
+            self.conn.commit()
+
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached embedding of key, calling compute() and caching its result on a miss
+        """
+        vector = self.get(key)
+        if vector is None:
+            vector = compute()
+            if vector is not None:
+                self.put(key, vector)
+
+        return vector
+
+
+    def _remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+
+    def _evict(self):
+        # drop least recently used rows until the disk tier is back to 90% of its cap
+        target = int(self.max_disk_bytes * 0.9)
+
+        while self.disk_bytes > target:
+            rows = self.conn.execute("SELECT key, size FROM embeddings ORDER BY last_access LIMIT 1000").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.disk_bytes <= target:
+                    break
+                self.conn.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                self.memory.pop(key, None)
+                self.disk_bytes -= size
+
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'memory_items': len(self.memory),
+            'disk_bytes': self.disk_bytes,
+        }
+
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.conn.execute("DELETE FROM embeddings")
+            self.conn.commit()
+            self.disk_bytes = 0
+
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """
+    Process-wide cache, stored at $EMBEDDING_CACHE_PATH (default ~/.cache/gen-cv/embeddings.sqlite)
+    """
+    global _default_cache
+
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache(os.getenv('EMBEDDING_CACHE_PATH', DEFAULT_CACHE_PATH))
+
+    return _default_cache
@@ -0,0 +1,191 @@
+import os
+import json
+import pickle
+import argparse
+import numpy as np
+
+from similarity import SimilarityIndex
+
+
+VECTORS_FILE = 'vectors.bin'
+RECORDS_FILE = 'records.jsonl'
+META_FILE = 'meta.json'
+
+
+
+class EmbeddingStore:
+    """
+    On-disk embedding store.
+
+    Vectors are kept in one contiguous row-major float32/float16 matrix (`vectors.bin`) that is opened
+    with a memory map, so opening a store does not read the vectors. Each row has a JSON record in the
+    `records.jsonl` sidecar holding its id (typically the image path) and optional metadata.
+    New rows are appended to both files, existing rows are never rewritten.
+    """
+
+    def __init__(self, path, dim = None, dtype = 'float32'):
+
+        self.path = path
+        self.meta_path = os.path.join(path, META_FILE)
+        self.vectors_path = os.path.join(path, VECTORS_FILE)
+        self.records_path = os.path.join(path, RECORDS_FILE)
+
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            if (dim is not None) and (dim != meta['dim']):
+                raise ValueError(f"Store {path} has dimension {meta['dim']}, got {dim}")
+            self.dim = meta['dim']
+            self.dtype = np.dtype(meta['dtype'])
+        else:
+            if dim is None:
+                raise ValueError(f"No embedding store at {path}, the dimension is required to create one")
+            self.dim = dim
+            self.dtype = np.dtype(dtype)
+            os.makedirs(path, exist_ok=True)
+            with open(self.meta_path, 'w') as f:
+                json.dump({'dim': self.dim, 'dtype': self.dtype.name}, f)
+            open(self.vectors_path, 'ab').close()
+            open(self.records_path, 'ab').close()
+
+        self.row_bytes = self.dim * self.dtype.itemsize
+        self._load_records()
+        self._vectors = None
+
+
+    def _load_records(self):
+        self.records = []
+        with open(self.records_path) as f:
+            for line in f:
+                try:
+                    self.records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+
+        # An interrupted append can leave one file longer than the other: only complete rows count
+        n_rows = os.path.getsize(self.vectors_path) // self.row_bytes
+        self.records = self.records[:n_rows]
+        self.id_to_row = {r['id']: i for i, r in enumerate(self.records)}
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def __contains__(self, id):
+        return id in self.id_to_row
+
+
+    @property
+    def ids(self):
+        return [r['id'] for r in self.records]
+
+
+    @property
+    def vectors(self):
+        """
+        Read-only memory-mapped matrix of shape (len(store), dim)
+        """
+        if (self._vectors is None) or (len(self._vectors) != len(self)):
+            if len(self) == 0:
+                self._vectors = np.empty((0, self.dim), dtype=self.dtype)
+            else:
+                self._vectors = np.memmap(self.vectors_path, dtype=self.dtype, mode='r', shape=(len(self), self.dim))
+
+        return self._vectors
+
+
+    def get(self, id):
+        return self.vectors[self.id_to_row[id]]
+
+
+    def append(self, ids, vectors, records = None):
+        """
+        Append vectors with their ids (and optional metadata dicts) at the end of the store
+        """
+        vectors = np.asarray(vectors, dtype=self.dtype).reshape(-1, self.dim)
+        ids = list(ids)
+
+        if len(ids) != len(vectors):
+            raise ValueError(f"Got {len(ids)} ids for {len(vectors)} vectors")
+
+        if records is None:
+            records = [{} for _ in ids]
+
+        new_records = [{**record, 'id': id} for id, record in zip(ids, records)]
+
+        self._truncate_to_records()
+
+        with open(self.vectors_path, 'ab') as f:
+            f.write(vectors.tobytes())
+        with open(self.records_path, 'a') as f:
+            f.writelines(json.dumps(r) + '\n' for r in new_records)
+
+        for r in new_records:
+            self.id_to_row[r['id']] = len(self.records)
+            self.records.append(r)
+
+
+    def _truncate_to_records(self):
+        # drop a partially written tail left by an interrupted append
+        expected = len(self.records) * self.row_bytes
+        if os.path.getsize(self.vectors_path) != expected:
+            self._vectors = None
+            with open(self.vectors_path, 'r+b') as f:
+                f.truncate(expected)
+            with open(self.records_path, 'w') as f:
+                f.writelines(json.dumps(r) + '\n' for r in self.records)
+
+
+    def similarity_index(self):
+        """
+        Build a SimilarityIndex over the store, keyed by the store ids
+        """
+        return SimilarityIndex(self.vectors, self.ids)
+
+
+
+def import_pickle(pkl_file, store_path, id_column = 'file', vector_column = 'embedding', dtype = 'float32'):
+    """
+    Import embeddings saved with utils.save_obj_to_pkl into an EmbeddingStore.
+
+    Supported pickles: a pandas DataFrame with an id column and an embedding column (other columns are
+    kept as metadata), a dict of {id: embedding}, or a plain list of embeddings (ids are the row numbers).
+    """
+    with open(pkl_file, 'rb') as f:
+        obj = pickle.load(f)
+
+    records = None
+
+    if hasattr(obj, 'to_dict') and hasattr(obj, 'columns'):
+        ids = [str(i) for i in obj[id_column]]
+        vectors = np.array(obj[vector_column].tolist(), dtype=dtype)
+        meta_columns = [c for c in obj.columns if c not in (id_column, vector_column)]
+        records = obj[meta_columns].to_dict('records') if meta_columns else None
+    elif isinstance(obj, dict):
+        ids = [str(i) for i in obj.keys()]
+        vectors = np.array(list(obj.values()), dtype=dtype)
+    else:
+        ids = [str(i) for i in range(len(obj))]
+        vectors = np.array(obj, dtype=dtype)
+
+    store = EmbeddingStore(store_path, dim=vectors.shape[1], dtype=dtype)
+    store.append(ids, vectors, records)
+
+    return store
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Import a pickle of embeddings into an embedding store')
+    parser.add_argument('pkl_file', type=str, help='pickle file created with utils.save_obj_to_pkl')
+    parser.add_argument('store_path', type=str, help='directory of the embedding store')
+    parser.add_argument('--id_column', type=str, default='file')
+    parser.add_argument('--vector_column', type=str, default='embedding')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'])
+
+    args = parser.parse_args()
+
+    store = import_pickle(args.pkl_file, args.store_path, args.id_column, args.vector_column, args.dtype)
+    print(f"{len(store)} embeddings of dimension {store.dim} in {args.store_path}")
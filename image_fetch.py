@@ -0,0 +1,198 @@
+import os
+import re
+import json
+import hashlib
+import threading
+import requests
+from io import BytesIO
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gen-cv', 'images')
+
+
+
+def decode_image(data, max_size = None, mode = None):
+    """
+    Decode image bytes. With max_size, JPEGs are decoded at a reduced scale by the decoder itself (draft mode)
+    and the result is downscaled to fit in max_size x max_size.
+    """
+    img = Image.open(BytesIO(data))
+
+    if max_size is not None:
+        # draft() only picks a scale >= the requested size, thumbnail() does the rest
+        img.draft(mode or img.mode, (max_size, max_size))
+        img.thumbnail((max_size, max_size))
+
+    if mode is not None and img.mode != mode:
+        img = img.convert(mode)
+
+    return img
+
+
+
+class ImageDiskCache:
+    """
+    Downloaded images, one file per URL with its ETag / Last-Modified next to it for revalidation
+    """
+
+    def __init__(self, directory = DEFAULT_CACHE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+
+    def get_path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+
+    def get(self, url):
+        """
+        (data, validators) of a cached URL, (None, {}) if not cached
+        """
+        path = self.get_path(url)
+        try:
+            with open(path + '.bin', 'rb') as f:
+                data = f.read()
+            with open(path + '.json') as f:
+                validators = json.load(f)
+        except (OSError, ValueError):
+            return None, {}
+
+        return data, validators
+
+
+    def put(self, url, data, validators):
+        path = self.get_path(url)
+        # write then rename, so concurrent readers never see a partial file
+        for suffix, content in (('.bin', data), ('.json', json.dumps(validators).encode('utf-8'))):
+            tmp = f"{path}{suffix}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(content)
+            os.replace(tmp, path + suffix)
+
+
+
+class ImageFetcher:
+    """
+    Concurrent image downloader over a bounded pool of keep-alive connections.
+
+    Downloads go through an on-disk cache keyed by URL: a cached image is revalidated with
+    If-None-Match / If-Modified-Since and only downloaded again when it changed (revalidate=False
+    serves cached images without any request).
+    """
+
+    def __init__(self, cache_dir = DEFAULT_CACHE_DIR, max_workers = 8, timeout = 30, revalidate = True, session = None):
+        self.cache = ImageDiskCache(cache_dir) if cache_dir else None
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.revalidate = revalidate
+
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+
+    def fetch(self, url):
+        """
+        Bytes of the image at url
+        """
+        data, validators = self.cache.get(url) if self.cache else (None, {})
+        if data is not None and not self.revalidate:
+            return data
+
+        headers = {}
+        if data is not None:
+            if validators.get('etag'): headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'): headers['If-Modified-Since'] = validators['last_modified']
+
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException:
+            if data is not None:
+                return data
+            raise
+
+        if response.status_code == 304 and data is not None:
+            return data
+
+        response.raise_for_status()
+
+        if self.cache:
+            self.cache.put(url, response.content, {'etag': response.headers.get('ETag'),
+                                                   'last_modified': response.headers.get('Last-Modified')})
+        return response.content
+
+
+    def fetch_many(self, urls):
+        """
+        Bytes of each image, in the order of urls, yielded as soon as each one (and the ones before it) is downloaded
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            yield from executor.map(self.fetch, urls)
+
+
+    def iter_images(self, urls, max_size = None, mode = None):
+        """
+        Decoded images, in the order of urls; decoding of an image overlaps with the next downloads
+        """
+        for data in self.fetch_many(urls):
+            yield decode_image(data, max_size, mode)
+
+
+
+class FilenameAllocator:
+    """
+    Hands out numbered filenames (001.png, 002.png...) in a directory.
+
+    The directory is scanned once; each name is then claimed with an exclusive create, so that
+    concurrent writers (threads or processes) never get the same file.
+    """
+
+    def __init__(self, directory, extension = '.png', width = 3):
+        self.directory = directory
+        self.extension = extension
+        self.width = width
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        pattern = re.compile(r'^(\d+)' + re.escape(extension) + '$')
+        indexes = [int(m.group(1)) for m in map(pattern.match, os.listdir(directory)) if m]
+        self.next_index = max(indexes, default=0) + 1
+
+
+    def allocate(self):
+        """
+        Path of a new, empty file
+        """
+        with self.lock:
+            while True:
+                path = os.path.join(self.directory, f"{self.next_index:0{self.width}d}{self.extension}")
+                self.next_index += 1
+                try:
+                    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                    return path
+                except FileExistsError:
+                    continue
+
+
+
+_default_fetcher = None
+_default_fetcher_lock = threading.Lock()
+
+
+def get_image_fetcher():
+    """
+    Process-wide fetcher, caching images in $IMAGE_CACHE_DIR (default ~/.cache/gen-cv/images)
+    """
+    global _default_fetcher
+
+    with _default_fetcher_lock:
+        if _default_fetcher is None:
+            _default_fetcher = ImageFetcher(os.getenv('IMAGE_CACHE_DIR', DEFAULT_CACHE_DIR))
+
+    return _default_fetcher
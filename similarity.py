@@ -0,0 +1,101 @@
+import numpy as np
+
+
+
+def normalize_rows(vectors, dtype=np.float32):
+    """
+    L2-normalize a vector or a matrix of vectors (one per row). Zero rows are left as zeros.
+    """
+    matrix = np.asarray(vectors, dtype=dtype)
+    if matrix.ndim == 1:
+        matrix = matrix[None, :]
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+
+def top_k_indices(scores, k):
+    """
+    Return the indices of the k highest scores of each row, sorted by descending score.
+    Uses argpartition so only the k selected candidates get sorted.
+    """
+    n = scores.shape[1]
+    k = min(k, n)
+
+    if k < n:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.tile(np.arange(n), (scores.shape[0], 1))
+
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+
+class SimilarityIndex:
+    """
+    Brute-force cosine similarity over an in-memory embedding corpus.
+
+    The corpus is held as a pre-normalized float32 matrix, so a query (or a batch of queries)
+    is scored against every item with one matrix product.
+    """
+
+    def __init__(self, embeddings, ids = None, dtype = np.float32):
+
+        self.matrix = normalize_rows(embeddings, dtype=dtype)
+        self.ids = list(range(len(self.matrix))) if ids is None else list(ids)
+
+        if len(self.ids) != len(self.matrix):
+            raise ValueError(f"Got {len(self.ids)} ids for {len(self.matrix)} embeddings")
+
+
+    def __len__(self):
+        return len(self.matrix)
+
+
+    def scores(self, queries):
+        """
+        Cosine similarity of each query against every item of the corpus, shape (n_queries, n_items).
+        """
+        queries = normalize_rows(queries, dtype=self.matrix.dtype)
+
+        if queries.shape[1] != self.matrix.shape[1]:
+            raise ValueError(f"Query dimension {queries.shape[1]} does not match corpus dimension {self.matrix.shape[1]}")
+
+        return queries @ self.matrix.T
+
+
+    def search_batch(self, queries, k = 5):
+        """
+        Top-k search for a batch of queries. Returns one list of (id, similarity) tuples per query.
+        """
+        scores = self.scores(queries)
+        indices = top_k_indices(scores, k)
+
+        results = []
+        for row, idx in zip(scores, indices):
+            results.append([(self.ids[i], float(row[i])) for i in idx])
+
+        return results
+
+
+    def search(self, query, k = 5):
+        """
+        Top-k search for a single query vector. Returns a list of (id, similarity) tuples.
+        """
+        return self.search_batch(np.asarray(query)[None, :], k)[0]
+
+
+
+def cosine_similarity(vector1, vector2):
+    """
+    Cosine similarity of two embedding vectors.
+    Vectors of different lengths are compared on their common prefix, with the norms of the full vectors.
+    """
+    v1 = np.asarray(vector1, dtype=np.float64)
+    v2 = np.asarray(vector2, dtype=np.float64)
+    length = min(len(v1), len(v2))
+    return float(v1[:length] @ v2[:length] / (np.linalg.norm(v1) * np.linalg.norm(v2)))
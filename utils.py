@@ -4,13 +4,18 @@ import json
 from PIL import Image
 import requests
 import math
-from io import BytesIO
+import numpy as np
 import matplotlib.pyplot as plt
 import azure.ai.vision as sdk
 import pickle
 from tenacity import retry, stop_after_attempt, wait_random_exponential
 import openai
 
+from similarity import SimilarityIndex, cosine_similarity
+from embedding_store import EmbeddingStore
+from embedding_cache import get_embedding_cache
+from image_fetch import get_image_fetcher, FilenameAllocator
+
 # Central variables image search:
 load_dotenv('../.env')
 
@@ -19,6 +24,9 @@ key = os.getenv("azure_cv_key")
 endpoint = os.getenv("azure_cv_endpoint")
 # if endpoint.endswith('/'): endpoint = endpoint[:-1] # remove trailing slash if present
 
+cv_api_version = "2023-02-01-preview"
+cv_model_version = "latest"
+
 
 # Azure OpenAI
 # api_key = os.getenv('AOAI_API_KEY') # key of your Azure OpenAI resource
@@ -34,9 +42,10 @@ endpoint = os.getenv("azure_cv_endpoint")
 
 
 
-def show_images(images, cols=2, source='url', savedir='', show_title=False, titles=None):
+def show_images(images, cols=2, source='url', savedir='', show_title=False, titles=None, max_size=1024):
     """
     Get images from URL and display them in a grid. Optionally save or retrieve images to/from local dir. 
+    URLs are downloaded concurrently and cached on disk (see image_fetch).
     
     Parameters
     ----------
@@ -50,40 +59,32 @@ def show_images(images, cols=2, source='url', savedir='', show_title=False, titl
         Directory to save images to.
     show_title : bool
         Display filename as image title (local files only)
+    max_size : int
+        Images are decoded at most max_size pixels wide or high for display (None for full size).
+        Saved images are always full size.
     """
     
-    if savedir != '':
-        os.makedirs(savedir, exist_ok=True)
+    allocator = FilenameAllocator(savedir) if savedir != '' else None
         
     rows = int(math.ceil(len(images) / cols))
 
     fig = plt.figure(figsize=(cols * 5, rows * 5)) # specifying the overall grid size. TODO: 7,5 for landscape images
 
-    for i, image_url in enumerate(images):
+    if source == 'url':
+        # full size decode only when the images are saved
+        loaded = get_image_fetcher().iter_images(images, max_size=None if allocator else max_size)
+    else:
+        loaded = (Image.open(image_url) for image_url in images) # local files
+
+    for i, (image_url, img) in enumerate(zip(images, loaded)):
         plt.subplot(rows, cols,i+1)  
         
         if source == 'url':
-            response = requests.get(image_url)
-            img = Image.open(BytesIO(response.content))
-            
-            # save images if savedir is specified
-            if savedir != '':
-                
-                # get list of png files
-                png_filenames = [image for image in os.listdir(savedir) if image.endswith('.png')]
-                # get highest index from existing files
-                if png_filenames == []:
-                    max_index = 0
-                else:
-                    max_index = max([int(filename.strip('.png')) for filename in png_filenames])
-
-                # save new file with index + 1
-                new_filename = f'{max_index+1:03d}.png'
-                fp = os.path.join(savedir, new_filename)
-                img.save(fp, 'PNG')            
+            # save images if savedir is specified, as 001.png, 002.png...
+            if allocator:
+                img.save(allocator.allocate(), 'PNG')
             
         else: 
-            img = Image.open(image_url) # local file
             if show_title:
                 if titles is None: plt.title(image_url)
                 else: plt.title(titles[i])
@@ -98,22 +99,18 @@ def show_images(images, cols=2, source='url', savedir='', show_title=False, titl
 
 
 @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6)) # automatic retry in case of a failing API call
-def get_embedding(imagefile):
+def vectorize_image(data):
     """
-    Get embedding from an image using Azure Computer Vision 4
+    Get embedding from image bytes using Azure Computer Vision 4
     """
     # settings
-    model = "?api-version=2023-02-01-preview&modelVersion=latest"
+    model = f"?api-version={cv_api_version}&modelVersion={cv_model_version}"
     url = endpoint + "/computervision/retrieval:vectorizeImage" + model
     headers = {
         "Content-type": "application/octet-stream",
         "Ocp-Apim-Subscription-Key": key,
     }
 
-    # Read the image file
-    with open(imagefile, "rb") as f:
-        data = f.read()
-
     # Sending the requests
     r = requests.post(url, data=data, headers=headers)
     results = r.json()
@@ -122,15 +119,32 @@ def get_embedding(imagefile):
     return embeddings
 
 
+def get_embedding(imagefile, use_cache=True):
+    """
+    Get embedding from an image using Azure Computer Vision 4.
+    Embeddings are cached by image content, so unchanged files are not sent again.
+    """
+    # Read the image file
+    with open(imagefile, "rb") as f:
+        data = f.read()
+
+    if not use_cache:
+        return vectorize_image(data)
+
+    cache = get_embedding_cache()
+    cache_key = cache.make_key(data, f"cv-image-{cv_model_version}", cv_api_version)
+    return cache.get_or_compute(cache_key, lambda: vectorize_image(data))
+
+
 @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6)) # automatic retry in case of a failing API call
-def get_text_embedding(text):
+def vectorize_text(text):
     """
     Get embedding from text using Azure Computer Vision 4
     """
 
     # settings
     options = "&features=caption,tags"
-    model = "?api-version=2023-02-01-preview&modelVersion=latest"
+    model = f"?api-version={cv_api_version}&modelVersion={cv_model_version}"
     url = endpoint + "/computervision/retrieval:vectorizeText" + model # + options
     headers = {
         "Content-type": "application/json",
@@ -149,15 +163,39 @@ def get_text_embedding(text):
     return embeddings
 
 
+def get_text_embedding(text, use_cache=True):
+    """
+    Get embedding from text using Azure Computer Vision 4.
+    Embeddings are cached by normalized text.
+    """
+    if not use_cache:
+        return vectorize_text(text)
+
+    cache = get_embedding_cache()
+    cache_key = cache.make_key(text, f"cv-text-{cv_model_version}", cv_api_version)
+    return cache.get_or_compute(cache_key, lambda: vectorize_text(text))
+
+
 
 def get_cosine_similarity(vector1, vector2):
     """
     Calculate cosine similarity of two embeddings vectors
     """
-    dot_product = sum(a*b for a, b in zip(vector1, vector2))
-    magnitude1 = math.sqrt(sum((val*val) for val in vector1))
-    magnitude2 = math.sqrt(sum((val*val) for val in vector2))
-    return dot_product / (magnitude1 * magnitude2)    
+    return cosine_similarity(vector1, vector2)
+
+
+
+def get_similar_embeddings(query_embeddings, embeddings, ids=None, top_k=5):
+    """
+    Get the top_k most similar embeddings for one query embedding or a list of query embeddings.
+    Returns a list of (id, similarity) tuples, or one such list per query.
+    """
+    index = embeddings if isinstance(embeddings, SimilarityIndex) else SimilarityIndex(embeddings, ids)
+
+    if np.ndim(query_embeddings) == 2:
+        return index.search_batch(query_embeddings, top_k)
+    else:
+        return index.search(query_embeddings, top_k)
 
 
 
@@ -187,10 +225,50 @@ def analyze_image(imagefile, extended_analysis = False):
 
 
 @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(30))
-def get_openai_embedding(query, embedding_model = 'text-embedding-ada-002'):
+def openai_embedding(query, embedding_model = 'text-embedding-ada-002'):
     return openai.Embedding.create(input=query, engine=embedding_model)['data'][0]['embedding']
 
 
+def get_openai_embedding(query, embedding_model = 'text-embedding-ada-002', use_cache = True):
+    if not use_cache:
+        return openai_embedding(query, embedding_model)
+
+    cache = get_embedding_cache()
+    cache_key = cache.make_key(query, f"openai-{embedding_model}", openai.api_version)
+    return cache.get_or_compute(cache_key, lambda: openai_embedding(query, embedding_model))
+
+
+@retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(30))
+def openai_embeddings(queries, embedding_model = 'text-embedding-ada-002'):
+    data = openai.Embedding.create(input=queries, engine=embedding_model)['data']
+    return [d['embedding'] for d in sorted(data, key=lambda d: d['index'])]
+
+
+def get_openai_embeddings(queries, embedding_model = 'text-embedding-ada-002', batch_size = 16, use_cache = True):
+    """
+    Embeddings of a list of strings, sent to the embeddings endpoint batch_size inputs per request.
+    Only the strings missing from the embedding cache are sent.
+    """
+    embeddings = [None] * len(queries)
+    cache = get_embedding_cache() if use_cache else None
+    keys = [cache.make_key(q, f"openai-{embedding_model}", openai.api_version) for q in queries] if use_cache else []
+
+    if use_cache:
+        for i, k in enumerate(keys):
+            embeddings[i] = cache.get(k)
+
+    missing = [i for i, e in enumerate(embeddings) if e is None]
+
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        for i, embedding in zip(batch, openai_embeddings([queries[i] for i in batch], embedding_model)):
+            embeddings[i] = embedding
+            if use_cache:
+                cache.put(keys[i], embedding)
+
+    return embeddings
+
+
 
 def save_obj_to_pkl(object, filename):
     with open(filename, 'wb') as pickle_out:
@@ -198,6 +276,18 @@ def save_obj_to_pkl(object, filename):
 
 
 
+def save_embeddings_to_store(ids, embeddings, store_path, records = None, dtype = 'float32'):
+    """
+    Append embeddings to the memory-mapped EmbeddingStore at store_path (created if missing)
+    """
+    embeddings = np.asarray(embeddings, dtype=dtype)
+    store = EmbeddingStore(store_path, dim=embeddings.shape[-1], dtype=dtype)
+    store.append(ids, embeddings, records)
+
+    return store
+
+
+
 @retry(wait=wait_random_exponential(min=1, max=5), stop=stop_after_attempt(7))
 def chat_openai(prompt, completion_model, max_output_tokens = 500):
 